@@ -0,0 +1,232 @@
+import pandas as pd
+import mtg_transform as mt
+import logging
+import json
+import gzip
+import io
+from os import path
+log = logging.getLogger("__main__")
+
+# simdjson parses lazily, so fields that are not projected are never turned into python objects
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+#region Compression
+def get_compression(file_name: str) -> str | None:
+    """Detect whether a bulk file is gzip or zstd compressed from its first bytes, None when it is plain"""
+    with open(file_name, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return None
+
+def require_zstandard():
+    if zstandard is None:
+        raise ValueError("zstd bulk files need the zstandard package installed")
+
+def open_bulk(file_name: str) -> io.BufferedIOBase:
+    """Open a bulk file for reading, decompressing it as it is read"""
+    compression = get_compression(file_name)
+    if compression == "gzip":
+        return gzip.open(file_name, 'rb')
+    if compression == "zstd":
+        require_zstandard()
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(file_name, 'rb'), closefd=True))
+    return open(file_name, 'rb')
+
+def is_ndjson(file_name: str) -> bool:
+    """NDJSON files start straight away with a record instead of a JSON array"""
+    with open_bulk(file_name) as f:
+        return f.read(64).lstrip().startswith(b"{")
+
+def write_ndjson(lines, file_name: str, compression: str):
+    """Write a bulk file that has one record per line as compressed NDJSON
+
+    Parameters:
+    lines (Iterable[bytes]): Lines of the bulk file, as scryfall serves it
+    file_name (str): Location to write to
+    compression (str): gzip or zstd
+    """
+    if compression == "gzip":
+        f = gzip.open(file_name, 'xb', compresslevel=6)
+    elif compression == "zstd":
+        require_zstandard()
+        f = zstandard.ZstdCompressor(level=10).stream_writer(open(file_name, 'xb'), closefd=True)
+    else:
+        raise ValueError("unknown bulk compression : "+str(compression))
+
+    with f:
+        for line in lines:
+            record = line.strip()
+            if record in (b"", b"[", b"]"):
+                continue
+            record = record.removesuffix(b",")
+            if not (record.startswith(b"{") and record.endswith(b"}")):
+                raise ValueError("bulk data is not one record per line")
+            f.write(record+b"\n")
+
+def iter_record_chunks(file_name: str, chunk_mb: int = 256):
+    """Stream a bulk file, yielding JSON arrays of whole records that are around chunk_mb in size
+
+    Parameters:
+    file_name (str): Bulk file location, compressed or not
+    chunk_mb (int): Size in MB a chunk has to reach before it is yielded
+    """
+    chunk_size = chunk_mb * 1048576
+    ndjson = is_ndjson(file_name)
+    indent: bytes = None
+    lines: list[bytes] = []
+    size = 0
+    with open_bulk(file_name) as f:
+        for line in f:
+            if indent is None:
+                stripped = line.lstrip()
+                # skips the opening bracket of an array
+                if not stripped.startswith(b"{"):
+                    continue
+                indent = line[:len(line) - len(stripped)]
+            if lines and size >= chunk_size and is_record_start(line, indent):
+                yield records_to_array(lines, ndjson)
+                lines = []
+                size = 0
+            lines.append(line)
+            size += len(line)
+    if lines:
+        yield records_to_array(lines, ndjson)
+
+def records_to_array(lines: list[bytes], ndjson: bool) -> bytes:
+    if ndjson:
+        # ndjson records are not comma separated
+        return b"["+b",".join(line for line in lines if line.strip() != b"")+b"]"
+    text = b"".join(lines).strip().removeprefix(b"[").removesuffix(b"]").strip().removesuffix(b",")
+    return b"["+text+b"]"
+#endregion
+
+def get_record_indent(file_name: str) -> bytes:
+    """Find the indentation that top level records start at
+
+    Scryfall bulk files have one record per line, files written with json.dump(indent=4) start each record at four spaces.
+    JSON strings can not contain raw new lines, so a line starting with exactly this indent and a "{" is always a record start
+
+    Parameters:
+    file_name (str): Bulk file location
+    """
+    with open(file_name, 'rb') as f:
+        for line in f:
+            stripped = line.lstrip()
+            if stripped.startswith(b"{"):
+                return line[:len(line) - len(stripped)]
+    return b""
+
+def is_record_start(line: bytes, indent: bytes) -> bool:
+    return line.startswith(indent) and line[len(indent):len(indent)+1] == b"{"
+
+def find_shard_offsets(file_name: str, shards: int) -> list[tuple[int, int]]:
+    """Split a bulk file into byte ranges that each start on a top level record
+
+    Parameters:
+    file_name (str): Bulk file location
+    shards (int): Amount of ranges to split into, less are returned for small files
+    """
+    size = path.getsize(file_name)
+    indent = get_record_indent(file_name)
+    starts = [0]
+    with open(file_name, 'rb') as f:
+        for shard in range(1, shards):
+            target = max(size * shard // shards, starts[-1] + 1)
+            f.seek(target)
+            # the line the target lands in is partial, skip it
+            f.readline()
+            offset = f.tell()
+            line = f.readline()
+            while line and not is_record_start(line, indent):
+                offset = f.tell()
+                line = f.readline()
+            if not line:
+                break
+            if offset > starts[-1]:
+                starts.append(offset)
+    ends = starts[1:] + [size]
+    return list(zip(starts, ends))
+
+def project(obj, fields: list) -> dict:
+    return {key: obj[key] for key in fields if key in obj}
+
+def project_card(card, columns: list) -> dict:
+    """Copy only the used fields out of a parsed card, including the nested faces, parts and images
+
+    Parameters:
+    card (dict | simdjson.Object): Parsed scryfall card
+    columns (list): Root fields to keep
+    """
+    row = project(card, columns)
+    if row.get("image_uris") is not None:
+        row["image_uris"] = project(row["image_uris"], mt.IMAGE_FIELDS)
+    if row.get("card_faces") is not None:
+        faces = []
+        for face in row["card_faces"]:
+            face_row = project(face, mt.FACE_FIELDS)
+            if face_row.get("image_uris") is not None:
+                face_row["image_uris"] = project(face_row["image_uris"], mt.IMAGE_FIELDS)
+            faces.append(face_row)
+        row["card_faces"] = faces
+    if row.get("all_parts") is not None:
+        row["all_parts"] = [project(part, mt.PART_FIELDS) for part in row["all_parts"]]
+    return row
+
+def parse_records(text: bytes) -> pd.DataFrame:
+    """Parse a JSON array of cards into a frame holding only the columns the loader uses
+
+    Parameters:
+    text (bytes): JSON array of scryfall cards
+    """
+    columns = mt.CARD_COLUMNS + [column for column in mt.SET_COLUMNS if column not in mt.CARD_COLUMNS]
+    if simdjson is not None:
+        records = simdjson.Parser().parse(text)
+    else:
+        records = json.loads(text)
+    return pd.DataFrame([project_card(card, columns) for card in records])
+
+def read_cards(file_name: str, chunk_mb: int = 256) -> pd.DataFrame:
+    """Parse a bulk file in record aligned chunks, so the parser only holds one chunk at a time
+
+    Parameters:
+    file_name (str): Bulk file location, plain or gzip/zstd compressed, JSON array or NDJSON
+    chunk_mb (int): Largest size of a chunk in MB
+    """
+    if get_compression(file_name) is not None:
+        frames = [parse_records(chunk) for chunk in iter_record_chunks(file_name, chunk_mb)]
+    else:
+        chunks = max(1, -(-path.getsize(file_name) // (chunk_mb * 1048576)))
+        frames = [read_shard(file_name, start, end) for start, end in find_shard_offsets(file_name, chunks)]
+    return pd.concat(frames, ignore_index=True)
+
+def read_shard(file_name: str, start: int, end: int) -> pd.DataFrame:
+    """Parse the records in a byte range returned by find_shard_offsets
+
+    Parameters:
+    file_name (str): Bulk file location
+    start (int): First byte of the range
+    end (int): Byte after the end of the range
+    """
+    ndjson = is_ndjson(file_name)
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).strip()
+    if text == b"" or text == b"]":
+        return pd.DataFrame()
+    # the first shard holds the opening bracket of the array and the last shard the closing one
+    lines = text.splitlines() if ndjson else [text]
+    return parse_records(records_to_array(lines, ndjson))
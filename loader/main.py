@@ -6,17 +6,32 @@ import datetime as dt
 import requests
 import json
 import mtg_transform as mt
-from sys import exit
-from os import mkdir, path, getenv, remove
+import bulk_file as bf
+import snapshot as snap
+from profiler import Profiler
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from sys import exit, argv
+from os import mkdir, path, getenv, remove, cpu_count
 from dotenv import load_dotenv
 from time import sleep
 
 #region Constants
 BULK_NAME: str = None
+BULK_TYPE: str = None
+BULK_COMPRESSION: str = None
 CONN_STR: str = None
 DB_NAME: str = None
 LOAD_STRAT: str = None
 LOG_LEVEL: int = None
+PROFILE: bool = False
+ORACLE_DEDUP: bool = False
+SHARD_WORKERS: int = 0
+SHARD_SIZE_MB: int = 256
+DAEMON: bool = False
+DAEMON_INTERVAL: int = 3600
+TRANSFORM_ENGINE: str = "pandas"
+SNAPSHOT_NAME: str = None
 engine: sa.Engine = None
 log: lo.Logger = None
 #endregion
@@ -31,6 +46,35 @@ def exit_as_failed(reason: str = None):
 def get_from_db(sql: str):
     return pd.read_sql(sql, engine)
 
+# In daemon mode dimension lookups and the card key index stay in memory between syncs
+LOOKUP_CACHE: dict[str, dict[str, pd.DataFrame]] = {}
+CARD_KEYS: pd.DataFrame = None
+
+def get_lookup(table: str, sql: str) -> pd.DataFrame:
+    if not DAEMON:
+        return get_from_db(sql)
+    table_cache = LOOKUP_CACHE.setdefault(table, {})
+    if sql not in table_cache:
+        table_cache[sql] = get_from_db(sql)
+    return table_cache[sql].copy()
+
+def invalidate_lookup(table: str):
+    LOOKUP_CACHE.pop(table, None)
+
+def get_card_keys() -> pd.DataFrame:
+    '''[ID] and [source_id] of every card, in daemon mode only cards added since the last call are read'''
+    global CARD_KEYS
+    if not DAEMON:
+        return get_from_db("SELECT [ID], [source_id] FROM [MTG].[Card]")
+    if CARD_KEYS is None:
+        CARD_KEYS = get_from_db("SELECT [ID], [source_id] FROM [MTG].[Card]")
+    else:
+        max_id = int(CARD_KEYS["ID"].max()) if CARD_KEYS.shape[0] > 0 else 0
+        added = get_from_db("SELECT [ID], [source_id] FROM [MTG].[Card] WHERE [ID] > "+str(max_id))
+        if added.shape[0] > 0:
+            CARD_KEYS = pd.concat([CARD_KEYS, added], ignore_index=True)
+    return CARD_KEYS
+
 def request_set_cards(_uri, data):
     # api asks for a 50ms to 100ms wait between requests
     sleep(0.15)
@@ -45,6 +89,14 @@ def request_set_cards(_uri, data):
         data = request_set_cards(req_data["next_page"], data)
     return data
 
+def get_transform_engine():
+    '''The module holding the transforms, mtg_transform or its polars version'''
+    if TRANSFORM_ENGINE == "polars":
+        # polars is optional, only import it when it is asked for
+        import mtg_transform_polars
+        return mtg_transform_polars
+    return mt
+
 def create_connection(db_name: str, db_location: str, db_driver: str, db_protected: bool, db_username: str, db_password: str) -> sa.Engine:
     if db_protected:
         connection_url = sa.URL.create(
@@ -110,47 +162,58 @@ def create_connection(db_name: str, db_location: str, db_driver: str, db_protect
     return engine
 #endregion
 
+def get_bulk_catalog_entry() -> dict:
+    bulk_catalog = "https://api.scryfall.com/bulk-data"
+    req: requests.Response = requests.get(bulk_catalog)
+    if req.status_code != 200:
+        log.critical("bulk data request failed : %s %s", req.status_code, req.reason)
+        exit_as_failed()
+    catalog = req.json()
+    entry = next((obj for obj in catalog.get("data", []) if obj["type"] == BULK_TYPE), None)
+    if entry is None:
+        log.critical("bulk data reading failed, data to get bulk file not found : %s", BULK_TYPE)
+        exit_as_failed()
+    return entry
+
+def download_bulk():
+    log.info("downloading bulk data")
+    bulk_uri = get_bulk_catalog_entry()["download_uri"]
+
+    if path.exists(BULK_NAME):
+        log.warning("deleting existing bulk file : "+BULK_NAME)
+        remove(BULK_NAME)
+
+    # all_cards is several GB, so stream it to disk instead of holding it in memory
+    with requests.get(bulk_uri, stream=True) as bulk_req:
+        bulk_req.raise_for_status()
+        if BULK_COMPRESSION is None:
+            with open(BULK_NAME, 'xb') as f:
+                for chunk in bulk_req.iter_content(chunk_size=1048576):
+                    f.write(chunk)
+        else:
+            bf.write_ndjson(bulk_req.iter_lines(chunk_size=1048576), BULK_NAME, BULK_COMPRESSION)
+    log.info("finished downloading bulk data")
+
 def extract() -> pd.DataFrame:
     card_frame: pd.DataFrame = None
     sets_frame: pd.DataFrame = None
     update_sets_data: pd.DataFrame = pd.DataFrame()
 
     if LOAD_STRAT == "DOWNLOAD":
-        log.info("downloading bulk data")
-        bulk_catalog = "https://api.scryfall.com/bulk-data"
-        req: requests.Response = requests.get(bulk_catalog)
-        if req.status_code != 200:
-            log.critical("bulk data request failed : %s %s", req.status_code, req.reason)
-            exit_as_failed()
-        catalog = req.json()
-        if "data" not in catalog and "default_cards" not in catalog["data"]:
-            log.critical("bulk data reading failed, data to get bulk file noth found")
-            exit_as_failed()
-
-        bulk_uri = next(obj["download_uri"] for obj in catalog["data"] if obj["type"] == "default_cards")
-        bulk_data = requests.get(bulk_uri).json()
-
-        if path.exists(BULK_NAME):
-            log.warning("deleting existing bulk file : "+BULK_NAME)
-            remove(BULK_NAME)
-
-        with open(BULK_NAME, 'x', encoding='utf-8') as f:
-            json.dump(bulk_data, f, ensure_ascii=False, indent=4)
-
-        # TODO: Can probably just load straight from the variable
-        card_frame = pd.read_json(BULK_NAME, orient='records')
-        sets_frame = card_frame.loc[:, ["set_name", "set", "set_search_uri", "set_type", "set_id"]].drop_duplicates()
+        download_bulk()
+        card_frame = bf.read_cards(BULK_NAME, SHARD_SIZE_MB)
+        sets_frame = card_frame.loc[:, mt.SET_COLUMNS].drop_duplicates()
         log.info("finished loading from download")
     elif LOAD_STRAT == "LOCAL":
         log.info("loading from bulk data file")
         if not path.exists(BULK_NAME):
             log.critical("bulk file does not exist")
             exit_as_failed()
-        card_frame = pd.read_json(BULK_NAME, orient='records')
-        sets_frame = card_frame.loc[:, ["set_name", "set", "set_search_uri", "set_type", "set_id"]].drop_duplicates()
+        card_frame = bf.read_cards(BULK_NAME, SHARD_SIZE_MB)
+        sets_frame = card_frame.loc[:, mt.SET_COLUMNS].drop_duplicates()
         log.info("finished loading from bulk data file")
     elif LOAD_STRAT == "API":
-        db_sets = get_from_db("SELECT [shorthand], [icon], [source_id], [release_date] FROM [MTG].[Set]")        
+        db_sets = get_lookup("Set", "SELECT [shorthand], [icon], [source_id], [release_date] FROM [MTG].[Set]")
         # load from api
         SETS_API_URI = "https://api.scryfall.com/sets"
         log.info("requesting sets data from %s", SETS_API_URI)
@@ -216,14 +279,136 @@ def transform(cards_raw: pd.DataFrame, sets_frame: pd.DataFrame):
     sets: pd.DataFrame = sets_frame.copy()
     sets = sets.rename(columns={"id":"set_id"})
     if cards_raw.shape[0] > 0:
-        rarities = mt.get_rarities(cards_raw)
-        layouts = mt.get_layouts(cards_raw)
-        types, type_lines = mt.get_type_line_data(cards_raw)
-        faces = mt.get_card_faces(cards_raw)
-        parts = mt.get_card_parts(cards_raw)
-        cards = mt.get_cards(cards_raw)
+        te = get_transform_engine()
+        rarities = te.get_rarities(cards_raw)
+        layouts = te.get_layouts(cards_raw)
+        # faces and type lines are the same for every printing of a card, so only transform one printing of each
+        oracle_cards = te.get_oracle_printings(cards_raw) if ORACLE_DEDUP else cards_raw
+        types, type_lines = te.get_type_line_data(oracle_cards)
+        faces = te.get_card_faces(oracle_cards)
+        parts = te.get_card_parts(cards_raw)
+        cards = te.get_cards(cards_raw)
+
+    return cards, faces, parts, type_lines, types, rarities, layouts, sets
+
+def run_load(stage):
+    '''Extract, transform and load once, stage wraps each step for profiling'''
+    if SHARD_WORKERS > 0 and LOAD_STRAT != "API":
+        if LOAD_STRAT == "DOWNLOAD":
+            with stage("extract"):
+                download_bulk()
+        # parsing and preparing happen inside the shard workers
+        with stage("transform"):
+            cards, faces, parts, type_lines, types, rarities, layouts, sets = extract_sharded()
+        sets_info = pd.DataFrame()
+    else:
+        with stage("extract"):
+            extract_cards, raw_sets, sets_info = extract()
+        with stage("prepare_cards"):
+            raw_cards = get_transform_engine().prepare_cards(extract_cards)
+        with stage("transform"):
+            cards, faces, parts, type_lines, types, rarities, layouts, sets = transform(raw_cards, raw_sets)
+    with stage("save_to_db"):
+        save_to_db(cards, sets, faces, parts, type_lines, types, rarities, layouts, sets_info)
+    if SNAPSHOT_NAME is not None:
+        with stage("snapshot"):
+            export_snapshot()
 
+def get_source_version():
+    '''Something that changes when the source data does, None when it always needs checking'''
+    if LOAD_STRAT == "DOWNLOAD":
+        return get_bulk_catalog_entry()["updated_at"]
+    if LOAD_STRAT == "LOCAL":
+        return path.getmtime(BULK_NAME) if path.exists(BULK_NAME) else None
+    # API compares the sets endpoint against the db, which is already incremental
+    return None
+
+def run_daemon(stage, cycle):
+    '''Stay resident and sync every DAEMON_INTERVAL seconds, keeping the db connection and lookups warm
+
+    cycle wraps each sync, so each one is profiled on its own'''
+    log.info("daemon started, syncing every %s seconds", DAEMON_INTERVAL)
+    last_version = None
+    while True:
+        try:
+            version = get_source_version()
+            if version is not None and version == last_version:
+                log.info("source data unchanged since last sync")
+            else:
+                log.info("sync started")
+                with cycle():
+                    run_load(stage)
+                last_version = version
+                log.info("sync finished")
+        # exit_as_failed raises SystemExit, which should only fail this sync
+        except (Exception, SystemExit) as ex:
+            log.exception("sync failed, retrying in %s seconds : %s", DAEMON_INTERVAL, ex)
+            # a partial load can leave cached lookups behind the db
+            LOOKUP_CACHE.clear()
+        sleep(DAEMON_INTERVAL)
+
+#region Sharding
+def init_shard_worker(oracle_dedup: bool, transform_engine: str):
+    # spawned workers re-import this module, so the settings from __main__ need passing in
+    global ORACLE_DEDUP, TRANSFORM_ENGINE
+    ORACLE_DEDUP = oracle_dedup
+    TRANSFORM_ENGINE = transform_engine
+    lo.getLogger("__main__").disabled = True
+
+def transform_shard(file_name: str, start: int, end: int):
+    return transform_cards(bf.read_shard(file_name, start, end))
+
+def transform_chunk(chunk: bytes):
+    return transform_cards(bf.parse_records(chunk))
+
+def transform_cards(shard_cards: pd.DataFrame):
+    if shard_cards.empty:
+        return None
+    shard_sets = shard_cards.loc[:, mt.SET_COLUMNS].drop_duplicates()
+    return transform(get_transform_engine().prepare_cards(shard_cards), shard_sets)
+
+def extract_sharded():
+    '''Parse, prepare and transform the bulk file in record aligned shards across worker processes'''
+    if not path.exists(BULK_NAME):
+        log.critical("bulk file does not exist")
+        exit_as_failed()
+
+    with ProcessPoolExecutor(max_workers=SHARD_WORKERS, initializer=init_shard_worker, initargs=(ORACLE_DEDUP, TRANSFORM_ENGINE)) as pool:
+        if bf.get_compression(BULK_NAME) is None:
+            shard_size = SHARD_SIZE_MB * 1048576
+            shards = max(SHARD_WORKERS, -(-path.getsize(BULK_NAME) // shard_size))
+            offsets = bf.find_shard_offsets(BULK_NAME, shards)
+            log.info("transforming bulk data file in %s shards across %s workers", len(offsets), SHARD_WORKERS)
+            futures = [pool.submit(transform_shard, BULK_NAME, start, end) for start, end in offsets]
+        else:
+            # compressed files can not be seeked into, so decompress here and hand the workers chunks of records
+            log.info("transforming compressed bulk data file across %s workers", SHARD_WORKERS)
+            futures = []
+            for chunk in bf.iter_record_chunks(BULK_NAME, SHARD_SIZE_MB):
+                # only keep a couple of chunks per worker in flight, so memory does not grow with the file
+                pending = [future for future in futures if not future.done()]
+                if len(pending) >= SHARD_WORKERS * 2:
+                    wait(pending, return_when=FIRST_COMPLETED)
+                futures.append(pool.submit(transform_chunk, chunk))
+        results = [future.result() for future in futures]
+    results = [result for result in results if result is not None]
+    if len(results) == 0:
+        exit_as_failed("bulk data file has no cards")
+
+    cards, faces, parts, type_lines, types, rarities, layouts, sets = [pd.concat(frames) for frames in zip(*results)]
+    types = types.drop_duplicates()
+    rarities = rarities.drop_duplicates()
+    layouts = layouts.drop_duplicates()
+    sets = sets.drop_duplicates()
+    if ORACLE_DEDUP:
+        # each shard only deduplicated against itself
+        oracle_ids = mt.get_oracle_printings(cards)["id"]
+        faces = faces.loc[faces["id"].isin(oracle_ids)]
+        type_lines = type_lines.loc[type_lines["id"].isin(oracle_ids)]
+
+    log.info("finished transforming %s shards", len(results))
     return cards, faces, parts, type_lines, types, rarities, layouts, sets
+#endregion
 
 # TODO: Make bulk inserts faster
 #       Potentionally use https://bcp.readthedocs.io/en/latest/
@@ -271,12 +456,13 @@ def save_to_db(cards: pd.DataFrame, sets: pd.DataFrame, faces: pd.DataFrame, par
                             """
             conn.execute(sa.text(update_sql))
             conn.commit()
+        invalidate_lookup("Set")
     #endregion
 
     #region Set Type
     log.info("checking for new set types")  
     tf_settypes = sets["set_type"].copy().to_frame(name="name").drop_duplicates()
-    db_settypes = get_from_db("SELECT [name] FROM [MTG].[SetType]")
+    db_settypes = get_lookup("SetType", "SELECT [name] FROM [MTG].[SetType]")
     new_settypes = tf_settypes.loc[~tf_settypes["name"].isin(db_settypes["name"]), :]
     if new_settypes.shape[0] > 0:
         was_updated = True
@@ -287,6 +473,7 @@ def save_to_db(cards: pd.DataFrame, sets: pd.DataFrame, faces: pd.DataFrame, par
             index=False,
             if_exists="append"
         )
+        invalidate_lookup("SetType")
         log.info("new set types added")
     else:
         log.info("no new set types found")
@@ -295,7 +482,7 @@ def save_to_db(cards: pd.DataFrame, sets: pd.DataFrame, faces: pd.DataFrame, par
     #region Sets
     log.info("checking for new sets")
     sets_source_ids = sets.copy()
-    db_sets = get_from_db("select [source_id] from mtg.[Set]")
+    db_sets = get_lookup("Set", "SELECT [source_id] FROM [MTG].[Set]")
     new_sets: pd.DataFrame = sets_source_ids.loc[~sets_source_ids["set_id"].isin(db_sets["source_id"])]
     if new_sets.shape[0] > 0:
         was_updated = True
@@ -309,7 +496,7 @@ def save_to_db(cards: pd.DataFrame, sets: pd.DataFrame, faces: pd.DataFrame, par
             "icon_svg_uri":"icon",
             "released_at":"release_date"
         })
-        settype_lookup = get_from_db("select [id], [name] from [MTG].[SetType]").set_index("name")
+        settype_lookup = get_lookup("SetType", "SELECT [id], [name] FROM [MTG].[SetType]").set_index("name")
         settype_lookup["id"] = settype_lookup["id"].astype("str")
         settype_lookup = settype_lookup.to_dict()["id"]
         new_sets["set_type_id"] = new_sets["set_type_id"].map(settype_lookup)
@@ -323,6 +510,7 @@ def save_to_db(cards: pd.DataFrame, sets: pd.DataFrame, faces: pd.DataFrame, par
             index=False,
             if_exists="append"
         )
+        invalidate_lookup("Set")
         log.info("new sets added")
     else:
         log.info("no new sets found")
@@ -332,7 +520,7 @@ def save_to_db(cards: pd.DataFrame, sets: pd.DataFrame, faces: pd.DataFrame, par
     log.info("checking for new rarities")
     if rarities.empty == False:
         was_updated = True
-        db_rarities = get_from_db("select [name] from [MTG].[Rarity]")
+        db_rarities = get_lookup("Rarity", "SELECT [name] FROM [MTG].[Rarity]")
         new_rarities = rarities.copy().loc[~rarities.isin(db_rarities["name"])]
         if new_rarities.shape[0] > 0:
             new_rarities.name = "name"
@@ -343,6 +531,7 @@ def save_to_db(cards: pd.DataFrame, sets: pd.DataFrame, faces: pd.DataFrame, par
                 index=False,
                 if_exists="append"
             )
+            invalidate_lookup("Rarity")
             log.info("new rarities added")
         else:
             log.info("no new rarities found")
@@ -355,7 +544,7 @@ def save_to_db(cards: pd.DataFrame, sets: pd.DataFrame, faces: pd.DataFrame, par
 
     if layouts.empty == False:
         was_updated = True
-        db_layouts = get_from_db("select [name] from [MTG].[Layout]")
+        db_layouts = get_lookup("Layout", "SELECT [name] FROM [MTG].[Layout]")
         new_layouts = layouts.copy().loc[~layouts.isin(db_layouts["name"])]        
         if new_layouts.shape[0] > 0:
             new_layouts.name = "name"
@@ -366,6 +555,7 @@ def save_to_db(cards: pd.DataFrame, sets: pd.DataFrame, faces: pd.DataFrame, par
                 index=False,
                 if_exists="append"
             )
+            invalidate_lookup("Layout")
             log.info("new layouts added")
         else:
             log.info("no new layouts found")
@@ -377,7 +567,7 @@ def save_to_db(cards: pd.DataFrame, sets: pd.DataFrame, faces: pd.DataFrame, par
     log.info("checking for new card types")
     if types.empty == False:
         was_updated = True
-        db_card_types = get_from_db("SELECT [name] FROM [MTG].[CardType]")
+        db_card_types = get_lookup("CardType", "SELECT [name] FROM [MTG].[CardType]")
         new_card_types: pd.DataFrame = types.loc[~types["type_line"].isin(db_card_types["name"])].copy()
         if new_card_types.shape[0] > 0:
             new_card_types = new_card_types.rename(columns={"type_line":"name"})
@@ -389,6 +579,7 @@ def save_to_db(cards: pd.DataFrame, sets: pd.DataFrame, faces: pd.DataFrame, par
                 index=False,
                 if_exists="append"
             )
+            invalidate_lookup("CardType")
             log.info("new card types added")
         else:
             log.info("no new card types to add")
@@ -399,13 +590,13 @@ def save_to_db(cards: pd.DataFrame, sets: pd.DataFrame, faces: pd.DataFrame, par
     #region Card
     log.info("checking for new cards")
     if cards.empty == False:
-        db_card_ids = get_from_db("SELECT [source_id], [id] FROM [MTG].[Card]")
+        db_card_ids = get_card_keys()
         new_cards: pd.DataFrame = cards.copy().loc[~cards["id"].isin(db_card_ids["source_id"])]
         if new_cards.shape[0] > 0:
             was_updated = True
-            rarity_lookup = get_from_db("select [id], [name] from [MTG].[Rarity]").set_index("name")
-            layout_lookup = get_from_db("select [id], [name] from [MTG].[Layout]").set_index("name")
-            set_lookup = get_from_db("SELECT [id], [shorthand] FROM [MTG].[Set]").set_index("shorthand")
+            rarity_lookup = get_lookup("Rarity", "SELECT [id], [name] FROM [MTG].[Rarity]").set_index("name")
+            layout_lookup = get_lookup("Layout", "SELECT [id], [name] FROM [MTG].[Layout]").set_index("name")
+            set_lookup = get_lookup("Set", "SELECT [id], [shorthand] FROM [MTG].[Set]").set_index("shorthand")
             
             rarity_lookup["id"] = rarity_lookup["id"].astype("str")
             layout_lookup["id"] = layout_lookup["id"].astype("str")
@@ -462,17 +653,27 @@ def save_to_db(cards: pd.DataFrame, sets: pd.DataFrame, faces: pd.DataFrame, par
     #region Card Face
     log.info("checking for new card faces")
     if faces.empty == False:
-        db_card_faces = get_from_db("""
-                                    SELECT DISTINCT c.source_id
-                                    FROM [MTG].[CardFace] AS cf
-                                    JOIN [MTG].[Card] AS c ON c.id = cf.CardID                                
-                                    """)
+        if ORACLE_DEDUP:
+            # faces are stored once per oracle id, printings find theirs through Card.oracle_id = CardFace.OracleID
+            # cards without an oracle id have no other printing to share with and keep their own
+            db_card_faces = get_from_db("""
+                                        SELECT DISTINCT c.source_id, c.oracle_id
+                                        FROM [MTG].[CardFace] AS cf
+                                        JOIN [MTG].[Card] AS c ON c.id = cf.CardID
+                                        """)
+            new_card_faces: pd.DataFrame = mt.get_new_oracle_rows(faces, cards, db_card_faces).copy()
+        else:
+            db_card_faces = get_from_db("""
+                                        SELECT DISTINCT c.source_id
+                                        FROM [MTG].[CardFace] AS cf
+                                        JOIN [MTG].[Card] AS c ON c.id = cf.CardID                                
+                                        """)
 
-        new_card_faces: pd.DataFrame = faces.copy().loc[~faces["id"].isin(db_card_faces["source_id"])]
+            new_card_faces: pd.DataFrame = faces.copy().loc[~faces["id"].isin(db_card_faces["source_id"])]
         if new_card_faces.shape[0] > 0:
             was_updated = True
             # map the datbase card id to the object 
-            db_card_dict = get_from_db("SELECT [ID], [source_id] FROM [MTG].[Card]").set_index("source_id").to_dict()["ID"]
+            db_card_dict = get_card_keys().set_index("source_id").to_dict()["ID"]
             new_card_faces["id"] = new_card_faces["id"].map(db_card_dict)
             new_card_faces["id"] = new_card_faces["id"].astype("int")
             new_card_faces = new_card_faces.drop(["index"], axis=1)
@@ -511,7 +712,7 @@ def save_to_db(cards: pd.DataFrame, sets: pd.DataFrame, faces: pd.DataFrame, par
         new_card_parts = pd.concat([parts.copy(), db_card_parts]).drop_duplicates(keep=False)
 
         if "db_card_dict" not in locals():
-            db_card_dict: pd.DataFrame = get_from_db("SELECT [ID], [source_id] FROM [MTG].[Card]").set_index("source_id").to_dict()["ID"]
+            db_card_dict: pd.DataFrame = get_card_keys().set_index("source_id").to_dict()["ID"]
 
         new_card_parts["card_id"] = new_card_parts["card_id"].map(db_card_dict)
 
@@ -544,10 +745,18 @@ def save_to_db(cards: pd.DataFrame, sets: pd.DataFrame, faces: pd.DataFrame, par
     log.info("checking for new card type lines")
     if type_lines.empty == False:
         if "db_card_dict" not in locals():
-            db_card_dict: pd.DataFrame = get_from_db("SELECT [ID], [source_id] FROM [MTG].[Card]").set_index("source_id").to_dict()["ID"]
+            db_card_dict: pd.DataFrame = get_card_keys().set_index("source_id").to_dict()["ID"]
 
-        db_card_types: pd.DataFrame = get_from_db("SELECT [id], [name] FROM [MTG].[CardType]").set_index("name").to_dict()["id"]
+        db_card_types: pd.DataFrame = get_lookup("CardType", "SELECT [id], [name] FROM [MTG].[CardType]").set_index("name").to_dict()["id"]
         db_type_lines: pd.DataFrame = get_from_db("SELECT [card_id], [type_id], [order] FROM [MTG].[TypeLine]")
+        if ORACLE_DEDUP:
+            # type lines are stored once per oracle id, against whichever printing was loaded first
+            db_type_oracles = get_from_db("""
+                                          SELECT DISTINCT c.source_id, c.oracle_id
+                                          FROM [MTG].[TypeLine] AS tl
+                                          JOIN [MTG].[Card] AS c ON c.id = tl.card_id
+                                          """)
+            type_lines = mt.get_new_oracle_rows(type_lines, cards, db_type_oracles)
         if type_lines.shape[0] > 0:
             was_updated = True
             card_to_type: pd.DataFrame = type_lines.copy()
@@ -578,16 +787,67 @@ def save_to_db(cards: pd.DataFrame, sets: pd.DataFrame, faces: pd.DataFrame, par
 
     log.info("finished loading data")
 
+def export_snapshot():
+    '''Write the denormalised read snapshot to SNAPSHOT_NAME, when the db has changed since the last one was written'''
+    last_updated = get_from_db("SELECT [LastUpdated] FROM [TCGCT].[Games] WHERE [Name] = 'MTG'")["LastUpdated"]
+    version = str(last_updated.iloc[0]) if last_updated.shape[0] > 0 else "None"
+    if version == snap.read_version(SNAPSHOT_NAME):
+        log.info("snapshot is already at version %s", version)
+        return
+
+    log.info("exporting snapshot")
+    cards = get_from_db("""
+                        SELECT c.[id], c.[source_id], c.[name], c.[mana_cost], c.[text], c.[flavor], c.[artist], c.[collector_number],
+                            c.[power], c.[toughness], c.[loyalty], c.[converted_cost], c.[image], c.[oracle_id],
+                            s.[shorthand] AS [set_code], s.[name] AS [set_name], st.[name] AS [set_type], CONVERT(NVARCHAR(10), s.[release_date], 23) AS [release_date],
+                            r.[name] AS [rarity], l.[name] AS [layout]
+                        FROM [MTG].[Card] AS c
+                        JOIN [MTG].[Set] AS s ON s.[id] = c.[card_set_id]
+                        JOIN [MTG].[SetType] AS st ON st.[id] = s.[set_type_id]
+                        JOIN [MTG].[Rarity] AS r ON r.[id] = c.[rarity_id]
+                        JOIN [MTG].[Layout] AS l ON l.[id] = c.[layout_id]
+                        """)
+    faces = get_from_db("""
+                        SELECT [CardID] AS [card_id], [Object] AS [object], [Name] AS [name], [Image] AS [image], [Mana_Cost] AS [mana_cost],
+                            [Oracle_Text] AS [oracle_text], [ConvertedCost] AS [converted_cost], [FlavourText] AS [flavour_text],
+                            [Loyalty] AS [loyalty], [Power] AS [power], [Toughness] AS [toughness]
+                        FROM [MTG].[CardFace]
+                        ORDER BY [CardID], [ID]
+                        """)
+    type_lines = get_from_db("""
+                             SELECT tl.[card_id], ct.[name] AS [type_name]
+                             FROM [MTG].[TypeLine] AS tl
+                             JOIN [MTG].[CardType] AS ct ON ct.[id] = tl.[type_id]
+                             ORDER BY tl.[card_id], tl.[order]
+                             """)
+    parts = get_from_db("""
+                        SELECT [CardID] AS [card_id], [Object] AS [object], [Component] AS [component], [RelatedOracleID] AS [related_card]
+                        FROM [MTG].[CardPart]
+                        ORDER BY [CardID], [ID]
+                        """)
+    snap.write_snapshot(SNAPSHOT_NAME, snap.build_cards(cards, faces, type_lines, parts), version)
+
 if __name__ == "__main__":
     load_dotenv()
     try:
         BULK_NAME = getenv("TCGCT_BULK_NAME")
+        BULK_TYPE = getenv("TCGCT_BULK_TYPE", "default_cards")
+        BULK_COMPRESSION = getenv("TCGCT_BULK_COMPRESSION")
         LOG_LEVEL = int(getenv('TCGCT_LOG_LEVEL'))
         LOAD_STRAT = str(getenv("TCGCT_LOAD_STRAT"))
         DB_NAME = getenv("TCGCT_DB_NAME")
         DB_LOCATION = getenv("TCGCT_DB_LOCATION")
         DB_DRIVER = getenv("TCGCT_DB_DRIVER")
         DB_PROTECTED = getenv("TCGCT_DB_PROTECTED") == "True"
+        PROFILE = getenv("TCGCT_PROFILE") == "True" or "--profile" in argv
+        ORACLE_DEDUP = getenv("TCGCT_ORACLE_DEDUP") == "True"
+        SHARD_WORKERS = getenv("TCGCT_SHARD_WORKERS", "0")
+        SHARD_WORKERS = cpu_count() if SHARD_WORKERS == "auto" else int(SHARD_WORKERS)
+        SHARD_SIZE_MB = int(getenv("TCGCT_SHARD_SIZE_MB", "256"))
+        DAEMON = getenv("TCGCT_DAEMON") == "True" or "--daemon" in argv
+        DAEMON_INTERVAL = int(getenv("TCGCT_DAEMON_INTERVAL", "3600"))
+        TRANSFORM_ENGINE = getenv("TCGCT_TRANSFORM_ENGINE", "pandas")
+        SNAPSHOT_NAME = getenv("TCGCT_SNAPSHOT_NAME")
         if DB_PROTECTED == True:
             DB_USERNAME = getenv("TCGCT_DB_USERNAME")
             DB_PASSWORD = getenv("TCGCT_DB_PASSWORD")
@@ -642,16 +902,33 @@ if __name__ == "__main__":
     if LOAD_STRAT is None or LOAD_STRAT not in ["LOCAL", "DOWNLOAD", "API"]:
         exit_as_failed("No LOAD_STRAT defined")
 
+    if BULK_COMPRESSION not in [None, "gzip", "zstd"]:
+        exit_as_failed("TCGCT_BULK_COMPRESSION must be gzip or zstd")
+
+    if TRANSFORM_ENGINE not in ["pandas", "polars"]:
+        exit_as_failed("TCGCT_TRANSFORM_ENGINE must be pandas or polars")
+
     for foreignLogger in lo.Logger.manager.loggerDict:
         if foreignLogger not in [__name__]:
             lo.getLogger(foreignLogger).disabled = True
 
     engine = create_connection(DB_NAME, DB_LOCATION, DB_DRIVER, DB_PROTECTED, DB_USERNAME, DB_PASSWORD)
 
+    profiler: Profiler = None
+    if PROFILE:
+        profiler = Profiler('logs/')
+        profiler.start()
+    stage = profiler.stage if PROFILE else lambda name: nullcontext()
+    cycle = profiler.cycle if PROFILE else nullcontext
+
     try:
-        extract_cards, raw_sets, sets_info = extract()
-        raw_cards = mt.prepare_cards(extract_cards)
-        cards, faces, parts, type_lines, types, rarities, layouts, sets = transform(raw_cards, raw_sets)
-        save_to_db(cards, sets, faces, parts, type_lines, types, rarities, layouts, sets_info)
+        if DAEMON:
+            run_daemon(stage, cycle)
+        else:
+            with cycle():
+                run_load(stage)
     except Exception as ex:
         exit_as_failed("unhandled error occurred : " + str(ex))
+    finally:
+        if PROFILE:
+            profiler.stop()
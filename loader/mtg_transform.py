@@ -3,16 +3,47 @@ import numpy as np
 import logging
 log = logging.getLogger("__main__")
 
+# Fields of the scryfall card objects that the transforms use, anything else is dropped
+CARD_COLUMNS = ["name", "mana_cost", "oracle_text", "flavor_text", "artist", "collector_number",
+                "power", "toughness", "set", "id", "cmc", "oracle_id", "rarity", "layout", "card_faces", "image_uris", "loyalty", "type_line", "all_parts"]
+FACE_FIELDS = ["object", "name", "image_uris", "mana_cost", "oracle_text", "cmc", "flavor_text", "loyalty", "oracle_id", "power", "toughness", "type_line"]
+PART_FIELDS = ["object", "component", "id"]
+IMAGE_FIELDS = ["normal"]
+SET_COLUMNS = ["set_name", "set", "set_search_uri", "set_type", "set_id"]
+
 def prepare_cards(_cards: pd.DataFrame) -> pd.DataFrame:
     """Add all potentially missing columns to provided cards dataframe
     
     Parameters:
     _cards (pd.DataFrame): Cards frame
     """
-    column_check = ["name", "mana_cost", "oracle_text", "flavor_text", "artist", "collector_number",
-                              "power", "toughness", "set", "id", "cmc", "oracle_id", "rarity", "layout", "card_faces", "image_uris", "loyalty", "type_line", "all_parts"]
-    ret_cards = _cards.reindex(_cards.columns.union(column_check, sort=False), axis=1, fill_value=pd.NA)
-    return ret_cards.loc[:, column_check]
+    ret_cards = _cards.reindex(_cards.columns.union(CARD_COLUMNS, sort=False), axis=1, fill_value=pd.NA)
+    return ret_cards.loc[:, CARD_COLUMNS]
+
+def get_oracle_printings(cards: pd.DataFrame) -> pd.DataFrame:
+    """Keep the first printing of each oracle_id, so oracle level data is only transformed once
+    Cards without a root oracle_id (reversible cards) are all kept
+
+    Parameters:
+    cards (pd.DataFrame): Prepared cards frame
+    """
+    return cards.loc[cards["oracle_id"].isna() | ~cards["oracle_id"].duplicated()]
+
+def get_new_oracle_rows(rows: pd.DataFrame, cards: pd.DataFrame, stored: pd.DataFrame) -> pd.DataFrame:
+    """Oracle level rows (faces or type lines) that still need storing, those of the first printing of each oracle_id not stored yet
+    Cards without a root oracle_id fall back to their own printing, their rows are kept unless that printing already has some stored
+
+    Parameters:
+    rows (pd.DataFrame): Rows with the id of their card
+    cards (pd.DataFrame): Cards with id and oracle_id, sharded loads can have the same card more than once
+    stored (pd.DataFrame): source_id and oracle_id of the cards that already have rows stored
+    """
+    cards = cards.drop_duplicates("id")
+    oracle_ids = rows["id"].map(cards.set_index("id")["oracle_id"])
+    first_printing = rows["id"].isin(get_oracle_printings(cards)["id"])
+    new_oracle = oracle_ids.notna() & first_printing & ~oracle_ids.isin(stored["oracle_id"].dropna())
+    new_printing = oracle_ids.isna() & ~rows["id"].isin(stored["source_id"])
+    return rows.loc[new_oracle | new_printing]
 
 def get_card_faces(cards: pd.DataFrame) -> pd.DataFrame:
     log.info("preparing card faces")
@@ -110,7 +141,7 @@ def get_type_line_data(cards: pd.DataFrame):
         card_no_typeline = cards.loc[cards["type_line"].isna(), ["id","card_faces"]].copy()
         face_explode = card_no_typeline.explode("card_faces")
         nested_faces = pd.json_normalize(face_explode["card_faces"]).set_index(face_explode.index)
-        nested_faces = nested_faces.loc[:, ["type_line"]]
+        nested_faces = nested_faces.reindex(columns=["type_line"]).astype("object")
         type_line_with_id = nested_faces["type_line"].str.split(" ").explode()
         card_to_type_premap_nested = pd.merge(card_no_typeline["id"], type_line_with_id, left_index=True, right_index=True)
         card_types_lookup_nested = type_line_with_id.drop_duplicates().reset_index().drop(["index"],axis=1) 
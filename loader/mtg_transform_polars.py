@@ -0,0 +1,162 @@
+import pandas as pd
+import polars as pl
+import pyarrow as pa
+import logging
+import mtg_transform as mt
+log = logging.getLogger("__main__")
+
+# Polars version of mtg_transform, selected with TCGCT_TRANSFORM_ENGINE="polars"
+# prepare_cards returns a polars frame, every other function takes that frame and returns the same pandas objects as mtg_transform
+
+IMAGE_SCHEMA = pl.Struct({"normal": pl.Utf8})
+FACE_SCHEMA = pl.Struct({
+    "object": pl.Utf8, "name": pl.Utf8, "image_uris": IMAGE_SCHEMA, "mana_cost": pl.Utf8, "oracle_text": pl.Utf8, "cmc": pl.Float64,
+    "flavor_text": pl.Utf8, "loyalty": pl.Utf8, "oracle_id": pl.Utf8, "power": pl.Utf8, "toughness": pl.Utf8, "type_line": pl.Utf8
+})
+PART_SCHEMA = pl.Struct({"object": pl.Utf8, "component": pl.Utf8, "id": pl.Utf8})
+CARD_SCHEMA = {column: pl.Utf8 for column in mt.CARD_COLUMNS}
+CARD_SCHEMA.update({"cmc": pl.Float64, "card_faces": pl.List(FACE_SCHEMA), "image_uris": IMAGE_SCHEMA, "all_parts": pl.List(PART_SCHEMA)})
+NESTED_COLUMNS = ["card_faces", "image_uris", "all_parts"]
+
+def to_pandas(frame: pl.DataFrame) -> pd.DataFrame:
+    """Convert back to pandas, using the original row numbers as the index like the pandas transforms do"""
+    ret_frame = frame.to_pandas().set_index("index")
+    ret_frame.index.name = None
+    return ret_frame
+
+def prepare_cards(_cards: pd.DataFrame) -> pl.DataFrame:
+    """Convert a cards frame to polars, adding all potentially missing columns
+
+    Parameters:
+    _cards (pd.DataFrame): Cards frame
+    """
+    columns = {}
+    for column in mt.CARD_COLUMNS:
+        if column in _cards:
+            values = _cards[column].astype(object)
+            values = values.where(values.notna(), None).tolist()
+        else:
+            values = [None] * _cards.shape[0]
+        columns[column] = to_series(column, values)
+    return pl.DataFrame(columns).with_columns(pl.Series("index", _cards.index.to_numpy()))
+
+def to_series(column: str, values: list) -> pl.Series:
+    dtype = CARD_SCHEMA[column]
+    if column in NESTED_COLUMNS:
+        # arrow builds nested columns far quicker than polars does from python objects
+        try:
+            arrow_type = pl.Series(column, [], dtype=dtype).to_arrow().type
+            return pl.Series(column, pa.array(values, type=arrow_type))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            log.debug("%s does not match its schema, casting it", column)
+    # strict=False casts read_json's numbers back to strings, the same as the pandas transforms' astype("str")
+    return pl.Series(column, values, dtype=dtype, strict=False)
+
+def get_oracle_printings(cards: pl.DataFrame) -> pl.DataFrame:
+    return cards.filter(pl.col("oracle_id").is_null() | pl.col("oracle_id").is_first_distinct())
+
+def nullable_str(column: str) -> pl.Expr:
+    # the pandas transforms store empty costs and text as NULL
+    return pl.when(pl.col(column) == "").then(None).otherwise(pl.col(column)).alias(column)
+
+def get_card_faces(cards: pl.DataFrame) -> pd.DataFrame:
+    log.info("preparing card faces")
+    face = pl.col("card_faces")
+    faces = (
+        cards.lazy()
+        .filter(face.is_not_null())
+        .select("index", "id", "oracle_id", pl.col("image_uris").struct.field("normal").alias("root_image"), "card_faces")
+        .explode("card_faces")
+        .select(
+            "index",
+            "id",
+            face.struct.field("object"),
+            face.struct.field("name"),
+            face.struct.field("mana_cost"),
+            face.struct.field("oracle_text"),
+            face.struct.field("cmc"),
+            face.struct.field("flavor_text"),
+            face.struct.field("loyalty"),
+            pl.coalesce(pl.col("oracle_id"), face.struct.field("oracle_id")).alias("oracle_id"),
+            face.struct.field("power"),
+            face.struct.field("toughness"),
+            # cards with one image in the root image_uris use it for every face
+            pl.coalesce(pl.col("root_image"), face.struct.field("image_uris").struct.field("normal")).alias("image"),
+            pl.col("root_image").is_not_null().alias("single_image")
+        )
+        .with_columns(nullable_str("oracle_text"), nullable_str("mana_cost"))
+    )
+    multi = faces.filter(~pl.col("single_image")).unique(subset=pl.exclude("index", "single_image"), keep="first", maintain_order=True)
+    single = faces.filter(pl.col("single_image"))
+    card_faces = pl.concat([multi, single]).drop("single_image").collect()
+
+    if card_faces.height == 0:
+        log.warning("no card faces found")
+        return pd.DataFrame(columns=["id", "object", "name", "normal", "mana_cost", "oracle_text", "cmc", "flavor_text", "loyalty", "oracle_id", "power", "toughness"])
+
+    log.info("finished preparing card faces")
+    return card_faces.to_pandas()
+
+def get_card_parts(cards: pl.DataFrame) -> pd.DataFrame:
+    log.info("preparing card parts")
+    part = pl.col("all_parts")
+    card_parts = (
+        cards.lazy()
+        .filter(part.is_not_null())
+        .select("index", "id", "all_parts")
+        .explode("all_parts")
+        .select(
+            "index",
+            pl.col("id").alias("card_id"),
+            part.struct.field("object"),
+            part.struct.field("component"),
+            part.struct.field("id").alias("related_card")
+        )
+        .collect()
+    )
+    log.info("finished preparing card parts")
+    return to_pandas(card_parts)
+
+def get_type_line_data(cards: pl.DataFrame):
+    log.info("preparing type line data")
+    root = (
+        cards.lazy()
+        .filter(pl.col("type_line").is_not_null())
+        .select("index", "id", pl.col("type_line").str.split(" ").alias("type_name"))
+        .explode("type_name")
+    )
+    # some cards dont have a type_line in its root, and instead its nested in its faces
+    nested = (
+        cards.lazy()
+        .filter(pl.col("type_line").is_null() & pl.col("card_faces").is_not_null())
+        .select("index", "id", "card_faces")
+        .explode("card_faces")
+        .select("index", "id", pl.col("card_faces").struct.field("type_line").str.split(" ").alias("type_name"))
+        .explode("type_name")
+    )
+    root, nested = pl.collect_all([root, nested])
+
+    card_types_lookup = pl.concat([
+        root.select(pl.col("type_name").unique(maintain_order=True)),
+        nested.select(pl.col("type_name").unique(maintain_order=True))
+    ]).rename({"type_name": "type_line"})
+    card_to_type = to_pandas(pl.concat([root, nested]))
+    card_to_type.index.name = "index"
+
+    log.info("finished preparing type line data")
+    return card_types_lookup.to_pandas(), card_to_type
+
+def get_rarities(cards: pl.DataFrame) -> pd.Series:
+    return to_pandas(cards.select("index", "rarity").unique(subset="rarity", keep="first", maintain_order=True))["rarity"]
+
+def get_layouts(cards: pl.DataFrame) -> pd.Series:
+    return to_pandas(cards.select("index", "layout").unique(subset="layout", keep="first", maintain_order=True))["layout"]
+
+def get_cards(_cards: pl.DataFrame) -> pd.DataFrame:
+    cards = _cards.select(
+        "index", "name", "mana_cost", "oracle_text", "flavor_text", "artist", "collector_number",
+        "power", "toughness", "set", "id", "cmc", "oracle_id", "rarity", "layout", "loyalty",
+        # only cards without faces take their image from the root
+        pl.when(pl.col("card_faces").is_null()).then(pl.col("image_uris").struct.field("normal")).alias("normal")
+    )
+    return to_pandas(cards)
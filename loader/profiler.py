@@ -0,0 +1,135 @@
+import sys
+import threading
+import tracemalloc
+import datetime as dt
+import logging
+from os import getpid
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter, sleep
+log = logging.getLogger("__main__")
+
+class StackSampler:
+    """Samples the stack of a thread at a fixed interval, counting each unique stack
+
+    Parameters:
+    interval (float): Seconds between samples
+    thread_id (int): Thread to sample, defaults to the thread that created the sampler
+    """
+    def __init__(self, interval: float = 0.005, thread_id: int = None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.stacks: Counter = Counter()
+        self.stage: str = "startup"
+        self._stop = threading.Event()
+        self._thread: threading.Thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                calls = []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append(code.co_name+" ("+code.co_filename+":"+str(code.co_firstlineno)+")")
+                    frame = frame.f_back
+                calls.append(self.stage)
+                self.stacks[";".join(reversed(calls))] += 1
+            sleep(self.interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+class Profiler:
+    """Collects per-stage timings, sampled cpu stacks and tracemalloc allocations for a loader run
+
+    Parameters:
+    log_dir (str): Directory the profile files are written to
+    top_allocations (int): Amount of allocation sites to keep per stage
+    interval (float): Seconds between stack samples
+    """
+    def __init__(self, log_dir: str = "logs/", top_allocations: int = 15, interval: float = 0.005):
+        self.log_dir = log_dir
+        self.top_allocations = top_allocations
+        self.sampler = StackSampler(interval)
+        self.timings: list[tuple[str, float, int]] = []
+        self.allocations: dict[str, list[tracemalloc.StatisticDiff]] = {}
+
+    def start(self):
+        tracemalloc.start(25)
+        self.sampler.start()
+        log.info("profiling enabled")
+
+    @contextmanager
+    def stage(self, name: str):
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        self.sampler.stage = name
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - started
+            # snapshots are slow, keep them out of the stage's samples
+            self.sampler.stage = "between stages"
+            _current, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            self.timings.append((name, elapsed, peak))
+            self.allocations[name] = after.compare_to(before, "lineno")[:self.top_allocations]
+            log.info("stage %s took %.2fs, peak traced memory %.1f MiB", name, elapsed, peak / 1048576)
+
+    def reset(self):
+        """Drop what was collected so far, so each cycle of a long running process is profiled on its own"""
+        # the sampler thread keeps counting into whichever counter is current
+        self.sampler.stacks = Counter()
+        self.timings = []
+        self.allocations = {}
+
+    @contextmanager
+    def cycle(self):
+        """Profile one run of the loader, written to its own files once the run finishes or fails"""
+        self.reset()
+        try:
+            yield
+        finally:
+            self.write()
+
+    def stop(self):
+        self.sampler.stop()
+        tracemalloc.stop()
+
+    def write(self):
+        # time and pid keep runs of the same day, and processes started at the same time, from overwriting each other
+        prefix = self.log_dir+dt.datetime.now().strftime("%Y-%m-%d_%H%M%S")+"_"+str(getpid())+"_profile"
+
+        with open(prefix+".folded", "w", encoding="utf-8") as f:
+            for stack, count in self.sampler.stacks.most_common():
+                f.write(stack+" "+str(count)+"\n")
+
+        # self time of each function, taken from the leaf of every sampled stack
+        leaf_counts: Counter = Counter()
+        for stack, count in self.sampler.stacks.items():
+            leaf_counts[stack.rsplit(";", 1)[-1]] += count
+        total_samples = sum(leaf_counts.values())
+
+        with open(prefix+".txt", "w", encoding="utf-8") as f:
+            f.write("# stage timings\n")
+            for name, elapsed, peak in self.timings:
+                f.write(f"{name}: {elapsed:.3f}s, peak traced memory {peak / 1048576:.1f} MiB\n")
+
+            f.write(f"\n# sampled cpu, top functions by self samples ({total_samples} samples every {self.sampler.interval * 1000:g}ms)\n")
+            for function, count in leaf_counts.most_common(30):
+                f.write(f"{count:>8} {count / total_samples:>7.1%}  {function}\n")
+
+            for name, stats in self.allocations.items():
+                f.write(f"\n# top allocations during {name}\n")
+                for stat in stats:
+                    f.write(str(stat)+"\n")
+
+        log.info("profile written to %s.txt and %s.folded", prefix, prefix)
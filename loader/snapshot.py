@@ -0,0 +1,149 @@
+import pandas as pd
+import sqlite3
+import logging
+import json
+import datetime as dt
+from contextlib import closing
+from os import path, remove, replace
+log = logging.getLogger("__main__")
+
+# Denormalised read snapshot of the card tables, one row per card with its faces, types and parts embedded as JSON
+# Written to a temporary file and swapped in, so readers always see a complete snapshot
+
+SNAPSHOT_SCHEMA = """
+CREATE TABLE [card] (
+    [id] INTEGER PRIMARY KEY,
+    [source_id] TEXT NOT NULL UNIQUE,
+    [name] TEXT,
+    [mana_cost] TEXT,
+    [text] TEXT,
+    [flavor] TEXT,
+    [artist] TEXT,
+    [collector_number] TEXT,
+    [power] TEXT,
+    [toughness] TEXT,
+    [loyalty] TEXT,
+    [converted_cost] REAL,
+    [image] TEXT,
+    [oracle_id] TEXT,
+    [set_code] TEXT,
+    [set_name] TEXT,
+    [set_type] TEXT,
+    [release_date] TEXT,
+    [rarity] TEXT,
+    [layout] TEXT,
+    [type_line] TEXT,
+    [types] TEXT,
+    [faces] TEXT,
+    [parts] TEXT
+);
+CREATE TABLE [snapshot_info] (
+    [key] TEXT PRIMARY KEY,
+    [value] TEXT
+);
+"""
+SNAPSHOT_INDEXES = """
+CREATE INDEX [ix_card_name] ON [card] ([name] COLLATE NOCASE);
+CREATE INDEX [ix_card_oracle_id] ON [card] ([oracle_id]);
+CREATE INDEX [ix_card_set] ON [card] ([set_code], [collector_number]);
+"""
+CARD_COLUMNS = ["id", "source_id", "name", "mana_cost", "text", "flavor", "artist", "collector_number", "power", "toughness", "loyalty",
+                "converted_cost", "image", "oracle_id", "set_code", "set_name", "set_type", "release_date", "rarity", "layout"]
+FACE_COLUMNS = ["object", "name", "image", "mana_cost", "oracle_text", "converted_cost", "flavour_text", "loyalty", "power", "toughness"]
+PART_COLUMNS = ["object", "component", "related_card"]
+
+def group_json(frame: pd.DataFrame, key: str, columns: list) -> pd.Series:
+    """JSON array of the rows of each key, in the order of the frame
+
+    Parameters:
+    frame (pd.DataFrame): Rows to group
+    key (str): Column to group by
+    columns (list): Columns kept in each row
+    """
+    if frame.empty:
+        return pd.Series(dtype=object)
+    values = frame.loc[:, columns].astype(object)
+    records = values.where(values.notna(), None).to_dict("records")
+    grouped: dict[int, list] = {}
+    for group, record in zip(frame[key], records):
+        grouped.setdefault(group, []).append(record)
+    return pd.Series({group: json.dumps(rows) for group, rows in grouped.items()}, dtype=object)
+
+def by_card_or_oracle(cards: pd.DataFrame, per_card: pd.Series) -> pd.Series:
+    """Map per card values onto the cards, falling back to another printing of the same oracle_id
+
+    With TCGCT_ORACLE_DEDUP faces and type lines are only stored against the first printing loaded
+
+    Parameters:
+    cards (pd.DataFrame): Cards with id and oracle_id
+    per_card (pd.Series): Values indexed by card id
+    """
+    values = cards["id"].map(per_card)
+    holders = cards.loc[cards["id"].isin(per_card.index) & cards["oracle_id"].notna()].drop_duplicates("oracle_id")
+    per_oracle = holders.set_index("oracle_id")["id"].map(per_card)
+    return values.fillna(cards["oracle_id"].map(per_oracle))
+
+def build_cards(cards: pd.DataFrame, faces: pd.DataFrame, type_lines: pd.DataFrame, parts: pd.DataFrame) -> pd.DataFrame:
+    """Denormalise the card tables into one row per card
+
+    Parameters:
+    cards (pd.DataFrame): Cards joined to their set, rarity and layout, with the columns in CARD_COLUMNS
+    faces (pd.DataFrame): Card faces with card_id and FACE_COLUMNS, in face order
+    type_lines (pd.DataFrame): card_id and type_name, in type line order
+    parts (pd.DataFrame): Card parts with card_id and PART_COLUMNS
+    """
+    log.info("building snapshot of %s cards", cards.shape[0])
+    snapshot = cards.loc[:, CARD_COLUMNS].copy()
+
+    type_names = type_lines.groupby("card_id", sort=False)["type_name"].agg(list)
+    type_names = by_card_or_oracle(snapshot, type_names)
+    snapshot["type_line"] = type_names.map(" ".join, na_action="ignore")
+    snapshot["types"] = type_names.map(json.dumps, na_action="ignore")
+
+    snapshot["faces"] = by_card_or_oracle(snapshot, group_json(faces, "card_id", FACE_COLUMNS))
+    snapshot["parts"] = snapshot["id"].map(group_json(parts, "card_id", PART_COLUMNS))
+    return snapshot
+
+def read_version(file_name: str) -> str | None:
+    """Version of an existing snapshot, None when there is no snapshot"""
+    if not path.exists(file_name):
+        return None
+    try:
+        with closing(sqlite3.connect("file:"+file_name+"?mode=ro", uri=True)) as conn:
+            row = conn.execute("SELECT [value] FROM [snapshot_info] WHERE [key] = 'version'").fetchone()
+    except sqlite3.Error as ex:
+        log.warning("could not read snapshot version : %s", ex)
+        return None
+    return None if row is None else row[0]
+
+def write_snapshot(file_name: str, snapshot: pd.DataFrame, version: str):
+    """Write a snapshot from build_cards to a SQLite file, replacing any existing snapshot
+
+    Parameters:
+    file_name (str): Location of the snapshot
+    snapshot (pd.DataFrame): Frame returned by build_cards
+    version (str): TCGCT.Games.LastUpdated the snapshot was built from
+    """
+    temp_name = file_name+".tmp"
+    if path.exists(temp_name):
+        remove(temp_name)
+
+    columns = list(snapshot.columns)
+    values = snapshot.astype(object)
+    rows = values.where(values.notna(), None).itertuples(index=False, name=None)
+    with closing(sqlite3.connect(temp_name)) as conn:
+        # nothing reads the temporary file, so there is no need to journal it
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.executescript(SNAPSHOT_SCHEMA)
+        conn.executemany("INSERT INTO [card] (["+"], [".join(columns)+"]) VALUES ("+", ".join("?" * len(columns))+")", rows)
+        conn.executescript(SNAPSHOT_INDEXES)
+        conn.executemany("INSERT INTO [snapshot_info] ([key], [value]) VALUES (?, ?)", [
+            ("version", version),
+            ("created_at", dt.datetime.now(dt.timezone.utc).isoformat()),
+            ("cards", str(snapshot.shape[0]))
+        ])
+        conn.commit()
+        conn.execute("ANALYZE")
+    replace(temp_name, file_name)
+    log.info("snapshot version %s written to %s", version, file_name)
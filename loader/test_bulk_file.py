@@ -0,0 +1,75 @@
+import unittest
+import bulk_file as bf
+import pandas as pd
+import tempfile
+import json
+from os import getenv, path
+
+class TestBulkFile(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open(getenv("TCGCT_TEST_BULK_NAME"), encoding='utf-8') as f:
+            cls.records: list = json.load(f)
+        cls.temp_dir = tempfile.TemporaryDirectory()
+
+        # the two layouts bulk files come in, scryfall's one record per line and json.dump(indent=4)
+        cls.lines_name = path.join(cls.temp_dir.name, "lines.json")
+        with open(cls.lines_name, 'w', encoding='utf-8') as f:
+            f.write("[\n"+",\n".join(json.dumps(record, ensure_ascii=False) for record in cls.records)+"\n]\n")
+        cls.indent_name = path.join(cls.temp_dir.name, "indent.json")
+        with open(cls.indent_name, 'w', encoding='utf-8') as f:
+            json.dump(cls.records, f, ensure_ascii=False, indent=4)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.temp_dir.cleanup()
+
+    def test_find_shard_offsets(self):
+        for bulk_name in [self.lines_name, self.indent_name]:
+            offsets = bf.find_shard_offsets(bulk_name, 3)
+            self.assertEqual(3, len(offsets))
+            # ranges follow on from each other and cover the whole file
+            self.assertEqual(0, offsets[0][0])
+            self.assertEqual(path.getsize(bulk_name), offsets[-1][1])
+            for (_start, end), (next_start, _end) in zip(offsets, offsets[1:]):
+                self.assertEqual(end, next_start)
+
+    def test_read_shard(self):
+        for bulk_name in [self.lines_name, self.indent_name]:
+            offsets = bf.find_shard_offsets(bulk_name, 3)
+            shards = [bf.read_shard(bulk_name, start, end) for start, end in offsets]
+            test_data = pd.concat(shards, ignore_index=True)
+
+            self.assertEqual([record["id"] for record in self.records], list(test_data["id"]))
+
+    def test_more_shards_than_records(self):
+        offsets = bf.find_shard_offsets(self.lines_name, 50)
+        self.assertEqual(len(self.records), len(offsets))
+
+    def test_compressed_ndjson(self):
+        with open(self.lines_name, 'rb') as f:
+            lines = f.readlines()
+
+        for compression in ["gzip", "zstd"]:
+            bulk_name = path.join(self.temp_dir.name, "cards.ndjson."+compression)
+            bf.write_ndjson(lines, bulk_name, compression)
+            self.assertEqual(compression, bf.get_compression(bulk_name))
+            self.assertTrue(bf.is_ndjson(bulk_name))
+
+            test_data = bf.read_cards(bulk_name)
+            self.assertEqual([record["id"] for record in self.records], list(test_data["id"]))
+
+            # small chunks so every record gets its own
+            chunks = list(bf.iter_record_chunks(bulk_name, 0))
+            self.assertEqual(len(self.records), len(chunks))
+
+    def test_plain_ndjson_shards(self):
+        bulk_name = path.join(self.temp_dir.name, "cards.ndjson")
+        with open(bulk_name, 'w', encoding='utf-8') as f:
+            for record in self.records:
+                f.write(json.dumps(record, ensure_ascii=False)+"\n")
+
+        self.assertIsNone(bf.get_compression(bulk_name))
+        offsets = bf.find_shard_offsets(bulk_name, 3)
+        test_data = pd.concat([bf.read_shard(bulk_name, start, end) for start, end in offsets], ignore_index=True)
+        self.assertEqual([record["id"] for record in self.records], list(test_data["id"]))
@@ -0,0 +1,109 @@
+import unittest
+import mtg_transform as mt
+import pandas as pd
+import tracemalloc
+import logging
+import json
+from os import getenv, path
+from time import perf_counter
+
+# Throughput and peak memory budgets for the transforms, checked against data/Testing/perf_baseline.json
+# Times are compared as a multiple of a reference pass timed in the same run, so a slower machine moves both and the budget still holds
+#   TCGCT_TEST_PERF_TOLERANCE: how many times slower than the baseline, relative to the reference pass, a transform is allowed to be
+#   TCGCT_TEST_PERF_MEMORY_TOLERANCE: how many times more peak memory than the baseline is allowed
+#   TCGCT_TEST_PERF_UPDATE_BASELINE: "True" to write the measured numbers as the new baseline
+BASELINE_NAME = path.join(path.dirname(path.abspath(__file__)), "data", "Testing", "perf_baseline.json")
+COPIES = 1000
+REPEATS = 3
+
+def generate_cards(copies: int) -> pd.DataFrame:
+    """Tile the test fixtures into a medium sized frame, giving every printing its own id"""
+    frames = [pd.read_json(getenv("TCGCT_TEST_BULK_NAME"), orient='records'),
+              pd.read_json(getenv("TCGCT_TEST_FACES_BULK_NAME"), orient='records')]
+    base = pd.concat(frames, ignore_index=True)
+    cards = pd.concat([base] * copies, ignore_index=True)
+    cards["id"] = [f"{i:08d}"+card_id[8:] for i, card_id in enumerate(cards["id"])]
+    return cards
+
+def reference_pass(cards: pd.DataFrame):
+    """Fixed pandas workload timed next to the transforms, the yardstick for how fast this machine is"""
+    frame = cards[["id", "name", "set", "collector_number"]].copy()
+    frame["key"] = frame["set"].str.upper()+"-"+frame["collector_number"].astype(str)
+    frame.sort_values(["key", "name"]).to_json(orient='records')
+
+def measure(func, arg) -> tuple[float, float]:
+    """Returns the best time of REPEATS runs in seconds, and the peak traced memory of one run in MiB"""
+    best = None
+    for _ in range(REPEATS):
+        started = perf_counter()
+        func(arg)
+        elapsed = perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    func(arg)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak / 1048576
+
+class TestPerformance(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        logging.getLogger("__main__").disabled = True
+        cls.raw_cards: pd.DataFrame = generate_cards(COPIES)
+        cls.cards: pd.DataFrame = mt.prepare_cards(cls.raw_cards)
+        cls.rows: int = cls.raw_cards.shape[0]
+        cls.tolerance = float(getenv("TCGCT_TEST_PERF_TOLERANCE", "3"))
+        cls.memory_tolerance = float(getenv("TCGCT_TEST_PERF_MEMORY_TOLERANCE", "1.5"))
+        cls.update_baseline = getenv("TCGCT_TEST_PERF_UPDATE_BASELINE") == "True"
+        cls.measured: dict = {}
+        cls.reference_seconds, _peak = measure(reference_pass, cls.raw_cards)
+
+        if path.exists(BASELINE_NAME):
+            with open(BASELINE_NAME, encoding='utf-8') as f:
+                cls.baseline = json.load(f)
+        else:
+            cls.baseline = {"rows": cls.rows, "functions": {}}
+
+    @classmethod
+    def tearDownClass(cls):
+        logging.getLogger("__main__").disabled = False
+        if cls.update_baseline:
+            with open(BASELINE_NAME, 'w', encoding='utf-8') as f:
+                json.dump({"rows": cls.rows, "functions": cls.measured}, f, indent=4)
+
+    def check_budget(self, name: str, func, arg):
+        elapsed, peak_mib = measure(func, arg)
+        rows_per_second = self.rows / elapsed
+        relative_time = elapsed / self.reference_seconds
+        self.measured[name] = {"rows_per_second": round(rows_per_second), "relative_time": round(relative_time, 3), "peak_mib": round(peak_mib, 2)}
+        if self.update_baseline:
+            return
+
+        self.assertEqual(self.baseline["rows"], self.rows, "baseline was recorded with a different input size")
+        self.assertIn(name, self.baseline["functions"], "no baseline recorded for "+name)
+        budget = self.baseline["functions"][name]
+
+        # rows_per_second is only recorded for reference, it depends on the machine the baseline was made on
+        max_relative_time = budget["relative_time"] * self.tolerance
+        self.assertLessEqual(relative_time, max_relative_time,
+                             f"{name} took {relative_time:.2f}x the reference pass ({rows_per_second:.0f} rows/s), budget is {max_relative_time:.2f}x")
+
+        max_peak_mib = budget["peak_mib"] * self.memory_tolerance
+        self.assertLessEqual(peak_mib, max_peak_mib,
+                             f"{name} peaked at {peak_mib:.1f} MiB, budget is {max_peak_mib:.1f} MiB")
+
+    def test_prepare_cards(self):
+        self.check_budget("prepare_cards", mt.prepare_cards, self.raw_cards)
+
+    def test_get_card_faces(self):
+        self.check_budget("get_card_faces", mt.get_card_faces, self.cards)
+
+    def test_get_card_parts(self):
+        self.check_budget("get_card_parts", mt.get_card_parts, self.cards)
+
+    def test_get_type_line_data(self):
+        self.check_budget("get_type_line_data", mt.get_type_line_data, self.cards)
+
+    def test_get_cards(self):
+        self.check_budget("get_cards", mt.get_cards, self.cards)
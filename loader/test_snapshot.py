@@ -0,0 +1,65 @@
+import unittest
+import snapshot as snap
+import pandas as pd
+import sqlite3
+import logging
+import json
+import tempfile
+from contextlib import closing
+from os import path
+
+def card(id: int, source_id: str, name: str, oracle_id: str) -> dict:
+    row = {column: None for column in snap.CARD_COLUMNS}
+    row.update({"id": id, "source_id": source_id, "name": name, "oracle_id": oracle_id, "converted_cost": 2.0, "set_code": "tst", "rarity": "common"})
+    return row
+
+def face(card_id: int, name: str) -> dict:
+    row = {column: None for column in snap.FACE_COLUMNS}
+    row.update({"card_id": card_id, "object": "card_face", "name": name})
+    return row
+
+class TestSnapshot(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        logging.getLogger("__main__").disabled = True
+        # 1 and 2 are printings of the same oracle card, with its faces and type line only stored against 1
+        cls.cards = pd.DataFrame([card(1, "a-1", "Delver of Secrets", "oracle-a"), card(2, "a-2", "Delver of Secrets", "oracle-a"),
+                                  card(3, "b-1", "Llanowar Elves", "oracle-b"), card(4, "c-1", "Reversible", None)])
+        cls.faces = pd.DataFrame([face(1, "Delver of Secrets"), face(1, "Insectile Aberration")])
+        cls.type_lines = pd.DataFrame({"card_id": [1, 1, 1, 1, 3, 3, 3, 3], "type_name": ["Creature", "—", "Human", "Wizard", "Creature", "—", "Elf", "Druid"]})
+        cls.parts = pd.DataFrame({"card_id": [3], "object": ["related_card"], "component": ["token"], "related_card": ["t-1"]})
+        cls.snapshot = snap.build_cards(cls.cards, cls.faces, cls.type_lines, cls.parts).set_index("id")
+
+    @classmethod
+    def tearDownClass(cls):
+        logging.getLogger("__main__").disabled = False
+
+    def test_build_cards(self):
+        self.assertEqual(list(self.snapshot.index), [1, 2, 3, 4])
+        self.assertEqual(self.snapshot.loc[3, "type_line"], "Creature — Elf Druid")
+        self.assertEqual(json.loads(self.snapshot.loc[3, "types"]), ["Creature", "—", "Elf", "Druid"])
+        self.assertEqual(json.loads(self.snapshot.loc[3, "parts"])[0]["related_card"], "t-1")
+        self.assertTrue(pd.isna(self.snapshot.loc[3, "faces"]))
+        self.assertEqual([f["name"] for f in json.loads(self.snapshot.loc[1, "faces"])], ["Delver of Secrets", "Insectile Aberration"])
+
+    def test_build_cards_oracle_fallback(self):
+        self.assertEqual(self.snapshot.loc[2, "faces"], self.snapshot.loc[1, "faces"])
+        self.assertEqual(self.snapshot.loc[2, "type_line"], "Creature — Human Wizard")
+        # no oracle_id, nothing to fall back to
+        self.assertTrue(pd.isna(self.snapshot.loc[4, "faces"]))
+        self.assertTrue(pd.isna(self.snapshot.loc[4, "type_line"]))
+
+    def test_write_snapshot(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_name = path.join(temp_dir, "cards.sqlite")
+            self.assertIsNone(snap.read_version(file_name))
+            snap.write_snapshot(file_name, self.snapshot.reset_index(), "2024-04-01 10:00:00")
+            # a second write replaces the first
+            snap.write_snapshot(file_name, self.snapshot.reset_index(), "2024-04-02 10:00:00")
+            self.assertEqual(snap.read_version(file_name), "2024-04-02 10:00:00")
+            self.assertFalse(path.exists(file_name+".tmp"))
+
+            with closing(sqlite3.connect(file_name)) as conn:
+                rows = conn.execute("SELECT [source_id], [type_line] FROM [card] WHERE [name] = 'llanowar elves' COLLATE NOCASE").fetchall()
+                self.assertEqual(rows, [("b-1", "Creature — Elf Druid")])
+                self.assertEqual(conn.execute("SELECT COUNT(1) FROM [card]").fetchone()[0], 4)
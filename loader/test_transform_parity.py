@@ -0,0 +1,74 @@
+import unittest
+import mtg_transform as mt
+import bulk_file as bf
+import pandas as pd
+import logging
+from os import getenv
+
+try:
+    import mtg_transform_polars as mtp
+except ImportError:
+    mtp = None
+
+def normalise(frame: pd.DataFrame) -> pd.DataFrame:
+    """Bring both engines' null markers in object columns to None, values and dtypes are compared as they are"""
+    frame = frame.copy()
+    for column in frame.columns:
+        if frame[column].dtype == object:
+            frame[column] = frame[column].where(frame[column].notna(), None)
+    return frame
+
+# Checks the polars engine produces the same rows as the pandas transforms on the test fixtures
+@unittest.skipIf(mtp is None, "polars is not installed")
+class TestTransformParity(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        logging.getLogger("__main__").disabled = True
+        # the same reader the loader uses, so both engines get the frame they get in a real run
+        cards = pd.concat([bf.read_cards(getenv("TCGCT_TEST_BULK_NAME")),
+                           bf.read_cards(getenv("TCGCT_TEST_FACES_BULK_NAME"))], ignore_index=True)
+        cls.pandas_cards: pd.DataFrame = mt.prepare_cards(cards)
+        cls.polars_cards = mtp.prepare_cards(cards)
+
+    @classmethod
+    def tearDownClass(cls):
+        logging.getLogger("__main__").disabled = False
+
+    def assert_same(self, expected: pd.DataFrame, actual: pd.DataFrame):
+        self.assertEqual(list(expected.columns), list(actual.columns))
+        self.assertEqual(list(expected.index), list(actual.index))
+        # e.g. an Int64 cmc against a Float64 one, or a loyalty of "3" against 3.0, is a real difference between the engines
+        self.assertEqual(dict(expected.dtypes), dict(actual.dtypes))
+        expected, actual = normalise(expected.reset_index(drop=True)), normalise(actual.reset_index(drop=True))
+        pd.testing.assert_frame_equal(expected, actual)
+
+    def test_get_cards(self):
+        self.assert_same(mt.get_cards(self.pandas_cards.copy()), mtp.get_cards(self.polars_cards))
+
+    def test_get_card_faces(self):
+        expected = mt.get_card_faces(self.pandas_cards)
+        actual = mtp.get_card_faces(self.polars_cards)
+        self.assertFalse(actual.empty)
+        self.assert_same(expected, actual)
+
+    def test_get_card_parts(self):
+        self.assert_same(mt.get_card_parts(self.pandas_cards), mtp.get_card_parts(self.polars_cards))
+
+    def test_get_type_line_data(self):
+        expected_lookup, expected_to_type = mt.get_type_line_data(self.pandas_cards)
+        actual_lookup, actual_to_type = mtp.get_type_line_data(self.polars_cards)
+        self.assertEqual(list(expected_lookup.columns), list(actual_lookup.columns))
+        self.assertEqual(list(expected_lookup["type_line"]), list(actual_lookup["type_line"]))
+        self.assertEqual(expected_to_type.index.name, actual_to_type.index.name)
+        self.assert_same(expected_to_type, actual_to_type)
+
+    def test_get_rarities(self):
+        pd.testing.assert_series_equal(mt.get_rarities(self.pandas_cards), mtp.get_rarities(self.polars_cards))
+
+    def test_get_layouts(self):
+        pd.testing.assert_series_equal(mt.get_layouts(self.pandas_cards), mtp.get_layouts(self.polars_cards))
+
+    def test_get_oracle_printings(self):
+        expected = mt.get_oracle_printings(self.pandas_cards)
+        actual = mtp.get_oracle_printings(self.polars_cards)
+        self.assertEqual(list(expected.index), actual["index"].to_list())
@@ -326,6 +326,34 @@ class TestTransforms(unittest.TestCase):
 
         self.assertTrue(test_unique_types.reset_index(drop=True).equals(compare_frame))
 
+    def test_get_oracle_printings(self):
+        prepared = mt.prepare_cards(self.cards)
+        reprints = prepared.copy()
+        reprints["id"] = "reprint-" + reprints["id"]
+        test_data = mt.get_oracle_printings(pd.concat([prepared, reprints], ignore_index=True))
+
+        # only the first printing of each oracle id is kept, the reversible card has no root oracle id so both printings stay
+        expected_ids = list(prepared["id"]) + list(reprints.loc[reprints["oracle_id"].isna(), "id"])
+        self.assertEqual(expected_ids, list(test_data["id"]))
+
+    def test_get_new_oracle_rows(self):
+        # a-1 and a-2 share an oracle id, r-1 and r-2 are printings of a reversible card without one, a sharded load repeats a-1
+        cards = pd.DataFrame({"id": ["a-1", "a-2", "b-1", "r-1", "r-2", "a-1"], "oracle_id": ["oracle-a", "oracle-a", "oracle-b", None, None, "oracle-a"]})
+        faces = pd.DataFrame({"id": ["a-1", "a-1", "a-2", "a-2", "b-1", "r-1", "r-1", "r-2", "r-2"], "name": ["front", "back"] * 2 + ["b"] + ["front", "back"] * 2})
+
+        nothing_stored = pd.DataFrame({"source_id": pd.Series([], dtype="object"), "oracle_id": pd.Series([], dtype="object")})
+        test_data = mt.get_new_oracle_rows(faces, cards, nothing_stored)
+        self.assertEqual(["a-1", "a-1", "b-1", "r-1", "r-1", "r-2", "r-2"], list(test_data["id"]))
+
+        # oracle-a is stored through another printing and r-1 has its own faces, so only b-1 and r-2 are new
+        stored = pd.DataFrame({"source_id": ["a-9", "r-1"], "oracle_id": ["oracle-a", None]})
+        test_data = mt.get_new_oracle_rows(faces, cards, stored)
+        self.assertEqual(["b-1", "r-2", "r-2"], list(test_data["id"]))
+
+        # a second load of the same cards stores nothing again
+        stored = pd.DataFrame({"source_id": ["a-1", "b-1", "r-1", "r-2"], "oracle_id": ["oracle-a", "oracle-b", None, None]})
+        self.assertTrue(mt.get_new_oracle_rows(faces, cards, stored).empty)
+
     def test_get_rarities(self):
         test_data = mt.get_rarities(self.cards)
 
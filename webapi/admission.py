@@ -0,0 +1,262 @@
+import asyncio
+import sqlite3
+import threading
+import logging as lo
+from collections import OrderedDict
+from math import ceil
+from time import time
+from orjson import dumps
+log = lo.getLogger(__name__)
+
+# Admission control for the expensive endpoints. Each endpoint class has token buckets per user and per client IP, and a limit on
+# requests in flight. Rejections are answered straight from the middleware, before the request body is read or any work is queued
+#
+# Buckets live in a backend, MemoryBucketBackend for one process or SQLiteBucketBackend to share them between the workers of one host.
+# A backend only needs take(buckets), blocking and stats(). Neither backend is shared between hosts, so behind a load balancer each host
+# applies the rates on its own, and each worker process with the memory backend. In flight limits are always per worker process, with
+# uvicorn --workers N a host lets in up to N times an endpoint class's concurrency
+#
+# Login requests carry their username in the body, which the middleware does not read. Their user buckets are keyed by the submitted
+# username and taken by the endpoint with AdmissionController.admit_user, before the password is hashed. Creating a user is only
+# limited per IP, there is no user to key it by yet
+
+# Limits per endpoint class, rates are requests per second and bursts are the requests allowed at once after being idle, per bucket backend.
+# concurrency is per worker process. 0 turns a limit off
+DEFAULT_LIMITS = {
+    "login": {"user_rate": 0.5, "user_burst": 5, "ip_rate": 2, "ip_burst": 20, "concurrency": 64},
+    "write": {"user_rate": 20, "user_burst": 60, "ip_rate": 50, "ip_burst": 150, "concurrency": 64},
+    "read": {"user_rate": 50, "user_burst": 100, "ip_rate": 100, "ip_burst": 200, "concurrency": 256},
+    # an export holds a db connection for as long as it streams
+    "export": {"user_rate": 0.1, "user_burst": 3, "ip_rate": 0.2, "ip_burst": 6, "concurrency": 4}
+}
+
+def refill(tokens: float, updated: float, now: float, rate: float, burst: float) -> float:
+    return min(burst, tokens + max(0.0, now - updated) * rate)
+
+def take_tokens(states: list[tuple[float, float] | None], buckets: list[tuple[str, float, float]], now: float) -> tuple[list[tuple[float, float]], list[float]]:
+    """New (tokens, updated) of each bucket and the seconds each is short of a token, tokens are only taken when every bucket has one"""
+    tokens = [burst if state is None else refill(state[0], state[1], now, rate, burst) for state, (_key, rate, burst) in zip(states, buckets)]
+    waits = [0.0 if count >= 1 else (1 - count) / rate for count, (_key, rate, _burst) in zip(tokens, buckets)]
+    if all(wait == 0 for wait in waits):
+        tokens = [count - 1 for count in tokens]
+    return [(count, now) for count in tokens], waits
+
+class MemoryBucketBackend:
+    """Token buckets in this process, the least recently used buckets are dropped past max_keys, which only resets them to full
+
+    Parameters:
+    max_keys (int): Most buckets held at once
+    """
+    # takes never wait on anything, they can run on the event loop
+    blocking = False
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self.buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, buckets: list[tuple[str, float, float]]) -> list[float]:
+        """Take a token from every bucket or from none of them, returns the seconds until each bucket has a token, all 0 when they were taken
+
+        Parameters:
+        buckets (list[tuple[str, float, float]]): (key, rate, burst) of each bucket
+        """
+        now = time()
+        with self.lock:
+            states, waits = take_tokens([self.buckets.get(key) for key, _rate, _burst in buckets], buckets, now)
+            for (key, _rate, _burst), state in zip(buckets, states):
+                self.buckets[key] = state
+                self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+            return waits
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"backend": "memory", "keys": len(self.buckets), "max_keys": self.max_keys}
+
+class SQLiteBucketBackend:
+    """Token buckets in a SQLite file shared by every worker on the host
+
+    A take that can not get the file lock within timeout is let through rather than making the request wait. Takes wait on the file,
+    so the controller runs them off the event loop
+
+    Parameters:
+    file_name (str): Location of the SQLite file, created when missing
+    timeout (float): Seconds to wait for another worker's update of the file
+    expire_seconds (float): Buckets untouched for this long are deleted
+    """
+    blocking = True
+
+    def __init__(self, file_name: str, timeout: float = 0.05, expire_seconds: float = 3600):
+        self.file_name = file_name
+        self.timeout = timeout
+        self.expire_seconds = expire_seconds
+        self.local = threading.local()
+        self.takes = 0
+        self.failed_open = 0
+        self.lock = threading.Lock()
+        conn = self.connect()
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS [bucket] ([key] TEXT PRIMARY KEY, [tokens] REAL NOT NULL, [updated] REAL NOT NULL) WITHOUT ROWID")
+        conn.execute("CREATE INDEX IF NOT EXISTS [bucket_updated] ON [bucket] ([updated])")
+
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.file_name, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def take(self, buckets: list[tuple[str, float, float]]) -> list[float]:
+        """Same as MemoryBucketBackend.take"""
+        now = time()
+        conn = self.connect()
+        with self.lock:
+            self.takes += 1
+            expire = self.takes % 10000 == 0
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                states = [conn.execute("SELECT [tokens], [updated] FROM [bucket] WHERE [key] = ?", (key,)).fetchone() for key, _rate, _burst in buckets]
+                states, waits = take_tokens(states, buckets, now)
+                conn.executemany("INSERT OR REPLACE INTO [bucket] ([key], [tokens], [updated]) VALUES (?, ?, ?)",
+                                 [(key, tokens, updated) for (key, _rate, _burst), (tokens, updated) in zip(buckets, states)])
+                if expire:
+                    conn.execute("DELETE FROM [bucket] WHERE [updated] < ?", (now - self.expire_seconds,))
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.OperationalError as ex:
+            with self.lock:
+                self.failed_open += 1
+            log.warning("admission buckets %s not checked : %s", [key for key, _rate, _burst in buckets], ex)
+            return [0.0] * len(buckets)
+        return waits
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"backend": "sqlite", "file_name": self.file_name, "takes": self.takes, "failed_open": self.failed_open}
+
+class AdmissionController:
+    """Decides whether a request of an endpoint class is let in, and keeps the counts for the metrics
+
+    The in flight counts are those of this process, the bucket limits are as wide as the backend is shared
+
+    Parameters:
+    backend (MemoryBucketBackend | SQLiteBucketBackend): Where the token buckets are kept
+    limits (dict): Limits per endpoint class, same shape as DEFAULT_LIMITS
+    """
+    def __init__(self, backend, limits: dict):
+        self.backend = backend
+        self.limits = limits
+        self.lock = threading.Lock()
+        self.in_flight = {name: 0 for name in limits}
+        self.counts = {name: {"admitted": 0, "rejected_user": 0, "rejected_ip": 0, "rejected_concurrency": 0} for name in limits}
+
+    def admit(self, name: str, user: str | None, ip: str | None) -> tuple[int, float] | None:
+        """Let a request in, returns None when it may run or (status code, retry after seconds) when it is rejected
+
+        An admitted request must be handed to release when it finishes
+        """
+        limits = self.limits[name]
+        with self.lock:
+            if limits["concurrency"] > 0 and self.in_flight[name] >= limits["concurrency"]:
+                self.counts[name]["rejected_concurrency"] += 1
+                return 503, 1
+            self.in_flight[name] += 1
+
+        # both buckets are checked before either is taken from, so a request turned away for its IP does not use up its user's tokens
+        buckets = []
+        reasons = []
+        if user is not None and limits["user_rate"] > 0:
+            buckets.append((name+":user:"+user, limits["user_rate"], limits["user_burst"]))
+            reasons.append("rejected_user")
+        if ip is not None and limits["ip_rate"] > 0:
+            buckets.append((name+":ip:"+ip, limits["ip_rate"], limits["ip_burst"]))
+            reasons.append("rejected_ip")
+        waits = self.backend.take(buckets) if len(buckets) > 0 else []
+
+        with self.lock:
+            for reason, wait in zip(reasons, waits):
+                if wait > 0:
+                    self.in_flight[name] -= 1
+                    self.counts[name][reason] += 1
+                    return 429, max(waits)
+            self.counts[name]["admitted"] += 1
+        return None
+
+    def admit_user(self, name: str, user: str) -> float:
+        """Take from the user bucket of a request admitted without a user, for users only known once the request has been read
+
+        Returns 0 when the request may carry on or the seconds to retry after. A rejected request is counted as rejected instead of
+        admitted, and is still released by the middleware
+        """
+        limits = self.limits[name]
+        if limits["user_rate"] <= 0:
+            return 0.0
+        wait = self.backend.take([(name+":user:"+user, limits["user_rate"], limits["user_burst"])])[0]
+        if wait > 0:
+            with self.lock:
+                self.counts[name]["admitted"] -= 1
+                self.counts[name]["rejected_user"] += 1
+        return wait
+
+    async def run(self, func, *args):
+        # backends that wait on a file or the network are run off the event loop
+        if not self.backend.blocking:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def release(self, name: str):
+        with self.lock:
+            self.in_flight[name] -= 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            classes = {name: {**self.counts[name], "in_flight": self.in_flight[name], **self.limits[name]} for name in self.limits}
+        return {"classes": classes, "buckets": self.backend.stats()}
+
+class AdmissionMiddleware:
+    """ASGI middleware applying the app's AdmissionController, requests pass through untouched while app.admission is None
+
+    Parameters:
+    app: ASGI app to wrap
+    classify (Callable[[str, str], str | None]): Endpoint class of a method and path, None for requests that are not limited
+    identify (Callable[[dict], str | None]): User of a request from its headers, None when not known
+    body_users (set[str]): Endpoint classes whose user is in the request body, their endpoints take the user bucket with admit_user
+    """
+    def __init__(self, app, classify, identify, body_users: set[str] = None):
+        self.app = app
+        self.classify = classify
+        self.identify = identify
+        self.body_users = body_users or set()
+
+    async def __call__(self, scope, receive, send):
+        controller: AdmissionController = getattr(scope.get("app"), "admission", None) if scope["type"] == "http" else None
+        name = self.classify(scope["method"], scope["path"]) if controller is not None else None
+        if name is None:
+            await self.app(scope, receive, send)
+            return
+
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+        client = scope.get("client")
+        user = self.identify(headers) if name not in self.body_users else None
+        rejection = await controller.run(controller.admit, name, user, client[0] if client else None)
+        if rejection is not None:
+            status_code, retry_after = rejection
+            detail = "Too many requests, try again shortly" if status_code == 429 else "Too many requests in progress, try again shortly"
+            body = dumps({"detail": detail})
+            await send({"type": "http.response.start", "status": status_code, "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, ceil(retry_after))).encode())
+            ]})
+            await send({"type": "http.response.body", "body": body})
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            controller.release(name)
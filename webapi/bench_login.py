@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import sqlite3
+import httpx
+from os import path
+from time import perf_counter
+from werkzeug.security import generate_password_hash
+
+# Login throughput against the latency of other endpoints while logins are running
+# Start the webapi first, e.g. against the stand-in database :
+#   DB_STANDIN_PATH=data/standin uvicorn main:app
+#   python bench_login.py --standin data/standin
+
+def seed_user(standin_path: str, username: str, password: str):
+    """Add the benchmark user straight into the stand-in, replacing it if it exists"""
+    with sqlite3.connect(path.join(standin_path, "account.sqlite")) as conn:
+        conn.execute("DELETE FROM [User] WHERE [Username] = ?", (username,))
+        conn.execute("INSERT INTO [User] ([Username], [Password]) VALUES (?, ?)", (username, generate_password_hash(password, salt_length=16)))
+
+def percentile(values: list[float], pct: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+async def login_worker(client: httpx.AsyncClient, args, deadline: float, results: dict):
+    while perf_counter() < deadline:
+        started = perf_counter()
+        response = await client.post("/token", data={"username": args.username, "password": args.password})
+        results["latency"].append(perf_counter() - started)
+        results["status"][response.status_code] = results["status"].get(response.status_code, 0) + 1
+
+async def probe_worker(client: httpx.AsyncClient, args, deadline: float, results: dict):
+    while perf_counter() < deadline:
+        started = perf_counter()
+        await client.get(args.probe)
+        results["latency"].append(perf_counter() - started)
+        await asyncio.sleep(args.probe_interval)
+
+def report(name: str, results: dict, duration: float):
+    latency = results["latency"]
+    print(f"{name}: {len(latency)} requests, {len(latency) / duration:.1f}/s, "
+          f"p50 {percentile(latency, 50) * 1000:.1f}ms, p99 {percentile(latency, 99) * 1000:.1f}ms, max {max(latency, default=0) * 1000:.1f}ms")
+    if "status" in results:
+        print("    status codes: "+", ".join(f"{code}: {count}" for code, count in sorted(results["status"].items())))
+
+async def run(args):
+    limits = httpx.Limits(max_connections=args.concurrency + args.probes)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+        deadline = perf_counter() + args.duration
+        logins = {"latency": [], "status": {}}
+        probes = {"latency": []}
+        await asyncio.gather(
+            *[login_worker(client, args, deadline, logins) for _ in range(args.concurrency)],
+            *[probe_worker(client, args, deadline, probes) for _ in range(args.probes)]
+        )
+    report("logins", logins, args.duration)
+    report("probe "+args.probe, probes, args.duration)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark login throughput and the p99 latency of other endpoints during logins")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--username", default="benchuser")
+    parser.add_argument("--password", default="benchpassword")
+    parser.add_argument("--standin", help="stand-in database directory to add the benchmark user to")
+    parser.add_argument("--concurrency", type=int, default=32, help="logins in flight at once")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run for")
+    parser.add_argument("--probe", default="/Health/Pool", help="endpoint timed while logins run")
+    parser.add_argument("--probes", type=int, default=4, help="probe requests in flight at once")
+    parser.add_argument("--probe-interval", type=float, default=0.01, help="seconds between probes of one worker")
+    args = parser.parse_args()
+
+    if args.standin is not None:
+        seed_user(args.standin, args.username, args.password)
+    asyncio.run(run(args))
@@ -0,0 +1,81 @@
+import argparse
+import json
+import random
+from time import perf_counter
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from responses import ORJSONResponse, RawJSONResponse, dumps
+from search import RESULT_FIELDS
+
+# Serialisation throughput of a large card payload through each way the webapi can send it, no server needed :
+#   python bench_serialise.py --cards 10000
+
+RARITIES = ["common", "uncommon", "rare", "mythic"]
+
+def make_cards(count: int) -> list[dict]:
+    cards = []
+    for i in range(count):
+        card = {field: None for field in RESULT_FIELDS}
+        card.update({
+            "source_id": "%08x-0000-4000-8000-%012x" % (i, i),
+            "name": "Benchmark Card "+str(i),
+            "set_code": "s"+str(i % 50),
+            "set_name": "Benchmark Set "+str(i % 50),
+            "collector_number": str(i % 300),
+            "rarity": random.choice(RARITIES),
+            "mana_cost": "{"+str(i % 7)+"}{G}",
+            "converted_cost": float(i % 7 + 1),
+            "type_line": "Creature — Elf Druid",
+            "image": "https://cards.example/large/front/"+str(i)+".jpg"
+        })
+        cards.append(card)
+    return cards
+
+def default_response(payload: dict) -> bytes:
+    # what returning a dict from an endpoint did before, jsonable_encoder then the stdlib json encoder
+    return JSONResponse(jsonable_encoder(payload)).body
+
+def orjson_response(payload: dict) -> bytes:
+    # returning a dict with ORJSONResponse as the default response class still goes through jsonable_encoder
+    return ORJSONResponse(jsonable_encoder(payload)).body
+
+def orjson_direct(payload: dict) -> bytes:
+    return ORJSONResponse(payload).body
+
+def cached_bytes(body: bytes) -> bytes:
+    return RawJSONResponse(body).body
+
+def time_it(func, arg, repeat: int) -> tuple[float, int]:
+    size = len(func(arg))
+    timings = []
+    for _ in range(repeat):
+        started = perf_counter()
+        func(arg)
+        timings.append(perf_counter() - started)
+    return min(timings), size
+
+def main(args):
+    payload = {"version": "bench", "total": args.cards, "cards": make_cards(args.cards)}
+    body = dumps(payload)
+    # every way must produce the same document
+    assert json.loads(default_response(payload)) == json.loads(body)
+
+    cases = [
+        ("jsonable_encoder + json", default_response, payload),
+        ("jsonable_encoder + orjson", orjson_response, payload),
+        ("orjson", orjson_direct, payload),
+        ("cached bytes", cached_bytes, body)
+    ]
+    print(f"{args.cards} cards, best of {args.repeat}")
+    print(f"{'path':<28}{'ms':>10}{'MB/s':>10}{'cards/s':>12}")
+    for name, func, arg in cases:
+        seconds, size = time_it(func, arg, args.repeat)
+        print(f"{name:<28}{seconds * 1000:>10.2f}{size / seconds / 1e6:>10.1f}{args.cards / seconds:>12.0f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark serialising a large card payload")
+    parser.add_argument("--cards", type=int, default=10000, help="cards in the payload")
+    parser.add_argument("--repeat", type=int, default=20, help="times each path is timed")
+    args = parser.parse_args()
+    random.seed(0)
+    main(args)
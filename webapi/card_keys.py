@@ -0,0 +1,71 @@
+# In-memory lookup of the keys clients know cards by, so thousands of identifiers resolve with one dict lookup each instead of a query each
+# Built from the same snapshot read as the search index and replaced along with it when the catalogue version changes
+
+class CardKeyError(Exception):
+    pass
+
+def normalise_key(value) -> str:
+    return str(value).strip().lower()
+
+class CardKeyIndex:
+    """Maps Scryfall ids and (set code, collector number) pairs to cards
+
+    Parameters:
+    cards (list[dict]): Cards with id, source_id, set_code and collector_number
+    version (str): Catalogue version the cards were read at
+    """
+    def __init__(self, cards: list[dict], version: str):
+        self.version = version
+        self.by_source_id: dict[str, tuple[int, str, str]] = {}
+        # None marks a set and collector number more than one card has, those can only be resolved by id
+        self.by_number: dict[tuple[str, str], tuple[int, str, str] | None] = {}
+        for card in cards:
+            key = (card["id"], card["set_code"], card["source_id"])
+            self.by_source_id[normalise_key(card["source_id"])] = key
+            if card["set_code"] is None or card["collector_number"] is None:
+                continue
+            number = (normalise_key(card["set_code"]), normalise_key(card["collector_number"]))
+            self.by_number[number] = None if number in self.by_number else key
+
+    def __len__(self) -> int:
+        return len(self.by_source_id)
+
+    def resolve(self, source_id: str = None, set_code: str = None, collector_number: str = None) -> tuple[int, str, str]:
+        """(internal card id, set code, card id) of the card with source_id, or with set_code and collector_number when no source_id is given
+
+        Raises CardKeyError with the reason when there is no single matching card
+        """
+        if source_id is not None:
+            key = self.by_source_id.get(normalise_key(source_id))
+            if key is None:
+                raise CardKeyError("no card with id "+source_id)
+            if set_code is not None and normalise_key(set_code) != normalise_key(key[1]):
+                raise CardKeyError("card "+source_id+" is not in set "+set_code)
+            return key
+        if set_code is None or collector_number is None:
+            raise CardKeyError("give an id, or a set and collector number")
+        number = (normalise_key(set_code), normalise_key(collector_number))
+        if number not in self.by_number:
+            raise CardKeyError("no card "+collector_number+" in set "+set_code)
+        key = self.by_number[number]
+        if key is None:
+            raise CardKeyError("more than one card "+collector_number+" in set "+set_code+", use its id")
+        return key
+
+    def check(self, set_code: str, source_id: str) -> str | None:
+        """Why (set code, card id) would be rejected by [Collection].[UpdateMTGCollection], None when the card exists"""
+        key = self.by_source_id.get(normalise_key(source_id))
+        if key is None:
+            return "no card with id "+source_id
+        if normalise_key(key[1]) != normalise_key(set_code):
+            return "card "+source_id+" is not in set "+set_code
+        return None
+
+    def validate(self, ids: list[tuple[str, str, int]]) -> list[dict]:
+        """Errors for the changes in a collection update whose card does not exist, with their position in ids"""
+        errors = []
+        for position, (set_code, source_id, _amount) in enumerate(ids):
+            error = self.check(set_code, source_id)
+            if error is not None:
+                errors.append({"index": position, "set": set_code, "id": source_id, "error": error})
+        return errors
@@ -0,0 +1,101 @@
+import sqlite3
+import threading
+import logging as lo
+import json
+from contextlib import closing
+from os import path
+from search import CardIndex
+from card_keys import CardKeyIndex
+log = lo.getLogger(__name__)
+
+# Card data served from the read snapshot the loader writes (TCGCT_SNAPSHOT_NAME), so card reads never go to the primary db
+# The snapshot's version is the TCGCT.Games.LastUpdated it was exported at
+
+def connect_snapshot(snapshot_path: str) -> sqlite3.Connection:
+    return sqlite3.connect("file:"+snapshot_path+"?mode=ro", uri=True)
+
+def read_version(snapshot_path: str) -> str | None:
+    """TCGCT.Games.LastUpdated the snapshot was exported at, None when there is no snapshot yet"""
+    if not path.exists(snapshot_path):
+        return None
+    with closing(connect_snapshot(snapshot_path)) as conn:
+        row = conn.execute("SELECT [value] FROM [snapshot_info] WHERE [key] = 'version'").fetchone()
+    return None if row is None else row[0]
+
+def read_cards(snapshot_path: str) -> tuple[list[dict], str]:
+    """Every card in the snapshot along with the version they were read at, read in one transaction so they match"""
+    with closing(connect_snapshot(snapshot_path)) as conn:
+        conn.row_factory = sqlite3.Row
+        conn.execute("BEGIN")
+        version = conn.execute("SELECT [value] FROM [snapshot_info] WHERE [key] = 'version'").fetchone()[0]
+        rows = conn.execute("""
+                            SELECT [id], [source_id], [name], [set_code], [set_name], [collector_number], [rarity], [mana_cost],
+                                [converted_cost], [type_line], [image], [text], [faces]
+                            FROM [card]
+                            """).fetchall()
+    cards = []
+    for row in rows:
+        card = dict(row)
+        faces = json.loads(card.pop("faces")) if row["faces"] is not None else []
+        texts = [card["text"]] + [face["oracle_text"] for face in faces]
+        card["text"] = " ".join(text for text in texts if text)
+        card["face_names"] = [face["name"] for face in faces if face["name"]]
+        # cards with faces have no image of their own, show the front face
+        if card["image"] is None and len(faces) > 0:
+            card["image"] = faces[0]["image"]
+        cards.append(card)
+    return cards, version
+
+class Catalogue:
+    """Holds the current CardIndex and CardKeyIndex and rebuilds them in the background when the snapshot version changes
+
+    Each index is replaced in one assignment, requests keep using the index they started with
+
+    Parameters:
+    snapshot_path (str): Snapshot written by the loader
+    poll_seconds (float): Seconds between version checks
+    """
+    def __init__(self, snapshot_path: str, poll_seconds: float = 30):
+        self.snapshot_path = snapshot_path
+        self.poll_seconds = poll_seconds
+        self.index: CardIndex = None
+        self.keys: CardKeyIndex = None
+        self.stop_event = threading.Event()
+        self.thread: threading.Thread = None
+
+    @property
+    def version(self) -> str | None:
+        index = self.index
+        return None if index is None else index.version
+
+    def refresh(self) -> bool:
+        """Rebuild the index when the snapshot version has changed, returns True when it was rebuilt"""
+        version = read_version(self.snapshot_path)
+        if version is None or version == self.version:
+            return False
+        log.info("building card index for catalogue version %s", version)
+        cards, version = read_cards(self.snapshot_path)
+        keys = CardKeyIndex(cards, version)
+        index = CardIndex(cards, version)
+        self.keys = keys
+        self.index = index
+        log.info("card index of %s cards built for catalogue version %s", len(cards), version)
+        return True
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.refresh()
+            except Exception as ex:
+                # keep serving the current index, the next poll tries again
+                log.exception("failed to refresh card index : %s", ex)
+            self.stop_event.wait(self.poll_seconds)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="catalogue", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,106 @@
+import csv
+import json
+
+# Streaming collection imports, rows of (set code, card id, amount) as NDJSON or CSV
+# Rows are parsed as the body arrives and coalesced into batches, so memory stays the same whatever the import size
+
+FORMATS = {
+    "application/x-ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+    "application/json": "ndjson",
+    "text/csv": "csv"
+}
+MAX_ERRORS_REPORTED = 100
+
+class ImportRowError(Exception):
+    pass
+
+def get_format(content_type: str | None) -> str | None:
+    if content_type is None:
+        return None
+    return FORMATS.get(content_type.split(";")[0].strip().lower())
+
+async def iter_lines(stream, max_line: int):
+    """Split a body stream into lines without holding more than one partial line
+
+    Parameters:
+    stream (AsyncIterator[bytes]): Body chunks, e.g. request.stream()
+    max_line (int): Longest line allowed in bytes
+    """
+    pending = b""
+    async for chunk in stream:
+        pending += chunk
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        if len(pending) > max_line:
+            raise ImportRowError("line is longer than "+str(max_line)+" bytes")
+        for line in lines:
+            if len(line) > max_line:
+                raise ImportRowError("line is longer than "+str(max_line)+" bytes")
+            yield line
+    if pending != b"":
+        yield pending
+
+def parse_row(line: str, format: str) -> tuple[str, str, int] | None:
+    """Parse one line into (set code, card id, amount), None for blank lines and CSV headers
+
+    NDJSON lines are ["set", "id", amount] or {"set": "set", "id": "id", "amount": amount}, CSV lines are set,id,amount
+    """
+    if line.strip() == "":
+        return None
+    if format == "csv":
+        fields = next(csv.reader([line]))
+        if len(fields) != 3:
+            raise ImportRowError("expected 3 fields, got "+str(len(fields)))
+        if [field.strip().lower() for field in fields] == ["set", "id", "amount"]:
+            return None
+        set_code, card_id, amount = fields
+    else:
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as ex:
+            raise ImportRowError("invalid json : "+str(ex))
+        if isinstance(row, dict):
+            row = [row.get("set"), row.get("id"), row.get("amount")]
+        if not isinstance(row, list) or len(row) != 3:
+            raise ImportRowError("expected [set, id, amount] or an object with set, id and amount")
+        set_code, card_id, amount = row
+
+    if not isinstance(set_code, str) or set_code.strip() == "":
+        raise ImportRowError("set code is missing")
+    if not isinstance(card_id, str) or card_id.strip() == "":
+        raise ImportRowError("card id is missing")
+    try:
+        if isinstance(amount, bool) or (isinstance(amount, float) and not amount.is_integer()):
+            raise ValueError()
+        amount = int(amount)
+    except (TypeError, ValueError):
+        raise ImportRowError("amount is not a whole number")
+    return set_code.strip(), card_id.strip(), amount
+
+class ImportBatcher:
+    """Coalesces rows for the same card and hands out batches of at most batch_size distinct cards
+
+    Parameters:
+    batch_size (int): Distinct cards in a batch
+    """
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.changes: dict[tuple[str, str], int] = {}
+        self.rows = 0
+
+    def add(self, set_code: str, card_id: str, amount: int) -> bool:
+        """Add a row, returns True when the batch is full and should be taken"""
+        key = (set_code, card_id)
+        self.changes[key] = self.changes.get(key, 0) + amount
+        self.rows += 1
+        return len(self.changes) >= self.batch_size
+
+    def take(self) -> tuple[list[tuple[str, str, int]], int]:
+        """The batch's changes in the same shape as CollectionUpdateItem.ids, and how many rows went into it"""
+        # rows that cancelled each other out change nothing
+        ids = [(set_code, card_id, amount) for (set_code, card_id), amount in self.changes.items() if amount != 0]
+        rows = self.rows
+        self.changes = {}
+        self.rows = 0
+        return ids, rows
@@ -0,0 +1,412 @@
+import sqlalchemy as sa
+import logging as lo
+import asyncio
+import threading
+import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from os import makedirs, path
+from time import perf_counter
+from sqlalchemy.pool import QueuePool
+log = lo.getLogger(__name__)
+
+# Schemas the webapi uses, the SQLite stand-in attaches one file per schema so the same [Schema].[Table] queries work on both
+STANDIN_SCHEMAS = ["Account", "Collection", "MTG"]
+STANDIN_TABLES = """
+CREATE TABLE IF NOT EXISTS [Account].[User] (
+    [ID] INTEGER PRIMARY KEY AUTOINCREMENT,
+    [UID] TEXT NOT NULL DEFAULT (upper(hex(randomblob(16)))),
+    [Username] TEXT NOT NULL UNIQUE,
+    [Password] TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS [MTG].[Set] (
+    [id] INTEGER PRIMARY KEY AUTOINCREMENT,
+    [name] TEXT,
+    [shorthand] TEXT NOT NULL,
+    [icon] TEXT,
+    [search_uri] TEXT,
+    [set_type_id] INTEGER,
+    [source_id] TEXT,
+    [release_date] TEXT
+);
+CREATE TABLE IF NOT EXISTS [MTG].[Card] (
+    [id] INTEGER PRIMARY KEY AUTOINCREMENT,
+    [name] TEXT,
+    [mana_cost] TEXT,
+    [text] TEXT,
+    [flavor] TEXT,
+    [artist] TEXT,
+    [collector_number] TEXT,
+    [power] TEXT,
+    [toughness] TEXT,
+    [loyalty] TEXT,
+    [card_set_id] INTEGER NOT NULL,
+    [source_id] TEXT NOT NULL UNIQUE,
+    [converted_cost] REAL,
+    [image] TEXT,
+    [oracle_id] TEXT,
+    [rarity_id] INTEGER,
+    [layout_id] INTEGER
+);
+CREATE TABLE IF NOT EXISTS [MTG].[Rarity] (
+    [id] INTEGER PRIMARY KEY AUTOINCREMENT,
+    [name] TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS [Collection].[MTGCollection] (
+    [UserID] INTEGER NOT NULL,
+    [CardID] INTEGER NOT NULL,
+    [Count] INTEGER NOT NULL,
+    PRIMARY KEY ([UserID], [CardID])
+);
+CREATE TABLE IF NOT EXISTS [Collection].[WriteBehindApplied] (
+    [UserID] INTEGER PRIMARY KEY,
+    [FlushID] TEXT NOT NULL,
+    [Change] INTEGER NOT NULL
+);
+"""
+
+#region Table definitions for queries built with sqlalchemy core, only the columns the webapi reads
+METADATA = sa.MetaData()
+CARD = sa.Table("Card", METADATA,
+    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column("name", sa.String),
+    sa.Column("mana_cost", sa.String),
+    sa.Column("collector_number", sa.String),
+    sa.Column("card_set_id", sa.Integer),
+    sa.Column("source_id", sa.String),
+    sa.Column("converted_cost", sa.Float),
+    sa.Column("image", sa.String),
+    sa.Column("rarity_id", sa.Integer),
+    schema="MTG"
+)
+SET = sa.Table("Set", METADATA,
+    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column("name", sa.String),
+    sa.Column("shorthand", sa.String),
+    schema="MTG"
+)
+RARITY = sa.Table("Rarity", METADATA,
+    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column("name", sa.String),
+    schema="MTG"
+)
+# created on SQL Server by sql/collection.sql
+COLLECTION = sa.Table("MTGCollection", METADATA,
+    sa.Column("UserID", sa.Integer, primary_key=True),
+    sa.Column("CardID", sa.Integer, primary_key=True),
+    sa.Column("Count", sa.Integer),
+    schema="Collection"
+)
+#endregion
+
+# Fields a collection read can project, the first three are what the collection is ordered and paged by
+COLLECTION_FIELDS = {
+    "set_code": SET.c.shorthand,
+    "collector_number": CARD.c.collector_number,
+    "card_id": CARD.c.source_id,
+    "name": CARD.c.name,
+    "set_name": SET.c.name,
+    "rarity": RARITY.c.name,
+    "mana_cost": CARD.c.mana_cost,
+    "converted_cost": CARD.c.converted_cost,
+    "image": CARD.c.image,
+    "count": COLLECTION.c.Count
+}
+# (set, collector number, card id), collector numbers can be missing and NULL never compares, so page by an empty string instead
+COLLECTION_KEY = [SET.c.shorthand, sa.func.coalesce(CARD.c.collector_number, ""), CARD.c.id]
+
+def collection_page_query(user_id: int, fields: list[str], after: tuple | None, limit: int, set_code: str = None, rarity: str = None,
+                          min_count: int = None, max_count: int = None) -> sa.Select:
+    """Select for one page of a user's collection, seeking past after instead of using OFFSET so every page costs the same
+
+    Parameters:
+    fields (list[str]): Keys of COLLECTION_FIELDS to return, the page key is always returned as key_set, key_number and key_id
+    after (tuple): (set, collector number, card id) key of the last row of the previous page, None for the first page
+    limit (int): Rows in the page, every row after after when None
+    """
+    sql = (
+        sa.select(*[COLLECTION_FIELDS[field].label(field) for field in fields],
+                  COLLECTION_KEY[0].label("key_set"), COLLECTION_KEY[1].label("key_number"), COLLECTION_KEY[2].label("key_id"))
+        .select_from(COLLECTION
+                     .join(CARD, CARD.c.id == COLLECTION.c.CardID)
+                     .join(SET, SET.c.id == CARD.c.card_set_id)
+                     .outerjoin(RARITY, RARITY.c.id == CARD.c.rarity_id))
+        .where(COLLECTION.c.UserID == user_id)
+    )
+    if set_code is not None:
+        sql = sql.where(SET.c.shorthand == set_code)
+    if rarity is not None:
+        sql = sql.where(RARITY.c.name == rarity)
+    if min_count is not None:
+        sql = sql.where(COLLECTION.c.Count >= min_count)
+    if max_count is not None:
+        sql = sql.where(COLLECTION.c.Count <= max_count)
+    if after is not None:
+        # (a, b, c) > (x, y, z) spelled out, mssql has no row value comparison
+        set_after, number_after, id_after = after
+        sql = sql.where(sa.or_(
+            COLLECTION_KEY[0] > set_after,
+            sa.and_(COLLECTION_KEY[0] == set_after, COLLECTION_KEY[1] > number_after),
+            sa.and_(COLLECTION_KEY[0] == set_after, COLLECTION_KEY[1] == number_after, COLLECTION_KEY[2] > id_after)
+        ))
+    sql = sql.order_by(*COLLECTION_KEY)
+    # limit is rendered as TOP on mssql and LIMIT on sqlite
+    return sql.limit(limit) if limit is not None else sql
+
+def create_connection(db_name: str, db_location: str, db_driver: str, db_username: str, db_password: str, pool_settings: dict) -> sa.Engine:
+    """Pooled engine for the MSSQL database
+
+    Parameters:
+    pool_settings (dict): pool_size, max_overflow, pool_timeout, pool_recycle and pool_pre_ping for sa.create_engine
+    """
+    connection_url = sa.URL.create(
+        "mssql+pyodbc",
+        username=db_username,
+        password=db_password,
+        host=db_location,
+        database=db_name,
+        query={"driver": db_driver},
+    )
+    engine = sa.create_engine(connection_url, **pool_settings)
+    log.debug("testing db connection")
+    try:
+        with engine.connect() as conn:
+            conn.execute(sa.text("SELECT 1"))
+    except:
+        # the pool reconnects once the db is reachable, so keep the engine
+        log.fatal("failed to create connection")
+        return engine
+    log.debug("connection success")
+    return engine
+
+def create_standin_connection(directory: str, pool_settings: dict) -> sa.Engine:
+    """Pooled engine for a local SQLite stand-in of the database, for development and load testing
+
+    Parameters:
+    directory (str): Directory holding one SQLite file per schema, created along with the tables when missing
+    pool_settings (dict): Same as create_connection
+    """
+    makedirs(directory, exist_ok=True)
+    engine = sa.create_engine(
+        "sqlite://",
+        poolclass=QueuePool,
+        connect_args={"check_same_thread": False, "timeout": 30},
+        **{key: value for key, value in pool_settings.items() if key != "pool_pre_ping"}
+    )
+
+    @sa.event.listens_for(engine, "connect")
+    def attach_schemas(dbapi_connection, _connection_record):
+        cursor = dbapi_connection.cursor()
+        for schema in STANDIN_SCHEMAS:
+            cursor.execute("ATTACH DATABASE ? AS ["+schema+"]", (path.join(directory, schema.lower()+".sqlite"),))
+            cursor.execute("PRAGMA ["+schema+"].journal_mode = WAL")
+        cursor.close()
+
+    with engine.connect() as conn:
+        conn.connection.executescript(STANDIN_TABLES)
+        conn.commit()
+    log.info("using the sqlite stand-in database in %s", directory)
+    return engine
+
+class Database:
+    """Pooled engine with a bounded thread pool, so async endpoints run their blocking db calls off the event loop
+
+    Parameters:
+    engine (sa.Engine): Engine from create_connection or create_standin_connection
+    threads (int): Amount of db calls that run at once, further calls queue for a thread
+    """
+    def __init__(self, engine: sa.Engine, threads: int):
+        self.engine = engine
+        self.standin = engine.dialect.name == "sqlite"
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="db")
+        self.threads = threads
+        # time spent waiting for a connection from the pool
+        self.wait = {"checkouts": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+        self.wait_lock = threading.Lock()
+
+    def record_pool_wait(self, seconds: float):
+        with self.wait_lock:
+            self.wait["checkouts"] += 1
+            self.wait["total_seconds"] += seconds
+            self.wait["max_seconds"] = max(self.wait["max_seconds"], seconds)
+
+    @contextmanager
+    def connect(self):
+        """Check a connection out of the pool, returned to the pool on exit"""
+        started = perf_counter()
+        conn = self.engine.connect()
+        self.record_pool_wait(perf_counter() - started)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def raw_connection(self):
+        """DBAPI connection from the pool, for calls sqlalchemy can not make. close() returns it to the pool"""
+        started = perf_counter()
+        conn = self.engine.raw_connection()
+        self.record_pool_wait(perf_counter() - started)
+        return conn
+
+    async def run(self, func, *args):
+        """Run a blocking function on the db thread pool and wait for it without blocking the event loop"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def pool_metrics(self) -> dict:
+        pool = self.engine.pool
+        with self.wait_lock:
+            checkouts = self.wait["checkouts"]
+            wait = {
+                "checkouts": checkouts,
+                "average_ms": round(self.wait["total_seconds"] / checkouts * 1000, 3) if checkouts > 0 else 0.0,
+                "max_ms": round(self.wait["max_seconds"] * 1000, 3)
+            }
+        return {
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            # sqlalchemy counts down from -size until the pool is full
+            "overflow": max(0, pool.overflow()),
+            "max_overflow": pool._max_overflow,
+            "threads": self.threads,
+            "queued": self.executor._work_queue.qsize(),
+            "wait": wait
+        }
+
+    def dispose(self):
+        self.executor.shutdown(wait=True)
+        self.engine.dispose()
+
+    #region Blocking queries, run through the thread pool by the async methods below
+    def fetch_user(self, username: str):
+        with self.connect() as conn:
+            sql = sa.text("SELECT [ID], [UID], [Username], [Password] FROM [Account].[User] WHERE [Username] = :param_username")
+            sql = sql.bindparams(param_username=username)
+            return conn.execute(sql).one_or_none()
+
+    def insert_user(self, username: str, password_hash: str):
+        with self.connect() as conn:
+            sql = sa.text("INSERT INTO [Account].[User]([Username], [Password]) VALUES(:param_username, :param_password)")
+            sql = sql.bindparams(param_username=username, param_password=password_hash)
+            conn.execute(sql)
+            conn.commit()
+
+    def exec_update_collection(self, user_id: int, json_str: str, applied: tuple[str, int] = None) -> int:
+        """Run [Collection].[UpdateMTGCollection], 1 when the changes were applied and 0 when a card does not exist
+
+        Parameters:
+        applied (tuple): (flush id, change index) of a write-behind flush, stored for the user in the same transaction as the changes
+        """
+        if self.standin:
+            return self.exec_update_collection_standin(user_id, json_str, applied)
+        conn = self.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("EXEC [Collection].[UpdateMTGCollection] ?, ?", (user_id, json_str))
+            result = cursor.fetchone()[0]
+            if result == 1 and applied is not None:
+                # pyodbc does not autocommit, the procedure's changes and this row commit together
+                cursor.execute("""
+                               UPDATE [Collection].[WriteBehindApplied] SET [FlushID] = ?, [Change] = ? WHERE [UserID] = ?;
+                               IF @@ROWCOUNT = 0 INSERT INTO [Collection].[WriteBehindApplied] ([UserID], [FlushID], [Change]) VALUES (?, ?, ?);
+                               """, (applied[0], applied[1], user_id, user_id, applied[0], applied[1]))
+            cursor.close()
+            conn.commit()
+        finally:
+            conn.close()
+        return result
+
+    def exec_update_collection_standin(self, user_id: int, json_str: str, applied: tuple[str, int] = None) -> int:
+        """Does what [Collection].[UpdateMTGCollection] does, returns 0 without changing anything when a card does not exist"""
+        ids = json.loads(json_str)["ids"]
+        with self.connect() as conn:
+            changes: dict[int, int] = {}
+            for set_code, source_id, change in ids:
+                sql = sa.text("""
+                              SELECT c.[id]
+                              FROM [MTG].[Card] AS c
+                              JOIN [MTG].[Set] AS s ON s.[id] = c.[card_set_id]
+                              WHERE c.[source_id] = :param_source_id AND s.[shorthand] = :param_set_code
+                              """)
+                card_id = conn.execute(sql.bindparams(param_source_id=source_id, param_set_code=set_code)).scalar_one_or_none()
+                if card_id is None:
+                    return 0
+                changes[card_id] = changes.get(card_id, 0) + change
+
+            for card_id, change in changes.items():
+                conn.execute(sa.text("""
+                                     INSERT INTO [Collection].[MTGCollection] ([UserID], [CardID], [Count]) VALUES (:param_user_id, :param_card_id, :param_change)
+                                     ON CONFLICT ([UserID], [CardID]) DO UPDATE SET [Count] = [Count] + excluded.[Count]
+                                     """).bindparams(param_user_id=user_id, param_card_id=card_id, param_change=change))
+            conn.execute(sa.text("DELETE FROM [Collection].[MTGCollection] WHERE [UserID] = :param_user_id AND [Count] <= 0").bindparams(param_user_id=user_id))
+            if applied is not None:
+                conn.execute(sa.text("""
+                                     INSERT INTO [Collection].[WriteBehindApplied] ([UserID], [FlushID], [Change]) VALUES (:param_user_id, :param_flush_id, :param_change)
+                                     ON CONFLICT ([UserID]) DO UPDATE SET [FlushID] = excluded.[FlushID], [Change] = excluded.[Change]
+                                     """).bindparams(param_user_id=user_id, param_flush_id=applied[0], param_change=applied[1]))
+            conn.commit()
+        return 1
+
+    def fetch_applied_changes(self, flush_id: str) -> dict[int, int]:
+        """Index of the last change each user had applied by the write-behind flush flush_id"""
+        with self.connect() as conn:
+            sql = sa.text("SELECT [UserID], [Change] FROM [Collection].[WriteBehindApplied] WHERE [FlushID] = :param_flush_id")
+            return dict(conn.execute(sql.bindparams(param_flush_id=flush_id)).all())
+
+    def fetch_collection_page(self, user_id: int, fields: list[str], after: tuple | None, limit: int, **filters) -> list[dict]:
+        sql = collection_page_query(user_id, fields, after, limit, **filters)
+        with self.connect() as conn:
+            return [dict(row) for row in conn.execute(sql).mappings()]
+
+    def iter_collection(self, user_id: int, fields: list[str], after: tuple | None, batch_size: int, **filters):
+        """Every row of a user's collection after after, in batches read from a server side cursor as they are iterated
+
+        Holds a pooled connection until the iteration finishes or the generator is closed
+        """
+        sql = collection_page_query(user_id, fields, after, None, **filters)
+        with self.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(sql).mappings()
+            for partition in result.partitions():
+                yield [dict(row) for row in partition]
+
+    def fetch_existing_cards(self, source_ids: list[str]) -> list[tuple[str, str]]:
+        """(set code, card id) of the cards in the db with one of source_ids"""
+        rows = []
+        with self.connect() as conn:
+            # in chunks, mssql takes at most 2100 parameters in a statement
+            for start in range(0, len(source_ids), 1000):
+                sql = (sa.select(SET.c.shorthand, CARD.c.source_id)
+                       .select_from(CARD.join(SET, SET.c.id == CARD.c.card_set_id))
+                       .where(CARD.c.source_id.in_(source_ids[start:start+1000])))
+                rows.extend(tuple(row) for row in conn.execute(sql))
+        return rows
+
+    def fetch_version(self) -> str:
+        with self.connect() as conn:
+            sql = "SELECT sqlite_version()" if self.standin else "SELECT @@VERSION"
+            return conn.execute(sa.text(sql)).scalar_one()
+    #endregion
+
+    async def get_user(self, username: str):
+        return await self.run(self.fetch_user, username)
+
+    async def create_user(self, username: str, password_hash: str):
+        await self.run(self.insert_user, username, password_hash)
+
+    async def update_collection(self, user_id: int, json_str: str) -> int:
+        return await self.run(self.exec_update_collection, user_id, json_str)
+
+    async def get_collection_page(self, user_id: int, fields: list[str], after: tuple | None, limit: int, **filters) -> list[dict]:
+        """One page of a user's collection, see collection_page_query for the parameters
+
+        Parameters:
+        filters: set_code, rarity, min_count and max_count
+        """
+        return await self.run(partial(self.fetch_collection_page, user_id, fields, after, limit, **filters))
+
+    async def get_existing_cards(self, source_ids: list[str]) -> list[tuple[str, str]]:
+        return await self.run(self.fetch_existing_cards, source_ids)
+
+    async def get_version(self) -> str:
+        return await self.run(self.fetch_version)
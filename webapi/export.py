@@ -0,0 +1,89 @@
+import csv
+import io
+import zlib
+from orjson import dumps
+try:
+    import brotli
+except ImportError:
+    # brotli is optional, exports are gzip compressed without it
+    brotli = None
+
+# Streaming collection exports. Rows come from the db a batch at a time, are encoded as CSV or NDJSON and go through an incremental
+# compressor, so an export of any size holds one batch in memory and its first bytes go out as soon as the first batch is read
+
+FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson"
+}
+# bytes of encoded rows the compressor may hold back before output is forced out
+FLUSH_BYTES = 256 * 1024
+
+def choose_encoding(accept_encoding: str | None) -> str | None:
+    """Best content encoding the client accepts, br when brotli is installed then gzip, None to send the export uncompressed"""
+    if accept_encoding is None:
+        return None
+    accepted = set()
+    for part in accept_encoding.split(","):
+        coding, *params = part.strip().lower().split(";")
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(coding.strip())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+def encode_rows(batches, fields: list[str], format: str):
+    """Encode batches of row dicts as CSV, with a header of fields, or as NDJSON, one chunk of bytes per batch"""
+    if format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(fields)
+        # the header goes out before the query has returned anything
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+        for batch in batches:
+            writer.writerows([[row[field] for field in fields] for row in batch])
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    else:
+        for batch in batches:
+            yield b"".join(dumps({field: row[field] for field in fields})+b"\n" for row in batch)
+
+def compress(chunks, encoding: str | None):
+    """Compress a stream of chunks as they come, without holding more than the compressor's window
+
+    The first chunk is flushed straight away so the client sees the export start, later output is flushed every FLUSH_BYTES of input
+    """
+    if encoding is None:
+        yield from chunks
+        return
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=5)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        # wbits 31 writes a gzip header and trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        process, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    held = 0
+    first = True
+    for chunk in chunks:
+        output = process(chunk)
+        held += len(chunk)
+        if first or held >= FLUSH_BYTES:
+            output += flush()
+            held = 0
+            first = False
+        if len(output) > 0:
+            yield output
+    yield finish()
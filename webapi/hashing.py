@@ -0,0 +1,58 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+
+class HashPoolSaturated(Exception):
+    """Raised instead of queueing when the hash pool already has its limit of work waiting"""
+
+class HashPool:
+    """Bounded thread pool for password hashing and verification, keeping the key derivation off the event loop
+
+    werkzeug's scrypt and pbkdf2 run in OpenSSL with the GIL released, so threads hash in parallel
+
+    Parameters:
+    workers (int): Hashes that run at once
+    max_queue (int): Hashes allowed to wait for a worker, more than this are rejected with HashPoolSaturated
+    """
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hash")
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+
+    async def run(self, func, *args):
+        with self.lock:
+            if self.in_flight >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise HashPoolSaturated()
+            self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                self.completed += 1
+
+    async def hash(self, password: str) -> str:
+        return await self.run(lambda: generate_password_hash(password=password, salt_length=16))
+
+    async def verify(self, password_hash: str, password: str) -> bool:
+        return await self.run(check_password_hash, password_hash, password)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "in_flight": self.in_flight,
+                "queued": max(0, self.in_flight - self.workers),
+                "completed": self.completed,
+                "rejected": self.rejected
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
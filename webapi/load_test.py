@@ -0,0 +1,157 @@
+import argparse
+import asyncio
+import random
+import subprocess
+import sys
+import tempfile
+import uuid
+import httpx
+import sqlalchemy as sa
+import db
+from os import environ, path
+from time import perf_counter, sleep
+from werkzeug.security import generate_password_hash
+from bench_login import percentile
+
+# Drives a mix of /token, /User/Create and /Collection/Update traffic and reports latency per endpoint
+# By default it starts the webapi itself against a freshly seeded stand-in database :
+#   python load_test.py --concurrency 32 --duration 30 --mix token=1,create=1,update=8
+# Pass --url to test an already running webapi instead, it then needs --standin pointing at the stand-in it uses
+# Admission control is off in the started webapi, --env ADMISSION_ENABLED=True tests with it
+
+WEBAPI_DIR = path.dirname(path.abspath(__file__))
+PASSWORD = "loadtestpassword"
+
+def parse_mix(mix: str) -> dict[str, int]:
+    weights = {}
+    for part in mix.split(","):
+        name, weight = part.split("=")
+        if name not in ["token", "create", "update"]:
+            raise ValueError("unknown endpoint in mix : "+name)
+        weights[name] = int(weight)
+    return weights
+
+def seed_standin(standin_path: str, users: int, sets: int, cards_per_set: int) -> tuple[list[str], list[tuple[str, str]]]:
+    """Create the stand-in tables and fill them with users, sets and cards to update collections with
+
+    Returns the usernames and the (set code, card id) pairs that exist
+    """
+    engine = db.create_standin_connection(standin_path, {})
+    password_hash = generate_password_hash(PASSWORD, salt_length=16)
+    usernames = ["loaduser"+str(i) for i in range(users)]
+    cards = [("ls"+str(s), "load-"+str(s)+"-"+str(c)) for s in range(sets) for c in range(cards_per_set)]
+    with engine.connect() as conn:
+        conn.execute(sa.text("DELETE FROM [Account].[User] WHERE [Username] LIKE 'loaduser%'"))
+        conn.execute(sa.text("INSERT INTO [Account].[User] ([Username], [Password]) VALUES (:username, :password)"),
+                     [{"username": username, "password": password_hash} for username in usernames])
+        for s in range(sets):
+            if conn.execute(sa.text("SELECT 1 FROM [MTG].[Set] WHERE [shorthand] = :code"), {"code": "ls"+str(s)}).one_or_none() is None:
+                conn.execute(sa.text("INSERT INTO [MTG].[Set] ([name], [shorthand]) VALUES (:code, :code)"), {"code": "ls"+str(s)})
+        conn.execute(sa.text("""
+                             INSERT OR IGNORE INTO [MTG].[Card] ([name], [card_set_id], [source_id])
+                             SELECT :source_id, [id], :source_id FROM [MTG].[Set] WHERE [shorthand] = :code
+                             """), [{"code": code, "source_id": source_id} for code, source_id in cards])
+        conn.commit()
+    engine.dispose()
+    return usernames, cards
+
+def start_webapi(standin_path: str, port: int, workers: int, env: dict) -> subprocess.Popen:
+    # a handful of users sending as fast as they can is what admission control turns away, leave it off unless asked for
+    process_env = {**environ, "ADMISSION_ENABLED": "False", **env, "DB_STANDIN_PATH": standin_path}
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+                               cwd=WEBAPI_DIR, env=process_env)
+    url = "http://127.0.0.1:"+str(port)
+    for _ in range(100):
+        try:
+            if httpx.get(url+"/Health/Pool").status_code == 200:
+                return process
+        except httpx.TransportError:
+            pass
+        if process.poll() is not None:
+            raise RuntimeError("webapi exited while starting")
+        sleep(0.1)
+    process.terminate()
+    raise RuntimeError("webapi did not start")
+
+async def get_tokens(client: httpx.AsyncClient, usernames: list[str]) -> list[str]:
+    tokens = []
+    for username in usernames:
+        response = await client.post("/token", data={"username": username, "password": PASSWORD})
+        response.raise_for_status()
+        tokens.append(response.json()["access_token"])
+    return tokens
+
+async def send(client: httpx.AsyncClient, name: str, args, usernames: list[str], tokens: list[str], cards: list):
+    if name == "token":
+        return await client.post("/token", data={"username": random.choice(usernames), "password": PASSWORD})
+    if name == "create":
+        return await client.post("/User/Create", json={"username": "load"+uuid.uuid4().hex, "password": PASSWORD})
+    ids = [[code, source_id, random.randint(-1, 3)] for code, source_id in random.sample(cards, args.update_size)]
+    return await client.patch("/Collection/Update", json={"ids": ids}, headers={"Authorization": "Bearer "+random.choice(tokens)})
+
+async def worker(client: httpx.AsyncClient, args, mix: dict[str, int], deadline: float, results: dict, usernames, tokens, cards):
+    names, weights = list(mix.keys()), list(mix.values())
+    while perf_counter() < deadline:
+        name = random.choices(names, weights)[0]
+        started = perf_counter()
+        try:
+            status = (await send(client, name, args, usernames, tokens, cards)).status_code
+        except httpx.TransportError as ex:
+            status = type(ex).__name__
+        results[name]["latency"].append(perf_counter() - started)
+        results[name]["status"][status] = results[name]["status"].get(status, 0) + 1
+
+def report(results: dict, duration: float):
+    print(f"{'endpoint':<10}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}  status codes")
+    for name, result in results.items():
+        latency = result["latency"]
+        statuses = ", ".join(f"{code}: {count}" for code, count in sorted(result["status"].items(), key=str))
+        print(f"{name:<10}{len(latency):>10}{len(latency) / duration:>10.1f}{percentile(latency, 50) * 1000:>10.1f}"
+              f"{percentile(latency, 95) * 1000:>10.1f}{percentile(latency, 99) * 1000:>10.1f}{max(latency, default=0) * 1000:>10.1f}  {statuses}")
+
+async def run(args, url: str, usernames: list[str], cards: list):
+    mix = parse_mix(args.mix)
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        tokens = await get_tokens(client, usernames[:args.token_users])
+        results = {name: {"latency": [], "status": {}} for name in mix}
+        started = perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(*[worker(client, args, mix, deadline, results, usernames, tokens, cards) for _ in range(args.concurrency)])
+        report(results, perf_counter() - started)
+        print("pool: "+str((await client.get("/Health/Pool")).json()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the webapi against a local stand-in database")
+    parser.add_argument("--url", help="test an already running webapi instead of starting one")
+    parser.add_argument("--standin", help="stand-in database directory, a temporary one is used when not given")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--concurrency", type=int, default=32, help="requests in flight at once")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to run for")
+    parser.add_argument("--mix", default="token=1,create=1,update=8", help="relative weight of each endpoint")
+    parser.add_argument("--users", type=int, default=50, help="users seeded into the stand-in")
+    parser.add_argument("--token-users", type=int, default=10, help="seeded users that send collection updates")
+    parser.add_argument("--sets", type=int, default=20)
+    parser.add_argument("--cards-per-set", type=int, default=250)
+    parser.add_argument("--update-size", type=int, default=20, help="cards in each collection update")
+    parser.add_argument("--env", action="append", default=[], help="NAME=VALUE setting for the started webapi, e.g. --env DB_POOL_SIZE=10")
+    args = parser.parse_args()
+
+    if args.url is not None and args.standin is None:
+        parser.error("--url needs --standin, to seed the database the webapi uses")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        standin_path = args.standin if args.standin is not None else temp_dir
+        usernames, cards = seed_standin(standin_path, args.users, args.sets, args.cards_per_set)
+        process = None
+        url = args.url
+        if url is None:
+            process = start_webapi(standin_path, args.port, args.workers, dict(setting.split("=", 1) for setting in args.env))
+            url = "http://127.0.0.1:"+str(args.port)
+        try:
+            asyncio.run(run(args, url, usernames, cards))
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
@@ -1,16 +1,28 @@
-import sqlalchemy as sa
 import logging as lo
 import datetime as dt
 import jwt
 import json
-from werkzeug.security import generate_password_hash, check_password_hash
+import hashlib
+import base64
+import db
+from shared_cache import SharedCache, MemoryCacheBackend, SQLiteCacheBackend, RedisCacheBackend
+from hashing import HashPool, HashPoolSaturated
+import collection_import as ci
+import export
+from catalogue import Catalogue
+from search import CardIndex
+from write_behind import WriteBehindQueue, JournalLockedError
+from admission import DEFAULT_LIMITS, AdmissionController, AdmissionMiddleware, MemoryBucketBackend, SQLiteBucketBackend
+from card_keys import CardKeyIndex, CardKeyError, normalise_key
+from responses import ORJSONResponse, RawJSONResponse, StreamingResponse, dumps
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-from fastapi import Depends, FastAPI, HTTPException, status
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
-from os import getenv, mkdir, path
+from os import getenv, mkdir, path, cpu_count
 from typing import Annotated
+from math import ceil
 from jwt.exceptions import InvalidTokenError
 
 APP_SETTINGS = {
@@ -48,6 +60,153 @@ def lifespan(app: FastAPI):
         print("something went wrong when getting env : "+str(ex))
         raise
 
+    try:
+        APP_SETTINGS["DB_POOL_SIZE"] = int(getenv("DB_POOL_SIZE"))
+    except:
+        APP_SETTINGS["DB_POOL_SIZE"] = 5
+
+    try:
+        APP_SETTINGS["DB_POOL_MAX_OVERFLOW"] = int(getenv("DB_POOL_MAX_OVERFLOW"))
+    except:
+        APP_SETTINGS["DB_POOL_MAX_OVERFLOW"] = 10
+
+    try:
+        APP_SETTINGS["DB_POOL_TIMEOUT"] = int(getenv("DB_POOL_TIMEOUT"))
+    except:
+        APP_SETTINGS["DB_POOL_TIMEOUT"] = 30
+
+    try:
+        APP_SETTINGS["DB_POOL_RECYCLE"] = int(getenv("DB_POOL_RECYCLE"))
+    except:
+        APP_SETTINGS["DB_POOL_RECYCLE"] = 1800
+
+    APP_SETTINGS["DB_POOL_PRE_PING"] = getenv("DB_POOL_PRE_PING", "True") == "True"
+
+    try:
+        APP_SETTINGS["DB_THREADS"] = int(getenv("DB_THREADS"))
+    except:
+        # one thread per connection the pool can hand out
+        APP_SETTINGS["DB_THREADS"] = APP_SETTINGS["DB_POOL_SIZE"] + APP_SETTINGS["DB_POOL_MAX_OVERFLOW"]
+
+    APP_SETTINGS["DB_STANDIN_PATH"] = getenv("DB_STANDIN_PATH")
+
+    try:
+        APP_SETTINGS["USER_CACHE_SIZE"] = int(getenv("USER_CACHE_SIZE"))
+    except:
+        APP_SETTINGS["USER_CACHE_SIZE"] = 1024
+
+    try:
+        APP_SETTINGS["USER_CACHE_TTL"] = int(getenv("USER_CACHE_TTL"))
+    except:
+        APP_SETTINGS["USER_CACHE_TTL"] = 60
+
+    try:
+        APP_SETTINGS["HASH_WORKERS"] = int(getenv("HASH_WORKERS"))
+    except:
+        APP_SETTINGS["HASH_WORKERS"] = cpu_count() or 1
+
+    try:
+        APP_SETTINGS["HASH_QUEUE_LIMIT"] = int(getenv("HASH_QUEUE_LIMIT"))
+    except:
+        APP_SETTINGS["HASH_QUEUE_LIMIT"] = APP_SETTINGS["HASH_WORKERS"] * 4
+
+    try:
+        APP_SETTINGS["HASH_RETRY_AFTER"] = int(getenv("HASH_RETRY_AFTER"))
+    except:
+        APP_SETTINGS["HASH_RETRY_AFTER"] = 1
+
+    try:
+        APP_SETTINGS["IMPORT_BATCH_SIZE"] = int(getenv("IMPORT_BATCH_SIZE"))
+    except:
+        APP_SETTINGS["IMPORT_BATCH_SIZE"] = 1000
+
+    try:
+        APP_SETTINGS["IMPORT_MAX_LINE"] = int(getenv("IMPORT_MAX_LINE"))
+    except:
+        APP_SETTINGS["IMPORT_MAX_LINE"] = 4096
+
+    try:
+        APP_SETTINGS["RESPONSE_CACHE_TTL"] = int(getenv("RESPONSE_CACHE_TTL"))
+    except:
+        APP_SETTINGS["RESPONSE_CACHE_TTL"] = 3600
+
+    # memory keeps the cache in each worker, sqlite shares it between the workers of a host and redis between hosts
+    APP_SETTINGS["SHARED_CACHE_BACKEND"] = getenv("SHARED_CACHE_BACKEND", "memory")
+    APP_SETTINGS["SHARED_CACHE_PATH"] = getenv("SHARED_CACHE_PATH", "shared_cache.sqlite")
+    APP_SETTINGS["SHARED_CACHE_URL"] = getenv("SHARED_CACHE_URL", "redis://localhost:6379/0")
+
+    try:
+        APP_SETTINGS["SHARED_CACHE_LOCAL_SIZE"] = int(getenv("SHARED_CACHE_LOCAL_SIZE"))
+    except:
+        APP_SETTINGS["SHARED_CACHE_LOCAL_SIZE"] = 1024
+
+    try:
+        APP_SETTINGS["SHARED_CACHE_LOCAL_TTL"] = float(getenv("SHARED_CACHE_LOCAL_TTL"))
+    except:
+        APP_SETTINGS["SHARED_CACHE_LOCAL_TTL"] = 5
+
+    try:
+        APP_SETTINGS["SHARED_CACHE_LOCK_SECONDS"] = float(getenv("SHARED_CACHE_LOCK_SECONDS"))
+    except:
+        APP_SETTINGS["SHARED_CACHE_LOCK_SECONDS"] = 5
+
+    APP_SETTINGS["CARD_SNAPSHOT_PATH"] = getenv("CARD_SNAPSHOT_PATH")
+
+    try:
+        APP_SETTINGS["CATALOGUE_POLL_SECONDS"] = int(getenv("CATALOGUE_POLL_SECONDS"))
+    except:
+        APP_SETTINGS["CATALOGUE_POLL_SECONDS"] = 30
+
+    try:
+        APP_SETTINGS["RESPONSE_CACHE_SIZE"] = int(getenv("RESPONSE_CACHE_SIZE"))
+    except:
+        APP_SETTINGS["RESPONSE_CACHE_SIZE"] = 2048
+
+    try:
+        APP_SETTINGS["CATALOGUE_MAX_AGE"] = int(getenv("CATALOGUE_MAX_AGE"))
+    except:
+        APP_SETTINGS["CATALOGUE_MAX_AGE"] = 60
+
+    try:
+        APP_SETTINGS["RESOLVE_MAX_IDENTIFIERS"] = int(getenv("RESOLVE_MAX_IDENTIFIERS"))
+    except:
+        APP_SETTINGS["RESOLVE_MAX_IDENTIFIERS"] = 5000
+
+    try:
+        APP_SETTINGS["EXPORT_BATCH_SIZE"] = int(getenv("EXPORT_BATCH_SIZE"))
+    except:
+        APP_SETTINGS["EXPORT_BATCH_SIZE"] = 1000
+
+    APP_SETTINGS["WRITE_BEHIND_JOURNAL"] = getenv("WRITE_BEHIND_JOURNAL")
+
+    try:
+        APP_SETTINGS["WRITE_BEHIND_SECONDS"] = float(getenv("WRITE_BEHIND_SECONDS"))
+    except:
+        APP_SETTINGS["WRITE_BEHIND_SECONDS"] = 2
+
+    try:
+        APP_SETTINGS["WRITE_BEHIND_MAX_CARDS"] = int(getenv("WRITE_BEHIND_MAX_CARDS"))
+    except:
+        APP_SETTINGS["WRITE_BEHIND_MAX_CARDS"] = 10000
+
+    APP_SETTINGS["WRITE_BEHIND_FSYNC"] = getenv("WRITE_BEHIND_FSYNC", "True") == "True"
+
+    APP_SETTINGS["ADMISSION_ENABLED"] = getenv("ADMISSION_ENABLED", "True") == "True"
+    # memory keeps the buckets per worker, sqlite shares them between the workers of a host through ADMISSION_SQLITE_PATH,
+    # no backend is shared between hosts and in flight limits are always per worker
+    APP_SETTINGS["ADMISSION_BACKEND"] = getenv("ADMISSION_BACKEND", "memory")
+    APP_SETTINGS["ADMISSION_SQLITE_PATH"] = getenv("ADMISSION_SQLITE_PATH", "admission.sqlite")
+
+    # ADMISSION_<CLASS>_<LIMIT>, e.g. ADMISSION_LOGIN_IP_RATE
+    APP_SETTINGS["ADMISSION_LIMITS"] = {}
+    for name, limits in DEFAULT_LIMITS.items():
+        APP_SETTINGS["ADMISSION_LIMITS"][name] = {}
+        for limit, default in limits.items():
+            try:
+                APP_SETTINGS["ADMISSION_LIMITS"][name][limit] = float(getenv("ADMISSION_"+name.upper()+"_"+limit.upper()))
+            except:
+                APP_SETTINGS["ADMISSION_LIMITS"][name][limit] = default
+
     if not path.isdir('logs'):
         mkdir('logs/')
 
@@ -58,9 +217,63 @@ def lifespan(app: FastAPI):
                     format='%(asctime)s | %(levelname)s | Line:%(lineno)s | %(message)s',
                     filemode='a'
                 )
+
+    # one pooled engine for the lifetime of the app, instead of a new engine per request
+    pool_settings = {
+        "pool_size": APP_SETTINGS["DB_POOL_SIZE"],
+        "max_overflow": APP_SETTINGS["DB_POOL_MAX_OVERFLOW"],
+        "pool_timeout": APP_SETTINGS["DB_POOL_TIMEOUT"],
+        "pool_recycle": APP_SETTINGS["DB_POOL_RECYCLE"],
+        "pool_pre_ping": APP_SETTINGS["DB_POOL_PRE_PING"]
+    }
+    if APP_SETTINGS["DB_STANDIN_PATH"] is not None:
+        engine = db.create_standin_connection(APP_SETTINGS["DB_STANDIN_PATH"], pool_settings)
+    else:
+        engine = db.create_connection(APP_SETTINGS["DB_NAME"], APP_SETTINGS["DB_LOCATION"], APP_SETTINGS["DB_DRIVER"], APP_SETTINGS["DB_USERNAME"], APP_SETTINGS["DB_PASSWORD"], pool_settings)
+    app.db = db.Database(engine, APP_SETTINGS["DB_THREADS"])
+    # users and serialised catalogue responses, shared by the workers unless the backend is memory
+    if APP_SETTINGS["SHARED_CACHE_BACKEND"] == "redis":
+        cache_backend = RedisCacheBackend(APP_SETTINGS["SHARED_CACHE_URL"])
+    elif APP_SETTINGS["SHARED_CACHE_BACKEND"] == "sqlite":
+        cache_backend = SQLiteCacheBackend(APP_SETTINGS["SHARED_CACHE_PATH"])
+    else:
+        cache_backend = MemoryCacheBackend(APP_SETTINGS["USER_CACHE_SIZE"] + APP_SETTINGS["RESPONSE_CACHE_SIZE"])
+    # a memory backend is already local, a second tier in front of it would only hold copies
+    local_size = APP_SETTINGS["SHARED_CACHE_LOCAL_SIZE"] if not isinstance(cache_backend, MemoryCacheBackend) else 0
+    app.cache = SharedCache(cache_backend, "webapi", local_size, APP_SETTINGS["SHARED_CACHE_LOCAL_TTL"], APP_SETTINGS["SHARED_CACHE_LOCK_SECONDS"])
+    app.hash_pool = HashPool(APP_SETTINGS["HASH_WORKERS"], APP_SETTINGS["HASH_QUEUE_LIMIT"])
+    # card search is served from the loader's snapshot, built in the background so startup does not wait on it
+    app.catalogue = None
+    if APP_SETTINGS["CARD_SNAPSHOT_PATH"] is not None:
+        app.catalogue = Catalogue(APP_SETTINGS["CARD_SNAPSHOT_PATH"], APP_SETTINGS["CATALOGUE_POLL_SECONDS"])
+        app.catalogue.start()
+    app.admission = None
+    if APP_SETTINGS["ADMISSION_ENABLED"]:
+        if APP_SETTINGS["ADMISSION_BACKEND"] == "sqlite":
+            backend = SQLiteBucketBackend(APP_SETTINGS["ADMISSION_SQLITE_PATH"])
+        else:
+            backend = MemoryBucketBackend()
+        app.admission = AdmissionController(backend, APP_SETTINGS["ADMISSION_LIMITS"])
+    # collection updates are journaled and applied in coalesced batches when a journal is set, otherwise each one goes to the db
+    app.write_behind = None
+    if APP_SETTINGS["WRITE_BEHIND_JOURNAL"] is not None:
+        try:
+            app.write_behind = WriteBehindQueue(app.db, APP_SETTINGS["WRITE_BEHIND_JOURNAL"], APP_SETTINGS["WRITE_BEHIND_SECONDS"],
+                                                APP_SETTINGS["WRITE_BEHIND_MAX_CARDS"], APP_SETTINGS["WRITE_BEHIND_FSYNC"])
+        except JournalLockedError:
+            # another worker has the journal, replaying it here as well would apply its changes twice
+            app.logger.fatal("collection journal %s is in use, run a single worker or leave WRITE_BEHIND_JOURNAL unset", APP_SETTINGS["WRITE_BEHIND_JOURNAL"])
+            raise
+        app.write_behind.start()
     yield
+    if app.catalogue is not None:
+        app.catalogue.stop()
+    if app.write_behind is not None:
+        app.write_behind.stop()
+    app.hash_pool.shutdown()
+    app.db.dispose()
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -77,44 +290,60 @@ class CreateUserItem(BaseModel):
     username: str
     password: str
 
+class CardIdentifier(BaseModel):
+    # Scryfall id, or set code and collector number
+    id: str | None = None
+    set: str | None = None
+    collector_number: str | None = None
+
+class ResolveItem(BaseModel):
+    identifiers: list[CardIdentifier]
+
+# what token auth needs of a user, the password hash is left out so it is never cached
 class User(BaseModel):
     id: int
     uid: str
     username: str
-    password: str
 #endregion
 
 #region Helpers
-def create_connection(db_name: str, db_location: str, db_driver: str, db_username: str, db_password: str) -> sa.Engine:
-    connection_url = sa.URL.create(
-        "mssql+pyodbc",
-        username=db_username,
-        password=db_password,
-        host=db_location,
-        database=db_name,
-        query={"driver": db_driver},
-    )
-    engine = sa.create_engine(connection_url)
-    app.logger.debug("testing db connection")
-    try:
-        with engine.connect() as conn:
-            conn.execute(sa.text("SELECT 1"))
-    except:
-        app.logger.fatal("failed to create connection")
+def load_user(username: str) -> bytes | None:
+    ret = app.db.fetch_user(username)
+    if ret is None:
         return None
-    app.logger.debug("connection success")
-    return engine
-
-def get_user(username: str) -> User | None:
-    engine: sa.Engine = create_connection(APP_SETTINGS["DB_NAME"], APP_SETTINGS["DB_LOCATION"], APP_SETTINGS["DB_DRIVER"], APP_SETTINGS["DB_USERNAME"], APP_SETTINGS["DB_PASSWORD"])
-    with engine.connect() as conn:
-        sql = sa.text("SELECT [ID], [UID], [Username], [Password] FROM [Account].[User] WHERE [Username] = :param_username")
-        sql = sql.bindparams(param_username=username)
-        ret = conn.execute(sql).one_or_none()
-        if ret is None:
-            return None
-        user = User(id=ret[0], uid=ret[1], username=ret[2], password=ret[3])
-    return user
+    return dumps(User(id=ret[0], uid=ret[1], username=ret[2]).model_dump())
+
+async def get_user(username: str) -> User | None:
+    # users are cached by username, so authenticated requests do not look the user up in the db every time
+    # the cache is shared with the other workers through its backend, which is why User holds no password hash
+    key = app.cache.key("user", username)
+    value = app.cache.peek(key)
+    if value is None:
+        # on a miss only one request across the workers reads the db, the others wait for its value
+        value = await app.db.run(app.cache.get_or_load, key, lambda: load_user(username), APP_SETTINGS["USER_CACHE_TTL"])
+    if value is None:
+        return None
+    return User.model_validate_json(value)
+
+def invalidate_user(username: str):
+    """Call after a user is created or changed, so the next lookup reads the db"""
+    app.cache.invalidate(app.cache.key("user", username))
+
+def current_card_keys() -> CardKeyIndex | None:
+    """Key index to check collection changes against before they reach the db, None when there is no catalogue to check with"""
+    return app.catalogue.keys if app.catalogue is not None else None
+
+async def find_unknown_cards(keys: CardKeyIndex, ids: list) -> list[dict]:
+    """keys.validate errors of the changes whose card is not in the db either
+
+    The key index is read from the snapshot, which lags behind the loader, so cards it does not have yet are looked up in the db before
+    they are turned away
+    """
+    errors = keys.validate(ids)
+    if len(errors) == 0:
+        return errors
+    found = {(normalise_key(set_code), normalise_key(source_id)) for set_code, source_id in await app.db.get_existing_cards([error["id"] for error in errors])}
+    return [error for error in errors if (normalise_key(error["set"]), normalise_key(error["id"])) not in found]
 
 #endregion
 
@@ -132,14 +361,30 @@ async def check_valid_access_token(token: Annotated[str, Depends(oauth2_scheme)]
             raise credentials_exception
     except InvalidTokenError:
         raise credentials_exception
-    user = get_user(username)
+    user = await get_user(username)
     if user is None:
         raise credentials_exception
     return user
 
-def get_password_hash(password):
-    hashed_password = generate_password_hash(password=password,salt_length=16)
-    return hashed_password
+def hash_pool_busy() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many logins in progress, try again shortly",
+        headers={"Retry-After": str(APP_SETTINGS["HASH_RETRY_AFTER"])}
+    )
+
+async def get_password_hash(password):
+    # hashing is deliberately slow, run it on the hash pool instead of the event loop
+    try:
+        return await app.hash_pool.hash(password)
+    except HashPoolSaturated:
+        raise hash_pool_busy()
+
+async def verify_password(password_hash: str, password: str) -> bool:
+    try:
+        return await app.hash_pool.verify(password_hash, password)
+    except HashPoolSaturated:
+        raise hash_pool_busy()
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
@@ -151,57 +396,278 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# endpoint classes admission control limits, everything else is let through
+ADMISSION_CLASSES = {
+    ("POST", "/token"): "login",
+    ("POST", "/User/Create"): "login",
+    ("PATCH", "/Collection/Update"): "write",
+    ("POST", "/Collection/Import"): "write",
+    ("GET", "/Collection"): "read",
+    ("GET", "/Collection/Export"): "export"
+}
+
+def admission_class(method: str, path: str) -> str | None:
+    return ADMISSION_CLASSES.get((method, path))
+
+def admission_user(headers: dict) -> str | None:
+    """Username of a request's valid access token, so its limits follow the user across IPs"""
+    authorization = headers.get("authorization", "")
+    if not authorization.startswith("Bearer "):
+        return None
+    try:
+        return jwt.decode(authorization[7:], SECRET_KEY, algorithms=[ALGORITHM]).get("sub::username")
+    except InvalidTokenError:
+        return None
+
+# login requests are limited per submitted username by check_login_rate, not by the token they might carry
+app.add_middleware(AdmissionMiddleware, classify=admission_class, identify=admission_user, body_users={"login"})
+
+async def check_login_rate(username: str):
+    """Take from the login bucket of the submitted username before its password is hashed, so guessing one user's password is
+    limited however many IPs it comes from"""
+    if app.admission is None:
+        return
+    retry_after = await app.admission.run(app.admission.admit_user, "login", username.strip().lower())
+    if retry_after > 0:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests, try again shortly",
+            headers={"Retry-After": str(max(1, ceil(retry_after)))}
+        )
+
 @app.post("/token")
 async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]) -> Token:
-    user = get_user(form_data.username)
+    await check_login_rate(form_data.username)
+    # the hash is read from the db on every login rather than from the user cache
+    user = await app.db.get_user(form_data.username)
 
     if user is None:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
-    if check_password_hash(user.password, form_data.password) == False:
+    if await verify_password(user.Password, form_data.password) == False:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
 
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
 
     access_token = create_access_token(
-        data={"sub::username": user.username}, expires_delta=access_token_expires
+        data={"sub::username": user.Username}, expires_delta=access_token_expires
     )
 
     return Token(access_token=access_token, token_type="bearer")
 #endregion
 
 @app.get("/")
-def read_root():
-    engine:sa.Engine = create_connection(APP_SETTINGS["DB_NAME"], APP_SETTINGS["DB_LOCATION"], APP_SETTINGS["DB_DRIVER"], APP_SETTINGS["DB_USERNAME"], APP_SETTINGS["DB_PASSWORD"])
-    with engine.connect() as conn:
-        sql = sa.text("SELECT @@VERSION")
-        data = conn.execute(sql).one_or_none()
-        return {"db_test": data[0]}
+async def read_root():
+    return {"db_test": await app.db.get_version()}
+
+@app.get("/Health/Pool")
+def read_pool_health():
+    return app.db.pool_metrics()
+
+@app.get("/Health/Cache")
+def read_cache_health():
+    return app.cache.stats()
+
+@app.get("/Health/Hash")
+def read_hash_health():
+    return app.hash_pool.stats()
+
+@app.get("/Health/Admission")
+def read_admission_health():
+    return app.admission.stats() if app.admission is not None else {"enabled": False}
+
+@app.get("/Health/WriteBehind")
+def read_write_behind_health():
+    return app.write_behind.stats() if app.write_behind is not None else {"enabled": False}
+
+async def get_card_index() -> CardIndex:
+    index = app.catalogue.index if app.catalogue is not None else None
+    if index is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Card index is not available yet", headers={"Retry-After": "5"})
+    return index
+
+async def get_card_keys() -> CardKeyIndex:
+    keys = app.catalogue.keys if app.catalogue is not None else None
+    if keys is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Card index is not available yet", headers={"Retry-After": "5"})
+    return keys
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in tags or "*" in tags
+
+def catalogue_response(request: Request, index: CardIndex, build) -> Response:
+    """Response for a catalogue read, with an ETag from the catalogue version
+
+    Answers If-None-Match with 304 and serves repeat requests from the shared cache, build is only called on a cache miss.
+    Waits while another worker builds the same response, so call it from a sync endpoint
+
+    Parameters:
+    index (CardIndex): Index the response is made from
+    build (Callable[[], dict]): Makes the response content
+    """
+    # the cache key and the ETag are both made from the version of the index the request holds, so a body built from one catalogue
+    # version is never cached or tagged as another, and responses of an old catalogue are never served and expire on their own
+    query = request.url.path+"?"+"&".join(sorted(str(request.query_params).split("&")))
+    key = app.cache.key("catalogue", query, version=index.version)
+    etag = '"'+hashlib.sha1(key.encode()).hexdigest()+'"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age="+str(APP_SETTINGS["CATALOGUE_MAX_AGE"])}
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    body = app.cache.get_or_load(key, lambda: dumps(build()), APP_SETTINGS["RESPONSE_CACHE_TTL"])
+    # cached bodies are already bytes, send them as they are
+    return RawJSONResponse(content=body, headers=headers)
+
+@app.get("/Cards/Search")
+def search_cards(
+    request: Request,
+    index: Annotated[CardIndex, Depends(get_card_index)],
+    name: str = None,
+    text: str = None,
+    type: str = None,
+    set: str = None,
+    rarity: str = None,
+    cmc: float = None,
+    cmc_min: float = None,
+    cmc_max: float = None,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+    offset: Annotated[int, Query(ge=0, le=10000)] = 0
+):
+    return catalogue_response(request, index, lambda: index.search(
+        name=name, text=text, type_line=type, set_code=set, rarity=rarity, cmc=cmc, cmc_min=cmc_min, cmc_max=cmc_max, limit=limit, offset=offset
+    ))
+
+@app.get("/Cards/Autocomplete")
+def autocomplete_cards(request: Request, index: Annotated[CardIndex, Depends(get_card_index)], q: str, limit: Annotated[int, Query(ge=1, le=25)] = 10):
+    return catalogue_response(request, index, lambda: {"version": index.version, "names": index.autocomplete(q, limit)})
+
+def encode_cursor(row: dict) -> str:
+    key = [row["key_set"], row["key_number"], row["key_id"]]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decode_cursor(cursor: str) -> tuple[str, str, int]:
+    try:
+        set_code, number, card_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(set_code, str) or not isinstance(number, str) or not isinstance(card_id, int):
+            raise ValueError()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return set_code, number, card_id
+
+@app.post("/Cards/Resolve")
+def resolve_cards(item: ResolveItem, keys: Annotated[CardKeyIndex, Depends(get_card_keys)]):
+    """Internal card ids, and the (set code, card id) pair /Collection/Update takes, for up to RESOLVE_MAX_IDENTIFIERS identifiers
+
+    Results are in the order of the identifiers, ones that do not match a single card have an error instead
+    """
+    if len(item.identifiers) > APP_SETTINGS["RESOLVE_MAX_IDENTIFIERS"]:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="At most "+str(APP_SETTINGS["RESOLVE_MAX_IDENTIFIERS"])+" identifiers per request")
+    results = []
+    resolved = 0
+    for identifier in item.identifiers:
+        try:
+            card_id, set_code, source_id = keys.resolve(identifier.id, identifier.set, identifier.collector_number)
+        except CardKeyError as ex:
+            results.append({"error": str(ex)})
+            continue
+        results.append({"card_id": card_id, "set": set_code, "id": source_id})
+        resolved += 1
+    return ORJSONResponse({"version": keys.version, "resolved": resolved, "unresolved": len(results) - resolved, "results": results})
+
+def collection_fields(fields: str | None) -> list[str]:
+    selected = list(db.COLLECTION_FIELDS) if fields is None else [field.strip() for field in fields.split(",") if field.strip() != ""]
+    unknown = [field for field in selected if field not in db.COLLECTION_FIELDS]
+    if len(unknown) > 0 or len(selected) == 0:
+        raise HTTPException(status_code=400, detail="Fields must be from "+", ".join(db.COLLECTION_FIELDS))
+    return selected
 
 @app.get("/Collection")
-def read_item(token: Annotated[User, Depends(oauth2_scheme)]):
-    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-    print(payload)
-    print(token)
-    return {
-        "one": payload.get("sub::username")
-    }
+async def read_collection(
+    token: Annotated[User, Depends(check_valid_access_token)],
+    fields: str = None,
+    set: str = None,
+    rarity: str = None,
+    min_count: Annotated[int, Query(ge=1)] = None,
+    max_count: Annotated[int, Query(ge=1)] = None,
+    limit: Annotated[int, Query(ge=1, le=500)] = 100,
+    after: str = None
+):
+    """Page of the user's collection ordered by set, collector number and card
+
+    Pass the returned next cursor as after to get the following page, next is None on the last page
+
+    Parameters:
+    fields (str): Comma separated fields to return, every field in db.COLLECTION_FIELDS when not given
+    """
+    selected = collection_fields(fields)
+    cursor = decode_cursor(after) if after is not None else None
+
+    # one row more than asked for tells whether there is a next page
+    rows = await app.db.get_collection_page(token.id, selected, cursor, limit + 1, set_code=set, rarity=rarity, min_count=min_count, max_count=max_count)
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    # the page is already in memory, one orjson encode of it beats streaming it in chunks
+    return ORJSONResponse({"next": next_cursor, "cards": [{field: row[field] for field in selected} for row in rows[:limit]]})
+
+@app.get("/Collection/Export")
+def export_collection(
+    request: Request,
+    token: Annotated[User, Depends(check_valid_access_token)],
+    format: Annotated[str, Query(pattern="^(csv|ndjson)$")] = "csv",
+    fields: str = None,
+    set: str = None,
+    rarity: str = None,
+    min_count: Annotated[int, Query(ge=1)] = None,
+    max_count: Annotated[int, Query(ge=1)] = None,
+    after: str = None
+):
+    """The user's whole collection as CSV or NDJSON, streamed from the db and compressed with br or gzip when the client accepts it
+
+    Every row ends with a cursor, pass the cursor of the last row received as after to carry on an export that was cut off
+
+    Parameters:
+    fields (str): Same as GET /Collection
+    """
+    selected = collection_fields(fields)
+    cursor = decode_cursor(after) if after is not None else None
+    batches = app.db.iter_collection(token.id, selected, cursor, APP_SETTINGS["EXPORT_BATCH_SIZE"], set_code=set, rarity=rarity, min_count=min_count, max_count=max_count)
+
+    def with_cursors():
+        for batch in batches:
+            for row in batch:
+                row["cursor"] = encode_cursor(row)
+            yield batch
+
+    encoding = export.choose_encoding(request.headers.get("accept-encoding"))
+    headers = {"Content-Disposition": "attachment; filename=collection."+format, "Vary": "Accept-Encoding"}
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    # a sync iterator is read on starlette's thread pool, so the blocking db reads stay off the event loop
+    chunks = export.compress(export.encode_rows(with_cursors(), selected + ["cursor"], format), encoding)
+    return StreamingResponse(chunks, media_type=export.FORMATS[format], headers=headers)
 
 @app.patch("/Collection/Update")
-def update_item(item: CollectionUpdateItem, token: Annotated[User, Depends(check_valid_access_token)]):
-    json_str = "{ \"ids\":"+json.dumps(item.ids)+"}"
+async def update_item(item: CollectionUpdateItem, token: Annotated[User, Depends(check_valid_access_token)]):
+    # the procedure does the whole update before reporting a missing card, turn those away before it runs
+    keys = current_card_keys()
+    if keys is not None:
+        errors = await find_unknown_cards(keys, item.ids)
+        if len(errors) > 0:
+            raise HTTPException(status_code=400, detail={"error": "Not all provided objects exist in tables", "items": errors[:ci.MAX_ERRORS_REPORTED]})
+
+    if app.write_behind is not None:
+        if keys is None:
+            # a queued change is acknowledged before the procedure runs, so it can only be queued once it has been checked
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Card index is not available yet", headers={"Retry-After": "5"})
+        # applied within WRITE_BEHIND_SECONDS, so reads of the collection can lag behind for that long
+        await app.write_behind.add(token.id, item.ids)
+        return ORJSONResponse({"success": True, "queued": True}, status_code=status.HTTP_202_ACCEPTED)
 
-    engine:sa.Engine = create_connection(APP_SETTINGS["DB_NAME"], APP_SETTINGS["DB_LOCATION"], APP_SETTINGS["DB_DRIVER"], APP_SETTINGS["DB_USERNAME"], APP_SETTINGS["DB_PASSWORD"])
-    conn = engine.raw_connection()
-    cursor = conn.cursor()
+    json_str = "{ \"ids\":"+json.dumps(item.ids)+"}"
 
-    sql = sa.text("[Collection].[UpdateMTGCollection] :param_id, :param_json")
-    sql = sql.bindparams(param_id=token.id, param_json=json_str)    
-    
-    cursor.execute("EXEC [Collection].[UpdateMTGCollection] ?, ?", (token.id, json_str))
-    result = cursor.fetchone()[0]
-    cursor.close() 
-    conn.commit()
-    conn.close()
+    result = await app.db.update_collection(token.id, json_str)
 
     if result == 1:
         return {"success": True}
@@ -212,25 +678,95 @@ def update_item(item: CollectionUpdateItem, token: Annotated[User, Depends(check
 
 
 @app.post("/User/Create")
-def create_user(item: CreateUserItem):
+async def create_user(item: CreateUserItem):
     if len(item.username) < APP_SETTINGS["USERNAME_MINIMUM_LENGTH"]:
         raise HTTPException(status_code=400, detail="Username did not comply with the minimum length of "+str(APP_SETTINGS["USERNAME_MINIMUM_LENGTH"]))
     if len(item.password) < APP_SETTINGS["PASSWORD_MINIMUM_LENGTH"]:
         raise HTTPException(status_code=400, detail="Username did not comply with the minimum length of "+str(APP_SETTINGS["PASSWORD_MINIMUM_LENGTH"]))
-    if get_user(item.username) is not None:
+    if await get_user(item.username) is not None:
         raise HTTPException(status_code=400, detail="Username is taken")    
 
     success: bool = False
 
-    password_hash = get_password_hash(item.password)
-    engine:sa.Engine = create_connection(APP_SETTINGS["DB_NAME"], APP_SETTINGS["DB_LOCATION"], APP_SETTINGS["DB_DRIVER"], APP_SETTINGS["DB_USERNAME"], APP_SETTINGS["DB_PASSWORD"])
+    password_hash = await get_password_hash(item.password)
     try:
-        with engine.connect() as conn:
-            sql = sa.text("INSERT INTO [Account].[User]([Username], [Password]) VALUES(:param_username, :param_password)")
-            sql = sql.bindparams(param_username=item.username, param_password=password_hash.upper())
-            conn.execute(sql)
-            conn.commit()
+        await app.db.create_user(item.username, password_hash.upper())
         success = True
     except:
         success = False
+    finally:
+        invalidate_user(item.username)
     return {"success": success}
+
+@app.post("/Collection/Import")
+async def import_collection(request: Request, token: Annotated[User, Depends(check_valid_access_token)]):
+    """Apply a collection import streamed as NDJSON or CSV rows of set code, card id and amount
+
+    Rows are applied in batches of IMPORT_BATCH_SIZE distinct cards as the body arrives. Rows for cards not in the catalogue or the db are reported as
+    invalid and left out, without a catalogue a batch with a card that does not exist is not applied
+    """
+    format = ci.get_format(request.headers.get("content-type"))
+    if format is None:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Send rows as application/x-ndjson or text/csv")
+
+    batcher = ci.ImportBatcher(APP_SETTINGS["IMPORT_BATCH_SIZE"])
+    keys = current_card_keys()
+    batches: list[dict] = []
+    errors: list[dict] = []
+    summary = {"rows": 0, "invalid_rows": 0, "applied_rows": 0, "failed_rows": 0}
+
+    async def apply_batch():
+        ids, rows = batcher.take()
+        if rows == 0:
+            return
+        success = True
+        if len(ids) > 0:
+            json_str = "{ \"ids\":"+json.dumps(ids)+"}"
+            success = await app.db.update_collection(token.id, json_str) == 1
+        batches.append({"batch": len(batches) + 1, "rows": rows, "cards": len(ids), "success": success})
+        summary["applied_rows" if success else "failed_rows"] += rows
+        app.logger.info("import for user %s, batch %s of %s rows %s", token.id, len(batches), rows, "applied" if success else "failed")
+
+    # db answers for cards the key index does not have, so each one is looked up once per import
+    unknown_cards: dict[tuple[str, str], str | None] = {}
+
+    async def check_unknown_card(row: tuple) -> str | None:
+        key = (normalise_key(row[0]), normalise_key(row[1]))
+        if key not in unknown_cards:
+            errors = await find_unknown_cards(keys, [row])
+            unknown_cards[key] = errors[0]["error"] if len(errors) > 0 else None
+        return unknown_cards[key]
+
+    line_number = 0
+    try:
+        async for line in ci.iter_lines(request.stream(), APP_SETTINGS["IMPORT_MAX_LINE"]):
+            line_number += 1
+            try:
+                row = ci.parse_row(line.decode("utf-8-sig" if line_number == 1 else "utf-8"), format)
+                # a row for a card that does not exist would fail its whole batch in the db, reject just the row
+                error = keys.check(row[0], row[1]) if keys is not None and row is not None else None
+                if error is not None:
+                    error = await check_unknown_card(row)
+                if error is not None:
+                    raise ci.ImportRowError(error)
+            except (ci.ImportRowError, UnicodeDecodeError) as ex:
+                summary["invalid_rows"] += 1
+                if len(errors) < ci.MAX_ERRORS_REPORTED:
+                    errors.append({"line": line_number, "error": str(ex)})
+                continue
+            if row is None:
+                continue
+            summary["rows"] += 1
+            if batcher.add(*row):
+                await apply_batch()
+        await apply_batch()
+    except ci.ImportRowError as ex:
+        # only raised for a line too long to buffer, batches before it stay applied
+        raise HTTPException(status_code=400, detail={"error": "line "+str(line_number + 1)+" : "+str(ex), **summary, "batches": batches})
+
+    return {
+        "success": summary["invalid_rows"] == 0 and summary["failed_rows"] == 0,
+        **summary,
+        "batches": batches,
+        "errors": errors
+    }
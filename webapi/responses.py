@@ -0,0 +1,12 @@
+import orjson
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+
+# Response classes for the webapi. orjson encodes straight to bytes several times faster than the stdlib json FastAPI uses by default,
+# ORJSONResponse is the app's default response class and large bodies skip the encoder altogether
+
+def dumps(content) -> bytes:
+    return orjson.dumps(content)
+
+class RawJSONResponse(Response):
+    """Response for JSON that is already serialised, e.g. bytes from a cache, sent as is without being decoded and encoded again"""
+    media_type = "application/json"
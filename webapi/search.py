@@ -0,0 +1,191 @@
+import re
+import unicodedata
+from bisect import bisect_left
+from math import floor
+
+# In-memory card search index. Cards are numbered in name order and every filter is a python int used as a bitmap of card numbers,
+# so combining filters is a handful of big int ANDs and results come out already sorted by name
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+RESULT_FIELDS = ["source_id", "name", "set_code", "set_name", "collector_number", "rarity", "mana_cost", "converted_cost", "type_line", "image"]
+
+def normalise(text: str) -> str:
+    """Lowercase and strip accents, so "Lim-Dûl" matches "lim-dul" """
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+def tokenise(text: str | None) -> list[str]:
+    if text is None:
+        return []
+    return TOKEN_PATTERN.findall(normalise(text))
+
+def trigrams(text: str) -> set[str]:
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+def to_bitmap(numbers: list[int]) -> int:
+    if len(numbers) < 64:
+        bitmap = 0
+        for number in numbers:
+            bitmap |= 1 << number
+        return bitmap
+    # setting bits one at a time copies the whole int each time, build large bitmaps as bytes instead
+    bits = bytearray(max(numbers) // 8 + 1)
+    for number in numbers:
+        bits[number >> 3] |= 1 << (number & 7)
+    return int.from_bytes(bits, "little")
+
+def range_bitmap(start: int, end: int) -> int:
+    """Bitmap with the bits from start up to end set"""
+    return ((1 << end) - 1) ^ ((1 << start) - 1)
+
+def ranges_bitmap(ranges: list[tuple[int, int]], size: int) -> int:
+    """Bitmap of many ranges, built as a string of digits in one go instead of one big int per range"""
+    digits = bytearray(b"0") * size
+    for start, end in ranges:
+        digits[start:end] = b"1" * (end - start)
+    digits.reverse()
+    return int(digits, 2) if size > 0 else 0
+
+def iter_bits(bitmap: int):
+    # clearing bits one at a time copies the int each time, finding them in its binary string does not
+    digits = bin(bitmap)[:1:-1]
+    position = digits.find("1")
+    while position != -1:
+        yield position
+        position = digits.find("1", position + 1)
+
+class CardIndex:
+    """Immutable search index over a list of cards, a new index is built and swapped in when the cards change
+
+    Parameters:
+    cards (list[dict]): Cards with RESULT_FIELDS, plus text (oracle text of the card and its faces) and face_names
+    version (str): Catalogue version the cards were read at
+    """
+    def __init__(self, cards: list[dict], version: str):
+        self.version = version
+        for card in cards:
+            card["search_name"] = normalise(card["name"] or "")
+        cards.sort(key=lambda card: (card["search_name"], card["set_code"] or "", card["collector_number"] or ""))
+        self.cards = [{field: card[field] for field in RESULT_FIELDS} for card in cards]
+        self.all = range_bitmap(0, len(cards))
+
+        # cards are in name order, so each distinct name is a contiguous range of card numbers
+        self.names: list[str] = []
+        self.display_names: list[str] = []
+        self.name_starts: list[int] = []
+        for number, card in enumerate(cards):
+            if len(self.names) == 0 or self.names[-1] != card["search_name"]:
+                self.names.append(card["search_name"])
+                self.display_names.append(card["name"])
+                self.name_starts.append(number)
+        self.name_starts.append(len(cards))
+
+        name_trigrams: dict[str, list[int]] = {}
+        for name_number, name in enumerate(self.names):
+            for trigram in trigrams(name):
+                name_trigrams.setdefault(trigram, []).append(name_number)
+        self.trigrams = {trigram: to_bitmap(numbers) for trigram, numbers in name_trigrams.items()}
+
+        words: dict[str, list[int]] = {}
+        types: dict[str, list[int]] = {}
+        sets: dict[str, list[int]] = {}
+        rarities: dict[str, list[int]] = {}
+        costs: dict[int, list[int]] = {}
+        for number, card in enumerate(cards):
+            for word in set(tokenise(card["text"])) | set(tokenise(" ".join(card["face_names"]))):
+                words.setdefault(word, []).append(number)
+            for type_name in set(tokenise(card["type_line"])):
+                types.setdefault(type_name, []).append(number)
+            if card["set_code"] is not None:
+                sets.setdefault(card["set_code"].lower(), []).append(number)
+            if card["rarity"] is not None:
+                rarities.setdefault(card["rarity"].lower(), []).append(number)
+            if card["converted_cost"] is not None:
+                costs.setdefault(floor(card["converted_cost"]), []).append(number)
+        self.words = {word: to_bitmap(numbers) for word, numbers in words.items()}
+        self.types = {type_name: to_bitmap(numbers) for type_name, numbers in types.items()}
+        self.sets = {code: to_bitmap(numbers) for code, numbers in sets.items()}
+        self.rarities = {rarity: to_bitmap(numbers) for rarity, numbers in rarities.items()}
+        self.costs = {cost: to_bitmap(numbers) for cost, numbers in costs.items()}
+
+    def prefix_names(self, query: str) -> range:
+        """Range of name numbers starting with query"""
+        start = bisect_left(self.names, query)
+        end = bisect_left(self.names, query+"\uffff", start)
+        return range(start, end)
+
+    def contains_names(self, query: str, limit: int = None) -> list[int]:
+        """Name numbers containing query, query needs at least 3 characters
+
+        Parameters:
+        limit (int): Stop after this many names, all of them when None
+        """
+        candidates = self.all
+        for trigram in trigrams(query):
+            candidates &= self.trigrams.get(trigram, 0)
+        found = []
+        for number in iter_bits(candidates):
+            if query in self.names[number]:
+                found.append(number)
+                if limit is not None and len(found) >= limit:
+                    break
+        return found
+
+    def name_bitmap(self, query: str) -> int:
+        query = normalise(query)
+        names = self.prefix_names(query)
+        ranges = [(self.name_starts[names.start], self.name_starts[names.stop])] if len(names) > 0 else []
+        if len(query) >= 3:
+            ranges += [(self.name_starts[number], self.name_starts[number + 1]) for number in self.contains_names(query)]
+        return ranges_bitmap(ranges, len(self.cards))
+
+    def autocomplete(self, query: str, limit: int = 10) -> list[str]:
+        """Distinct card names starting with query, then names containing it"""
+        query = normalise(query)
+        if query == "":
+            return []
+        names = self.prefix_names(query)
+        found = list(names[:limit])
+        if len(found) < limit and len(query) >= 3:
+            # prefix matches also contain the query, ask for enough to skip past them
+            found += [number for number in self.contains_names(query, limit + len(found)) if number not in names][:limit - len(found)]
+        return [self.display_names[number] for number in found]
+
+    def search(self, name: str = None, text: str = None, type_line: str = None, set_code: str = None, rarity: str = None,
+               cmc: float = None, cmc_min: float = None, cmc_max: float = None, limit: int = 20, offset: int = 0) -> dict:
+        """Cards matching every given filter, in name order
+
+        Parameters:
+        name (str): Name starts with, or contains when 3 or more characters
+        text (str): Every word appears in the oracle text or face names
+        type_line (str): Every word appears in the type line
+        """
+        bitmap = self.all
+        if name:
+            bitmap &= self.name_bitmap(name)
+        for word in tokenise(text):
+            bitmap &= self.words.get(word, 0)
+        for type_name in tokenise(type_line):
+            bitmap &= self.types.get(type_name, 0)
+        if set_code:
+            bitmap &= self.sets.get(set_code.lower(), 0)
+        if rarity:
+            bitmap &= self.rarities.get(rarity.lower(), 0)
+        if cmc is not None:
+            bitmap &= self.costs.get(floor(cmc), 0)
+        if cmc_min is not None or cmc_max is not None:
+            low = floor(cmc_min) if cmc_min is not None else None
+            high = floor(cmc_max) if cmc_max is not None else None
+            cost_bitmap = 0
+            for cost, cost_cards in self.costs.items():
+                if (low is None or cost >= low) and (high is None or cost <= high):
+                    cost_bitmap |= cost_cards
+            bitmap &= cost_bitmap
+
+        cards = []
+        for position, number in enumerate(iter_bits(bitmap)):
+            if position >= offset + limit:
+                break
+            if position >= offset:
+                cards.append(self.cards[number])
+        return {"version": self.version, "total": bitmap.bit_count(), "cards": cards}
@@ -0,0 +1,288 @@
+import sqlite3
+import threading
+import logging as lo
+from collections import OrderedDict
+from time import monotonic, sleep, time
+from cache import TTLCache
+log = lo.getLogger(__name__)
+
+# Cache shared by every worker process, so a value is loaded once for all of them instead of once per worker
+#
+# SharedCache keeps a small short lived local tier in front of a backend holding bytes :
+#   MemoryCacheBackend  in this process only, what a single worker needs
+#   SQLiteCacheBackend  a file shared by the workers of one host, also the stand-in for a networked backend in development and tests
+#   RedisCacheBackend   shared by every host
+# A backend needs get, set, add (set only when missing, used as the cross worker lock), delete and stats, any other store can be dropped in
+# Values of changing data are keyed by the version they were made from (see SharedCache.key), so a new version never reads old values
+# Anything that can reach the SQLite file or Redis can read every value, so credentials and password hashes are never cached here
+
+class MemoryCacheBackend:
+    """Entries in this process, expired by their own ttl and the least recently used dropped past max_size
+
+    Parameters:
+    max_size (int): Most entries held at once
+    """
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self.entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> bytes | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value: bytes, ttl: float):
+        with self.lock:
+            self.entries[key] = (monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def add(self, key: str, value: bytes, ttl: float) -> bool:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > monotonic():
+                return False
+            self.entries[key] = (monotonic() + ttl, value)
+            return True
+
+    def delete(self, key: str):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"backend": "memory", "size": len(self.entries), "max_size": self.max_size}
+
+class SQLiteCacheBackend:
+    """Entries in a SQLite file shared by the workers of one host
+
+    Parameters:
+    file_name (str): Location of the SQLite file, created when missing
+    timeout (float): Seconds to wait for another worker's write to the file
+    """
+    def __init__(self, file_name: str, timeout: float = 1):
+        self.file_name = file_name
+        self.timeout = timeout
+        self.local = threading.local()
+        self.writes = 0
+        self.lock = threading.Lock()
+        conn = self.connect()
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS [entry] ([key] TEXT PRIMARY KEY, [value] BLOB NOT NULL, [expires] REAL NOT NULL) WITHOUT ROWID")
+        conn.execute("CREATE INDEX IF NOT EXISTS [entry_expires] ON [entry] ([expires])")
+
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.file_name, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def purge_expired(self, conn: sqlite3.Connection):
+        # the file is only kept in check by expiry, clear it out every so many writes
+        with self.lock:
+            self.writes += 1
+            purge = self.writes % 1000 == 0
+        if purge:
+            conn.execute("DELETE FROM [entry] WHERE [expires] <= ?", (time(),))
+
+    def get(self, key: str) -> bytes | None:
+        row = self.connect().execute("SELECT [value] FROM [entry] WHERE [key] = ? AND [expires] > ?", (key, time())).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, key: str, value: bytes, ttl: float):
+        conn = self.connect()
+        conn.execute("INSERT OR REPLACE INTO [entry] ([key], [value], [expires]) VALUES (?, ?, ?)", (key, value, time() + ttl))
+        self.purge_expired(conn)
+
+    def add(self, key: str, value: bytes, ttl: float) -> bool:
+        now = time()
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM [entry] WHERE [key] = ? AND [expires] <= ?", (key, now))
+            added = conn.execute("INSERT OR IGNORE INTO [entry] ([key], [value], [expires]) VALUES (?, ?, ?)", (key, value, now + ttl)).rowcount == 1
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        return added
+
+    def delete(self, key: str):
+        self.connect().execute("DELETE FROM [entry] WHERE [key] = ?", (key,))
+
+    def stats(self) -> dict:
+        row = self.connect().execute("SELECT COUNT(*) FROM [entry] WHERE [expires] > ?", (time(),)).fetchone()
+        return {"backend": "sqlite", "file_name": self.file_name, "size": row[0]}
+
+class RedisCacheBackend:
+    """Entries in redis, shared by every host
+
+    Parameters:
+    url (str): Redis url, e.g. redis://cache:6379/0
+    """
+    def __init__(self, url: str):
+        import redis
+        self.url = url
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> bytes | None:
+        return self.client.get(key)
+
+    def set(self, key: str, value: bytes, ttl: float):
+        self.client.set(key, value, px=max(1, int(ttl * 1000)))
+
+    def add(self, key: str, value: bytes, ttl: float) -> bool:
+        return bool(self.client.set(key, value, px=max(1, int(ttl * 1000)), nx=True))
+
+    def delete(self, key: str):
+        self.client.delete(key)
+
+    def stats(self) -> dict:
+        return {"backend": "redis", "url": self.url.split("@")[-1], "size": self.client.dbsize()}
+
+class SharedCache:
+    """Two tier cache with single flight loading, of the workers asking for a missing key only one loads it and the rest wait for its value
+
+    A backend that fails is treated as a miss and the value is loaded, the cache never takes the endpoint down with it
+
+    Parameters:
+    backend (MemoryCacheBackend | SQLiteCacheBackend | RedisCacheBackend): Where shared values are kept
+    namespace (str): Prefix of every key, so several apps can share a backend
+    local_size (int): Entries in the local tier, 0 for none
+    local_ttl (float): Seconds a value is served from the local tier without asking the backend
+    lock_seconds (float): Most seconds a worker waits on another worker's load before loading the value itself
+    """
+    def __init__(self, backend, namespace: str = "webapi", local_size: int = 1024, local_ttl: float = 5, lock_seconds: float = 5):
+        self.backend = backend
+        self.namespace = namespace
+        self.local = TTLCache(local_size, local_ttl) if local_size > 0 else None
+        self.lock_seconds = lock_seconds
+        self.lock = threading.Lock()
+        self.loading: dict[str, threading.Event] = {}
+        self.counts = {"local_hits": 0, "shared_hits": 0, "misses": 0, "loads": 0, "waits": 0, "backend_errors": 0}
+
+    def key(self, *parts, version: str = None) -> str:
+        """Backend key of parts, with the version of the data the value is made from when it changes with it"""
+        return ":".join([self.namespace] + ([] if version is None else ["v"+str(version)]) + [str(part) for part in parts])
+
+    def count(self, name: str):
+        with self.lock:
+            self.counts[name] += 1
+
+    def backend_call(self, func, *args):
+        try:
+            return func(*args)
+        except Exception as ex:
+            self.count("backend_errors")
+            log.warning("shared cache backend call %s failed : %s", func.__name__, ex)
+            return None
+
+    def peek(self, key: str) -> bytes | None:
+        """Value from the local tier, or from a memory backend, without waiting on anything"""
+        value = self.local.get(key) if self.local is not None else None
+        if value is None and isinstance(self.backend, MemoryCacheBackend):
+            value = self.backend.get(key)
+        if value is not None:
+            self.count("local_hits")
+        return value
+
+    def get(self, key: str) -> bytes | None:
+        value = self.local.get(key) if self.local is not None else None
+        if value is not None:
+            self.count("local_hits")
+            return value
+        value = self.backend_call(self.backend.get, key)
+        if value is not None:
+            self.count("shared_hits")
+            if self.local is not None:
+                self.local.set(key, value)
+        return value
+
+    def set(self, key: str, value: bytes, ttl: float):
+        self.backend_call(self.backend.set, key, value, ttl)
+        if self.local is not None:
+            self.local.set(key, value)
+
+    def invalidate(self, key: str):
+        """Drop a key everywhere, other workers' local tiers keep serving it for up to local_ttl"""
+        self.backend_call(self.backend.delete, key)
+        if self.local is not None:
+            self.local.invalidate(key)
+
+    def get_or_load(self, key: str, load, ttl: float) -> bytes | None:
+        """Cached value of key, loaded with load when missing, blocks while another thread or worker loads it
+
+        Parameters:
+        load (Callable[[], bytes | None]): Makes the value, None is returned without being cached
+        ttl (float): Seconds the loaded value is kept in the backend
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        # single flight within the process, the first thread loads and the rest wait on its event
+        with self.lock:
+            event = self.loading.get(key)
+            leader = event is None
+            if leader:
+                event = self.loading[key] = threading.Event()
+        if not leader:
+            self.count("waits")
+            event.wait(self.lock_seconds)
+            value = self.get(key)
+            if value is not None:
+                return value
+            self.count("misses")
+            return load()
+
+        try:
+            self.count("misses")
+            return self.load_once(key, load, ttl)
+        finally:
+            with self.lock:
+                del self.loading[key]
+            event.set()
+
+    def load_once(self, key: str, load, ttl: float) -> bytes | None:
+        # single flight between workers, the worker that adds the lock key loads and the rest poll for its value
+        lock_key = key+":loading"
+        # a failing backend gives None, load as if the lock was taken
+        locked = self.backend_call(self.backend.add, lock_key, b"1", self.lock_seconds) is not False
+        if not locked:
+            self.count("waits")
+            deadline = monotonic() + self.lock_seconds
+            while monotonic() < deadline:
+                sleep(0.01)
+                value = self.get(key)
+                if value is not None:
+                    return value
+        try:
+            self.count("loads")
+            value = load()
+            if value is not None:
+                self.set(key, value, ttl)
+            return value
+        finally:
+            if locked:
+                self.backend_call(self.backend.delete, lock_key)
+
+    def stats(self) -> dict:
+        with self.lock:
+            counts = dict(self.counts)
+        lookups = counts["local_hits"] + counts["shared_hits"] + counts["misses"]
+        return {
+            **counts,
+            "hit_ratio": round((counts["local_hits"] + counts["shared_hits"]) / lookups, 4) if lookups > 0 else 0.0,
+            "local": self.local.stats() if self.local is not None else None,
+            "backend": self.backend_call(self.backend.stats)
+        }
@@ -0,0 +1,30 @@
+-- Collection tables on the TCGCT SQL Server database, the SQLite stand-in creates the same tables from db.STANDIN_TABLES
+-- [Collection].[UpdateMTGCollection] writes [MTGCollection], GET /Collection and /Collection/Export read it through db.collection_page_query
+
+IF SCHEMA_ID(N'Collection') IS NULL
+    EXEC(N'CREATE SCHEMA [Collection]');
+GO
+
+-- One row per card a user owns, rows whose count reaches 0 are deleted
+IF OBJECT_ID(N'[Collection].[MTGCollection]', N'U') IS NULL
+CREATE TABLE [Collection].[MTGCollection] (
+    [UserID] INT NOT NULL,
+    [CardID] INT NOT NULL,
+    [Count] INT NOT NULL,
+    CONSTRAINT [PK_MTGCollection] PRIMARY KEY CLUSTERED ([UserID], [CardID]),
+    CONSTRAINT [FK_MTGCollection_User] FOREIGN KEY ([UserID]) REFERENCES [Account].[User] ([ID]),
+    CONSTRAINT [FK_MTGCollection_Card] FOREIGN KEY ([CardID]) REFERENCES [MTG].[Card] ([id])
+);
+GO
+
+-- The last change each user had applied by a write-behind flush, written in the same transaction as the changes so a flush cut short
+-- by a crash is not applied twice (see write_behind.py). One row per user
+IF OBJECT_ID(N'[Collection].[WriteBehindApplied]', N'U') IS NULL
+CREATE TABLE [Collection].[WriteBehindApplied] (
+    [UserID] INT NOT NULL,
+    [FlushID] CHAR(32) NOT NULL,
+    [Change] INT NOT NULL,
+    CONSTRAINT [PK_WriteBehindApplied] PRIMARY KEY CLUSTERED ([UserID]),
+    CONSTRAINT [FK_WriteBehindApplied_User] FOREIGN KEY ([UserID]) REFERENCES [Account].[User] ([ID])
+);
+GO
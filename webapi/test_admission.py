@@ -0,0 +1,149 @@
+import unittest
+import logging
+import tempfile
+import threading
+from os import path
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from admission import AdmissionController, AdmissionMiddleware, MemoryBucketBackend, SQLiteBucketBackend
+
+def limits(**overrides) -> dict:
+    return {"test": {"user_rate": 1, "user_burst": 2, "ip_rate": 1, "ip_burst": 3, "concurrency": 0, **overrides}}
+
+class ThreadRecordingBackend(SQLiteBucketBackend):
+    """SQLite backend noting the thread each take ran on"""
+    def take(self, buckets: list) -> list[float]:
+        self.threads.append(threading.current_thread())
+        return super().take(buckets)
+
+class TestAdmission(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def backends(self) -> list:
+        return [MemoryBucketBackend(), SQLiteBucketBackend(path.join(self.temp_dir.name, "admission.sqlite"))]
+
+    def test_take(self):
+        for backend in self.backends():
+            self.assertEqual([[0.0], [0.0]], [backend.take([("a", 1, 2)]) for _ in range(2)])
+            wait = backend.take([("a", 1, 2)])[0]
+            self.assertGreater(wait, 0)
+            self.assertLessEqual(wait, 1)
+            # a refill rate of 100 a second has a token again shortly
+            backend.take([("b", 100, 1)])
+            self.assertGreater(backend.take([("b", 100, 1)])[0], 0)
+
+    def test_take_all_or_none(self):
+        for backend in self.backends():
+            backend.take([("empty", 0.001, 1)])
+            # the full bucket is not taken from while the other one is empty
+            for _ in range(3):
+                waits = backend.take([("empty", 0.001, 1), ("full", 0.001, 1)])
+                self.assertGreater(waits[0], 0)
+                self.assertEqual(0.0, waits[1])
+            self.assertEqual([0.0], backend.take([("full", 0.001, 1)]))
+            self.assertGreater(backend.take([("full", 0.001, 1)])[0], 0)
+
+    def test_memory_backend_size(self):
+        backend = MemoryBucketBackend(max_keys=2)
+        for key in ["a", "b", "c"]:
+            backend.take([(key, 1, 1)])
+        self.assertEqual(2, backend.stats()["keys"])
+        # a dropped bucket starts full again
+        self.assertEqual([0.0], backend.take([("a", 1, 1)]))
+
+    def test_ip_rejection_keeps_user_tokens(self):
+        controller = AdmissionController(MemoryBucketBackend(), limits(ip_burst=1))
+        self.assertIsNone(controller.admit("test", "bob", "10.0.0.1"))
+        status_code, retry_after = controller.admit("test", "bob", "10.0.0.1")
+        self.assertEqual(429, status_code)
+        self.assertGreater(retry_after, 0)
+        # bob's second token was not used up by the request his IP turned away
+        self.assertIsNone(controller.admit("test", "bob", "10.0.0.2"))
+        self.assertEqual(429, controller.admit("test", "bob", "10.0.0.3")[0])
+        counts = controller.stats()["classes"]["test"]
+        self.assertEqual((2, 1, 1), (counts["admitted"], counts["rejected_ip"], counts["rejected_user"]))
+
+    def test_concurrency(self):
+        controller = AdmissionController(MemoryBucketBackend(), limits(user_rate=0, ip_rate=0, concurrency=2))
+        self.assertIsNone(controller.admit("test", None, None))
+        self.assertIsNone(controller.admit("test", None, None))
+        self.assertEqual((503, 1), controller.admit("test", None, None))
+        controller.release("test")
+        self.assertIsNone(controller.admit("test", None, None))
+        self.assertEqual(2, controller.stats()["classes"]["test"]["in_flight"])
+
+    def test_admit_user(self):
+        controller = AdmissionController(MemoryBucketBackend(), limits(user_burst=1))
+        self.assertIsNone(controller.admit("test", None, "10.0.0.1"))
+        self.assertEqual(0.0, controller.admit_user("test", "bob"))
+        self.assertIsNone(controller.admit("test", None, "10.0.0.1"))
+        self.assertGreater(controller.admit_user("test", "bob"), 0)
+        counts = controller.stats()["classes"]["test"]
+        self.assertEqual((1, 1), (counts["admitted"], counts["rejected_user"]))
+        self.assertEqual(0.0, AdmissionController(MemoryBucketBackend(), limits(user_rate=0)).admit_user("test", "bob"))
+
+    def test_middleware(self):
+        app = FastAPI()
+        reads = []
+        loop_threads = set()
+        @app.post("/limited")
+        async def limited(request: Request):
+            loop_threads.add(threading.current_thread())
+            reads.append(await request.body())
+            return {"user": request.headers.get("x-user")}
+        @app.post("/open")
+        async def open_endpoint():
+            return {}
+        app.add_middleware(AdmissionMiddleware, classify=lambda method, path: "test" if path == "/limited" else None,
+                           identify=lambda headers: headers.get("x-user"))
+
+        backend = ThreadRecordingBackend(path.join(self.temp_dir.name, "admission.sqlite"))
+        backend.threads = []
+        app.admission = AdmissionController(backend, limits(ip_burst=100))
+        with TestClient(app) as client:
+            self.assertEqual(200, client.post("/limited", content=b"1", headers={"x-user": "bob"}).status_code)
+            self.assertEqual(200, client.post("/limited", content=b"2", headers={"x-user": "bob"}).status_code)
+            response = client.post("/limited", content=b"3", headers={"x-user": "bob"})
+            self.assertEqual(429, response.status_code)
+            self.assertEqual("1", response.headers["retry-after"])
+            self.assertEqual(200, client.post("/limited", content=b"4", headers={"x-user": "alice"}).status_code)
+            for _ in range(5):
+                self.assertEqual(200, client.post("/open").status_code)
+        # the rejected body was never read, and requests that finished are no longer in flight
+        self.assertEqual([b"1", b"2", b"4"], reads)
+        self.assertEqual(0, app.admission.stats()["classes"]["test"]["in_flight"])
+        # sqlite takes wait on the file, they ran on a thread rather than on the event loop
+        self.assertEqual(4, len(backend.threads))
+        self.assertEqual(set(), loop_threads & set(backend.threads))
+
+    def test_middleware_body_users(self):
+        app = FastAPI()
+        @app.post("/login")
+        async def login(request: Request):
+            retry_after = app.admission.admit_user("test", (await request.body()).decode())
+            return {"retry_after": retry_after}
+        app.add_middleware(AdmissionMiddleware, classify=lambda method, path: "test", identify=lambda headers: headers.get("x-user"),
+                           body_users={"test"})
+        app.admission = AdmissionController(MemoryBucketBackend(), limits(user_burst=1, ip_burst=100))
+        with TestClient(app) as client:
+            # the header user is ignored, the endpoint limits by the user in the body
+            self.assertEqual(0, client.post("/login", content=b"bob", headers={"x-user": "mallory"}).json()["retry_after"])
+            self.assertGreater(client.post("/login", content=b"bob", headers={"x-user": "mallory"}).json()["retry_after"], 0)
+            self.assertEqual(0, client.post("/login", content=b"alice", headers={"x-user": "mallory"}).json()["retry_after"])
+
+    def test_sqlite_fails_open(self):
+        logging.getLogger("admission").disabled = True
+        try:
+            backend = SQLiteBucketBackend(path.join(self.temp_dir.name, "admission.sqlite"), timeout=0.01)
+            # another worker holding the write lock lets the request through
+            other = SQLiteBucketBackend(path.join(self.temp_dir.name, "admission.sqlite")).connect()
+            other.execute("BEGIN IMMEDIATE")
+            self.assertEqual([0.0, 0.0], backend.take([("a", 1, 1), ("b", 1, 1)]))
+            other.execute("ROLLBACK")
+            self.assertEqual(1, backend.stats()["failed_open"])
+        finally:
+            logging.getLogger("admission").disabled = False
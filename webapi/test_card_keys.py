@@ -0,0 +1,31 @@
+import unittest
+from card_keys import CardKeyIndex, CardKeyError
+
+def card(id: int, source_id: str, set_code: str, collector_number: str) -> dict:
+    return {"id": id, "source_id": source_id, "set_code": set_code, "collector_number": collector_number}
+
+class TestCardKeys(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # 3 and 4 share a collector number, 5 has none
+        cls.keys = CardKeyIndex([card(1, "A-1", "aaa", "1"), card(2, "a-2", "aaa", "2a"), card(3, "b-1", "BBB", "1"),
+                                 card(4, "b-1-alt", "bbb", "1"), card(5, "c-1", "ccc", None)], "v1")
+
+    def test_resolve(self):
+        self.assertEqual(5, len(self.keys))
+        self.assertEqual((1, "aaa", "A-1"), self.keys.resolve(source_id=" a-1 "))
+        self.assertEqual((1, "aaa", "A-1"), self.keys.resolve(source_id="a-1", set_code="AAA"))
+        self.assertEqual((2, "aaa", "a-2"), self.keys.resolve(set_code="AAA", collector_number="2A"))
+        self.assertEqual((5, "ccc", "c-1"), self.keys.resolve(source_id="c-1"))
+
+    def test_resolve_errors(self):
+        for kwargs in [{"source_id": "missing"}, {"source_id": "a-1", "set_code": "bbb"}, {"set_code": "aaa"},
+                       {"set_code": "aaa", "collector_number": "9"}, {"set_code": "bbb", "collector_number": "1"}]:
+            with self.assertRaises(CardKeyError, msg=str(kwargs)):
+                self.keys.resolve(**kwargs)
+
+    def test_validate(self):
+        self.assertIsNone(self.keys.check("AAA", "a-1"))
+        self.assertIsNotNone(self.keys.check("bbb", "a-1"))
+        errors = self.keys.validate([("aaa", "a-1", 1), ("aaa", "missing", 1), ("bbb", "b-1", -1), ("ccc", "a-2", 1)])
+        self.assertEqual([(1, "missing"), (3, "a-2")], [(error["index"], error["id"]) for error in errors])
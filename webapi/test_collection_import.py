@@ -0,0 +1,51 @@
+import unittest
+import asyncio
+import collection_import as ci
+
+async def collect(chunks: list[bytes], max_line: int) -> list[bytes]:
+    async def stream():
+        for chunk in chunks:
+            yield chunk
+    return [line async for line in ci.iter_lines(stream(), max_line)]
+
+class TestCollectionImport(unittest.TestCase):
+    def test_get_format(self):
+        self.assertEqual("ndjson", ci.get_format("application/x-ndjson"))
+        self.assertEqual("csv", ci.get_format("text/csv; charset=utf-8"))
+        self.assertIsNone(ci.get_format("text/plain"))
+        self.assertIsNone(ci.get_format(None))
+
+    def test_iter_lines(self):
+        # lines split across chunks come out whole, the last line needs no newline
+        lines = asyncio.run(collect([b"a,b", b",1\nc,d,2\n", b"e,f,3"], 100))
+        self.assertEqual([b"a,b,1", b"c,d,2", b"e,f,3"], lines)
+        with self.assertRaises(ci.ImportRowError):
+            asyncio.run(collect([b"a" * 20], 10))
+        with self.assertRaises(ci.ImportRowError):
+            asyncio.run(collect([b"a" * 20 + b"\n"], 10))
+
+    def test_parse_row(self):
+        self.assertEqual(("aaa", "a-1", 2), ci.parse_row('["aaa", "a-1", 2]', "ndjson"))
+        self.assertEqual(("aaa", "a-1", -1), ci.parse_row('{"set": " aaa", "id": "a-1 ", "amount": -1.0}', "ndjson"))
+        self.assertEqual(("aaa", "a-1", 3), ci.parse_row("aaa,a-1,3", "csv"))
+        self.assertIsNone(ci.parse_row("set,id,amount", "csv"))
+        self.assertIsNone(ci.parse_row("  ", "ndjson"))
+
+    def test_parse_row_errors(self):
+        for line, format in [("aaa,a-1", "csv"), ("aaa,a-1,x", "csv"), (",a-1,1", "csv"), ("{", "ndjson"), ('["aaa", "a-1"]', "ndjson"),
+                             ('["aaa", "", 1]', "ndjson"), ('["aaa", "a-1", 1.5]', "ndjson"), ('["aaa", "a-1", true]', "ndjson")]:
+            with self.assertRaises(ci.ImportRowError, msg=line):
+                ci.parse_row(line, format)
+
+    def test_batcher(self):
+        batcher = ci.ImportBatcher(2)
+        self.assertFalse(batcher.add("aaa", "a-1", 1))
+        self.assertFalse(batcher.add("aaa", "a-1", 2))
+        self.assertTrue(batcher.add("aaa", "a-2", 1))
+        self.assertEqual(([("aaa", "a-1", 3), ("aaa", "a-2", 1)], 3), batcher.take())
+
+        # rows that cancel out are counted but change nothing
+        batcher.add("aaa", "a-1", 1)
+        batcher.add("aaa", "a-1", -1)
+        self.assertEqual(([], 2), batcher.take())
+        self.assertEqual(([], 0), batcher.take())
@@ -0,0 +1,121 @@
+import unittest
+import asyncio
+import tempfile
+import json
+import sqlalchemy as sa
+import db
+
+# (set code, collector number, card id, rarity) of the stand-in cards, one without a collector number
+CARDS = [("aaa", "1", "a-1", "common"), ("aaa", "2", "a-2", "rare"), ("aaa", "10", "a-10", "common"), ("aaa", None, "a-x", "common"),
+         ("bbb", "1", "b-1", "rare"), ("bbb", "2", "b-2", "common"), ("ccc", "1", "c-1", "mythic")]
+
+def seed(engine: sa.Engine):
+    with engine.connect() as conn:
+        for rarity in ["common", "rare", "mythic"]:
+            conn.execute(sa.text("INSERT INTO [MTG].[Rarity] ([name]) VALUES (:name)"), {"name": rarity})
+        for code in ["aaa", "bbb", "ccc"]:
+            conn.execute(sa.text("INSERT INTO [MTG].[Set] ([name], [shorthand]) VALUES (:name, :code)"), {"name": "Set "+code, "code": code})
+        conn.execute(sa.text("""
+                             INSERT INTO [MTG].[Card] ([name], [collector_number], [card_set_id], [source_id], [rarity_id])
+                             SELECT :source_id, :number, s.[id], :source_id, r.[id]
+                             FROM [MTG].[Set] AS s, [MTG].[Rarity] AS r
+                             WHERE s.[shorthand] = :code AND r.[name] = :rarity
+                             """), [{"code": code, "number": number, "source_id": source_id, "rarity": rarity} for code, number, source_id, rarity in CARDS])
+        conn.commit()
+
+def update(ids: list) -> str:
+    return json.dumps({"ids": ids})
+
+class TestDatabase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        cls.engine = db.create_standin_connection(cls.temp_dir.name, {})
+        seed(cls.engine)
+        cls.database = db.Database(cls.engine, 2)
+        # user 1 has n copies of the nth card
+        cls.database.exec_update_collection(1, update([[code, source_id, amount] for amount, (code, _number, source_id, _rarity) in enumerate(CARDS, 1)]))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.database.dispose()
+        cls.temp_dir.cleanup()
+
+    def counts(self, user_id: int) -> dict[str, int]:
+        with self.database.connect() as conn:
+            sql = sa.text("""
+                          SELECT c.[source_id], uc.[Count]
+                          FROM [Collection].[MTGCollection] AS uc
+                          JOIN [MTG].[Card] AS c ON c.[id] = uc.[CardID]
+                          WHERE uc.[UserID] = :param_user_id
+                          """)
+            return dict(conn.execute(sql.bindparams(param_user_id=user_id)).all())
+
+    def read_all(self, user_id: int, limit: int, **filters) -> list[list[dict]]:
+        pages = []
+        after = None
+        while True:
+            rows = self.database.fetch_collection_page(user_id, ["card_id", "count"], after, limit, **filters)
+            if len(rows) == 0:
+                return pages
+            pages.append(rows)
+            last = rows[-1]
+            after = (last["key_set"], last["key_number"], last["key_id"])
+
+    def test_users(self):
+        self.database.insert_user("tester", "hash")
+        user = self.database.fetch_user("tester")
+        self.assertEqual("tester", user.Username)
+        self.assertEqual("hash", user.Password)
+        self.assertIsNone(self.database.fetch_user("nobody"))
+        with self.assertRaises(sa.exc.IntegrityError):
+            self.database.insert_user("tester", "hash")
+
+    def test_collection_pages(self):
+        pages = self.read_all(1, 3)
+        self.assertEqual([3, 3, 1], [len(page) for page in pages])
+        # collector numbers are text, a missing one sorts first in its set
+        self.assertEqual(["a-x", "a-1", "a-10", "a-2", "b-1", "b-2", "c-1"], [row["card_id"] for page in pages for row in page])
+        counts = {row["card_id"]: row["count"] for page in pages for row in page}
+        self.assertEqual({source_id: amount for amount, (_code, _number, source_id, _rarity) in enumerate(CARDS, 1)}, counts)
+
+    def test_collection_filters(self):
+        rows = [row["card_id"] for page in self.read_all(1, 2, rarity="common") for row in page]
+        self.assertEqual(["a-x", "a-1", "a-10", "b-2"], rows)
+        rows = [row["card_id"] for page in self.read_all(1, 2, set_code="bbb") for row in page]
+        self.assertEqual(["b-1", "b-2"], rows)
+        rows = [row["card_id"] for page in self.read_all(1, 10, min_count=3, max_count=5) for row in page]
+        self.assertEqual(["a-10", "a-x", "b-1"], sorted(rows))
+
+    def test_iter_collection(self):
+        first = self.database.fetch_collection_page(1, ["card_id"], None, 2)
+        after = (first[-1]["key_set"], first[-1]["key_number"], first[-1]["key_id"])
+        batches = list(self.database.iter_collection(1, ["card_id"], after, 2))
+        self.assertTrue(all(len(batch) <= 2 for batch in batches))
+        self.assertEqual(["a-10", "a-2", "b-1", "b-2", "c-1"], [row["card_id"] for batch in batches for row in batch])
+
+    def test_update_collection(self):
+        self.assertEqual(1, self.database.exec_update_collection(2, update([["aaa", "a-1", 2], ["aaa", "a-1", 1], ["bbb", "b-1", 1]])))
+        self.assertEqual({"a-1": 3, "b-1": 1}, self.counts(2))
+
+        # a card that does not exist, or is in another set, rejects the whole update
+        self.assertEqual(0, self.database.exec_update_collection(2, update([["aaa", "a-1", 1], ["aaa", "missing", 1]])))
+        self.assertEqual(0, self.database.exec_update_collection(2, update([["bbb", "a-1", 1]])))
+        self.assertEqual({"a-1": 3, "b-1": 1}, self.counts(2))
+
+        # counts that reach 0 are removed
+        self.assertEqual(1, self.database.exec_update_collection(2, update([["bbb", "b-1", -1]])))
+        self.assertEqual({"a-1": 3}, self.counts(2))
+
+    def test_existing_cards(self):
+        self.assertEqual({("aaa", "a-1"), ("bbb", "b-1")}, set(self.database.fetch_existing_cards(["a-1", "b-1", "missing"])))
+        self.assertEqual([], self.database.fetch_existing_cards([]))
+
+    def test_async_calls(self):
+        async def calls():
+            return await asyncio.gather(self.database.get_version(), self.database.update_collection(3, update([["ccc", "c-1", 1]])))
+        version, result = asyncio.run(calls())
+        self.assertIsInstance(version, str)
+        self.assertEqual(1, result)
+        self.assertEqual({"c-1": 1}, self.counts(3))
+        self.assertEqual(2, self.database.pool_metrics()["threads"])
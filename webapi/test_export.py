@@ -0,0 +1,50 @@
+import unittest
+import zlib
+import json
+import export
+
+FIELDS = ["set_code", "card_id", "count"]
+
+def batches(count: int, batch_size: int) -> list[list[dict]]:
+    rows = [{"set_code": "aaa", "card_id": "a-"+str(i), "count": i, "name": "not exported"} for i in range(count)]
+    return [rows[i:i+batch_size] for i in range(0, count, batch_size)]
+
+class TestExport(unittest.TestCase):
+    def test_choose_encoding(self):
+        self.assertIsNone(export.choose_encoding(None))
+        self.assertIsNone(export.choose_encoding("identity"))
+        self.assertIsNone(export.choose_encoding("gzip;q=0"))
+        self.assertEqual("gzip", export.choose_encoding("deflate, gzip;q=0.5"))
+        self.assertEqual("gzip", export.choose_encoding("*"))
+        self.assertEqual("br" if export.brotli is not None else "gzip", export.choose_encoding("gzip, br"))
+
+    def test_encode_rows(self):
+        chunks = list(export.encode_rows(iter(batches(5, 2)), FIELDS, "csv"))
+        # the header is its own chunk, then one chunk per batch
+        self.assertEqual(4, len(chunks))
+        lines = b"".join(chunks).decode().splitlines()
+        self.assertEqual(["set_code,card_id,count", "aaa,a-0,0", "aaa,a-1,1"], lines[:3])
+        self.assertEqual(6, len(lines))
+
+        chunks = list(export.encode_rows(iter(batches(5, 2)), FIELDS, "ndjson"))
+        self.assertEqual(3, len(chunks))
+        rows = [json.loads(line) for line in b"".join(chunks).splitlines()]
+        self.assertEqual({"set_code": "aaa", "card_id": "a-4", "count": 4}, rows[-1])
+
+    def test_compress(self):
+        chunks = list(export.encode_rows(iter(batches(20000, 1000)), FIELDS, "ndjson"))
+        raw = b"".join(chunks)
+        self.assertEqual(chunks, list(export.compress(iter(chunks), None)))
+
+        compressed = list(export.compress(iter(chunks), "gzip"))
+        # the first batch is flushed straight away, so it can be decompressed before the rest arrives
+        first = zlib.decompressobj(31).decompress(compressed[0])
+        self.assertEqual(chunks[0], first)
+        body = b"".join(compressed)
+        self.assertEqual(raw, zlib.decompress(body, 31))
+        self.assertLess(len(body), len(raw) / 4)
+
+    @unittest.skipIf(export.brotli is None, "brotli is not installed")
+    def test_compress_brotli(self):
+        chunks = list(export.encode_rows(iter(batches(2000, 500)), FIELDS, "csv"))
+        self.assertEqual(b"".join(chunks), export.brotli.decompress(b"".join(export.compress(iter(chunks), "br"))))
@@ -0,0 +1,62 @@
+import unittest
+import search
+from search import CardIndex
+
+def card(source_id: str, name: str, set_code: str, rarity: str, converted_cost: float, type_line: str, text: str = None, face_names: list = None) -> dict:
+    row = {field: None for field in search.RESULT_FIELDS}
+    row.update({"source_id": source_id, "name": name, "set_code": set_code, "rarity": rarity, "converted_cost": converted_cost,
+                "type_line": type_line, "text": text, "face_names": face_names or []})
+    return row
+
+class TestSearch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.index = CardIndex([
+            card("1", "Llanowar Elves", "aaa", "common", 1, "Creature — Elf Druid", "{T}: Add {G}."),
+            card("2", "Lim-Dûl's Vault", "aaa", "uncommon", 2, "Instant", "Look at the top five cards of your library."),
+            card("3", "Delver of Secrets // Insectile Aberration", "bbb", "common", 1, "Creature — Human Wizard", "Look at the top card of your library.",
+                 ["Delver of Secrets", "Insectile Aberration"]),
+            card("4", "Elvish Mystic", "bbb", "common", 1, "Creature — Elf Druid", "{T}: Add {G}."),
+            card("5", "Llanowar Elves", "ccc", "common", 1, "Creature — Elf Druid", "{T}: Add {G}."),
+            card("6", "Shivan Dragon", "ccc", "rare", 6, "Creature — Dragon", "Flying")
+        ], "v1")
+
+    def source_ids(self, **filters) -> list[str]:
+        return [card["source_id"] for card in self.index.search(**filters)["cards"]]
+
+    def test_bitmaps(self):
+        numbers = [0, 3, 64, 65, 200]
+        self.assertEqual(numbers, list(search.iter_bits(search.to_bitmap(numbers))))
+        self.assertEqual(list(range(100)), list(search.iter_bits(search.to_bitmap(list(range(100))))))
+        self.assertEqual(search.range_bitmap(2, 5) | search.range_bitmap(8, 9), search.ranges_bitmap([(2, 5), (8, 9)], 10))
+        self.assertEqual(0, search.ranges_bitmap([], 0))
+
+    def test_name(self):
+        # results are in name order, printings of a name by set
+        self.assertEqual(["1", "5"], self.source_ids(name="llan"))
+        self.assertEqual(["2"], self.source_ids(name="lim-dul"))
+        self.assertEqual(["3", "4", "1", "5"], self.source_ids(name="elv"))
+        # under 3 characters only the start of a name matches
+        self.assertEqual(["4"], self.source_ids(name="el"))
+
+    def test_filters(self):
+        self.assertEqual(["4", "1", "5"], self.source_ids(text="add g"))
+        self.assertEqual(["3"], self.source_ids(text="aberration"))
+        self.assertEqual(["1", "5"], self.source_ids(type_line="elf", set_code="AAA") + self.source_ids(type_line="elf", set_code="ccc"))
+        self.assertEqual(["6"], self.source_ids(rarity="Rare"))
+        self.assertEqual(["2", "6"], self.source_ids(cmc_min=2))
+        self.assertEqual(["3", "4", "1", "5"], self.source_ids(cmc=1.5))
+        self.assertEqual([], self.source_ids(set_code="zzz"))
+
+    def test_paging(self):
+        result = self.index.search(type_line="creature", limit=2, offset=1)
+        self.assertEqual("v1", result["version"])
+        self.assertEqual(5, result["total"])
+        self.assertEqual(["4", "1"], [card["source_id"] for card in result["cards"]])
+
+    def test_autocomplete(self):
+        self.assertEqual(["Llanowar Elves"], self.index.autocomplete("LLAN"))
+        # names starting with the query come before names containing it
+        self.assertEqual(["Elvish Mystic", "Delver of Secrets // Insectile Aberration", "Llanowar Elves"], self.index.autocomplete("elv"))
+        self.assertEqual(["Elvish Mystic"], self.index.autocomplete("elv", 1))
+        self.assertEqual([], self.index.autocomplete(""))
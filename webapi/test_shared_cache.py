@@ -0,0 +1,100 @@
+import unittest
+import tempfile
+import threading
+from os import path
+from time import sleep
+from shared_cache import SharedCache, MemoryCacheBackend, SQLiteCacheBackend
+
+class FailingBackend:
+    def get(self, key: str):
+        raise ConnectionError("backend is down")
+
+    set = add = delete = stats = get
+
+class TestSharedCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def backends(self) -> list:
+        return [MemoryCacheBackend(), SQLiteCacheBackend(path.join(self.temp_dir.name, "cache.sqlite"))]
+
+    def test_backends(self):
+        for backend in self.backends():
+            backend.set("a", b"1", 60)
+            self.assertEqual(b"1", backend.get("a"))
+            # add only sets missing or expired keys
+            self.assertFalse(backend.add("a", b"2", 60))
+            self.assertTrue(backend.add("b", b"2", 0.01))
+            sleep(0.02)
+            self.assertIsNone(backend.get("b"))
+            self.assertTrue(backend.add("b", b"3", 60))
+            self.assertEqual(b"3", backend.get("b"))
+            backend.delete("a")
+            self.assertIsNone(backend.get("a"))
+            self.assertEqual(1, backend.stats()["size"])
+
+    def test_memory_backend_size(self):
+        backend = MemoryCacheBackend(max_size=2)
+        backend.set("a", b"1", 60)
+        backend.set("b", b"2", 60)
+        backend.get("a")
+        backend.set("c", b"3", 60)
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual(b"1", backend.get("a"))
+
+    def test_key(self):
+        cache = SharedCache(MemoryCacheBackend(), namespace="test")
+        self.assertEqual("test:user:bob", cache.key("user", "bob"))
+        self.assertEqual("test:v7:catalogue:search", cache.key("catalogue", "search", version=7))
+
+    def test_get_or_load(self):
+        for backend in self.backends():
+            cache = SharedCache(backend, local_size=0)
+            loads = []
+            self.assertEqual(b"x", cache.get_or_load("k", lambda: loads.append(1) or b"x", 60))
+            self.assertEqual(b"x", cache.get_or_load("k", lambda: loads.append(1) or b"y", 60))
+            self.assertEqual(1, len(loads))
+            # None is returned but not cached
+            self.assertIsNone(cache.get_or_load("none", lambda: None, 60))
+            self.assertIsNone(backend.get("none"))
+            cache.invalidate("k")
+            self.assertEqual(b"z", cache.get_or_load("k", lambda: b"z", 60))
+
+    def test_single_flight(self):
+        # two caches on one file stand in for two workers, each with threads asking for the same missing key
+        file_name = path.join(self.temp_dir.name, "cache.sqlite")
+        caches = [SharedCache(SQLiteCacheBackend(file_name), local_size=0) for _ in range(2)]
+        loads = []
+        def load():
+            loads.append(1)
+            sleep(0.1)
+            return b"value"
+        results = []
+        threads = [threading.Thread(target=lambda cache=cache: results.append(cache.get_or_load("k", load, 60))) for cache in caches for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([b"value"] * 8, results)
+        self.assertEqual(1, len(loads))
+
+    def test_local_tier(self):
+        backend = MemoryCacheBackend()
+        cache = SharedCache(SQLiteCacheBackend(path.join(self.temp_dir.name, "cache.sqlite")), local_size=10, local_ttl=60)
+        cache.set("k", b"1", 60)
+        cache.backend.delete("k")
+        # served from the local tier until it expires there
+        self.assertEqual(b"1", cache.get("k"))
+        self.assertEqual(b"1", cache.peek("k"))
+        self.assertEqual(2, cache.stats()["local_hits"])
+        self.assertIsNone(SharedCache(backend).peek("k"))
+
+    def test_failing_backend(self):
+        cache = SharedCache(FailingBackend(), local_size=0)
+        self.assertEqual(b"x", cache.get_or_load("k", lambda: b"x", 60))
+        stats = cache.stats()
+        self.assertGreater(stats["backend_errors"], 0)
+        self.assertIsNone(stats["backend"])
@@ -0,0 +1,212 @@
+import unittest
+import logging
+import tempfile
+import json
+from os import path
+import db
+import test_db
+from write_behind import WriteBehindQueue, JournalLockedError
+
+class FlakyDatabase:
+    """Stand-in database whose update calls raise once for the (user, call number) pairs in fail_on"""
+    def __init__(self, database: db.Database, fail_on: set = None):
+        self.database = database
+        self.fail_on = fail_on or set()
+        self.calls: dict[int, int] = {}
+
+    def exec_update_collection(self, user_id: int, json_str: str, applied: tuple = None) -> int:
+        call = self.calls[user_id] = self.calls.get(user_id, 0) + 1
+        if (user_id, call) in self.fail_on:
+            raise ConnectionError("db went away")
+        return self.database.exec_update_collection(user_id, json_str, applied)
+
+    def fetch_applied_changes(self, flush_id: str) -> dict[int, int]:
+        return self.database.fetch_applied_changes(flush_id)
+
+class ProcessDied(BaseException):
+    """Raised past the queue's error handling, leaves the journal files as a crash would"""
+
+class DyingDatabase(FlakyDatabase):
+    """Stand-in database that dies on the update calls of the users in fail_on"""
+    def exec_update_collection(self, user_id: int, json_str: str, applied: tuple = None) -> int:
+        if user_id in self.fail_on:
+            raise ProcessDied()
+        return self.database.exec_update_collection(user_id, json_str, applied)
+
+class DyingAfterCommitDatabase(FlakyDatabase):
+    """Stand-in database that raises error after committing an update of the users in fail_on"""
+    error = ProcessDied
+
+    def exec_update_collection(self, user_id: int, json_str: str, applied: tuple = None) -> int:
+        result = self.database.exec_update_collection(user_id, json_str, applied)
+        if user_id in self.fail_on and result == 1:
+            raise self.error()
+        return result
+
+class LostReplyDatabase(DyingAfterCommitDatabase):
+    error = ConnectionError
+
+class TestWriteBehind(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        logging.getLogger("write_behind").disabled = True
+        cls.db_dir = tempfile.TemporaryDirectory()
+        cls.engine = db.create_standin_connection(cls.db_dir.name, {})
+        test_db.seed(cls.engine)
+        cls.database = db.Database(cls.engine, 2)
+
+    @classmethod
+    def tearDownClass(cls):
+        logging.getLogger("write_behind").disabled = False
+        cls.database.dispose()
+        cls.db_dir.cleanup()
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.journal_path = path.join(self.temp_dir.name, "collection.journal")
+        with self.database.connect() as conn:
+            conn.execute(db.COLLECTION.delete())
+            conn.execute(db.sa.text("DELETE FROM [Collection].[WriteBehindApplied]"))
+            conn.commit()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def counts(self, user_id: int) -> dict[str, int]:
+        return {row["card_id"]: row["count"] for row in self.database.fetch_collection_page(user_id, ["card_id", "count"], None, None)}
+
+    def test_coalescing(self):
+        queue = WriteBehindQueue(self.database, self.journal_path, sync=False)
+        for _ in range(50):
+            queue.append(1, [["aaa", "a-1", 1], ["bbb", "b-1", 1]])
+            queue.append(2, [["aaa", "a-1", 1]])
+        queue.append(2, [["aaa", "a-1", -50]])
+        queue.flush()
+        self.assertEqual({"a-1": 50, "b-1": 50}, self.counts(1))
+        self.assertEqual({}, self.counts(2))
+        stats = queue.stats()
+        # user 2's changes cancelled out, so only user 1 needed a call
+        self.assertEqual(1, stats["db_calls"])
+        self.assertEqual(101, stats["updates"])
+        queue.stop()
+
+    def test_dropped_changes(self):
+        queue = WriteBehindQueue(self.database, self.journal_path, sync=False)
+        queue.append(1, [["aaa", "a-1", 1], ["aaa", "missing", 1], ["bbb", "b-1", 2]])
+        queue.flush()
+        self.assertEqual({"a-1": 1, "b-1": 2}, self.counts(1))
+        stats = queue.stats()
+        self.assertEqual(1, stats["dropped_changes"])
+        # the batch, then one call per card
+        self.assertEqual(4, stats["db_calls"])
+        self.assertEqual(0, stats["pending_cards"])
+        queue.stop()
+
+    def test_requeue_after_error(self):
+        # the whole batch raises, so all of it is queued again
+        queue = WriteBehindQueue(FlakyDatabase(self.database, {(1, 1)}), self.journal_path, sync=False)
+        queue.append(1, [["aaa", "a-1", 1], ["bbb", "b-1", 2]])
+        queue.flush()
+        self.assertEqual({}, self.counts(1))
+        self.assertEqual(1, queue.stats()["retried_users"])
+        self.assertEqual(2, queue.stats()["pending_cards"])
+        queue.flush()
+        self.assertEqual({"a-1": 1, "b-1": 2}, self.counts(1))
+        queue.stop()
+
+    def test_requeue_after_partial_fallback(self):
+        # the batch is rejected for the missing card and the fallback raises on the third card, after applying one card and dropping another
+        database = FlakyDatabase(self.database, {(1, 4)})
+        queue = WriteBehindQueue(database, self.journal_path, sync=False)
+        queue.append(1, [["aaa", "a-1", 1], ["aaa", "missing", 1], ["bbb", "b-1", 2], ["ccc", "c-1", 3]])
+        queue.flush()
+        self.assertEqual({"a-1": 1}, self.counts(1))
+        self.assertEqual({1: {("bbb", "b-1"): 2, ("ccc", "c-1"): 3}}, queue.pending)
+        queue.flush()
+        self.assertEqual({"a-1": 1, "b-1": 2, "c-1": 3}, self.counts(1))
+        self.assertEqual(1, queue.stats()["dropped_changes"])
+        queue.stop()
+
+        # the journal was left with nothing to apply again
+        queue = WriteBehindQueue(self.database, self.journal_path, sync=False)
+        self.assertEqual(0, queue.stats()["pending_cards"])
+        queue.stop()
+
+    def test_stop_flushes(self):
+        queue = WriteBehindQueue(self.database, self.journal_path, flush_seconds=60, sync=False)
+        queue.start()
+        queue.append(1, [["aaa", "a-2", 1]])
+        queue.stop()
+        self.assertEqual({"a-2": 1}, self.counts(1))
+        with open(self.journal_path, encoding="utf-8") as file:
+            self.assertEqual("", file.read())
+
+    def test_journal_lock(self):
+        queue = WriteBehindQueue(self.database, self.journal_path, sync=False)
+        queue.append(1, [["aaa", "a-1", 1]])
+        # a second worker on the same journal would replay changes the first one is about to apply
+        with self.assertRaises(JournalLockedError):
+            WriteBehindQueue(self.database, self.journal_path, sync=False)
+        queue.stop()
+        queue = WriteBehindQueue(self.database, self.journal_path, sync=False)
+        queue.stop()
+        self.assertEqual({"a-1": 1}, self.counts(1))
+
+    def test_recover_after_crash_mid_flush(self):
+        queue = WriteBehindQueue(DyingDatabase(self.database, {2}), self.journal_path, sync=False)
+        queue.append(1, [["aaa", "a-1", 1]])
+        queue.append(2, [["aaa", "a-1", 2]])
+        queue.append(3, [["aaa", "a-1", 3]])
+        with self.assertRaises(ProcessDied):
+            queue.flush()
+        # user 1 was applied and marked done before the process died part way through user 2
+        self.assertEqual({"a-1": 1}, self.counts(1))
+        self.assertTrue(path.exists(self.journal_path+".flushing"))
+        queue.journal.close()
+        queue.lock_file.close()
+
+        # the unfinished flush is queued again by the next flush, once the db can say what it applied
+        queue = WriteBehindQueue(self.database, self.journal_path, sync=False)
+        self.assertTrue(path.exists(self.journal_path+".flushing"))
+        queue.stop()
+        self.assertFalse(path.exists(self.journal_path+".flushing"))
+        self.assertEqual({"a-1": 1}, self.counts(1))
+        self.assertEqual({"a-1": 2}, self.counts(2))
+        self.assertEqual({"a-1": 3}, self.counts(3))
+
+    def test_recover_incomplete_line(self):
+        with open(self.journal_path, "w", encoding="utf-8") as file:
+            file.write(json.dumps([1, [["aaa", "a-1", 1]]])+"\n"+json.dumps([1, [["aaa", "a-1", 1]]])+"\n"+'[1, [["aaa", "a-')
+        queue = WriteBehindQueue(self.database, self.journal_path, sync=False)
+        self.assertEqual({1: {("aaa", "a-1"): 2}}, queue.pending)
+        queue.stop()
+        self.assertEqual({"a-1": 2}, self.counts(1))
+
+    def test_recover_after_crash_after_commit(self):
+        # user 2's batch fell back to one card at a time, the process died after the first card was committed
+        queue = WriteBehindQueue(DyingAfterCommitDatabase(self.database, {2}), self.journal_path, sync=False)
+        queue.append(1, [["aaa", "a-1", 1]])
+        queue.append(2, [["aaa", "a-1", 2], ["aaa", "missing", 1], ["bbb", "b-1", 1]])
+        queue.append(3, [["aaa", "a-1", 3]])
+        with self.assertRaises(ProcessDied):
+            queue.flush()
+        self.assertEqual({"a-1": 2}, self.counts(2))
+        queue.journal.close()
+        queue.lock_file.close()
+
+        queue = WriteBehindQueue(self.database, self.journal_path, sync=False)
+        queue.append(2, [["bbb", "b-2", 1]])
+        queue.stop()
+        self.assertEqual({"a-1": 1}, self.counts(1))
+        self.assertEqual({"a-1": 2, "b-1": 1, "b-2": 1}, self.counts(2))
+        self.assertEqual({"a-1": 3}, self.counts(3))
+
+    def test_requeue_after_lost_reply(self):
+        # the db committed the batch but the reply never arrived, the applied changes say not to queue it again
+        queue = WriteBehindQueue(LostReplyDatabase(self.database, {1}), self.journal_path, sync=False)
+        queue.append(1, [["aaa", "a-1", 1], ["bbb", "b-1", 2]])
+        queue.flush()
+        self.assertEqual(1, queue.stats()["retried_users"])
+        self.assertEqual(0, queue.stats()["pending_cards"])
+        queue.stop()
+        self.assertEqual({"a-1": 1, "b-1": 2}, self.counts(1))
@@ -0,0 +1,316 @@
+import asyncio
+import json
+import threading
+import logging as lo
+from os import fsync, path, remove, replace
+from time import monotonic
+from uuid import uuid4
+try:
+    import fcntl
+except ImportError:
+    # windows locks files through msvcrt instead
+    fcntl = None
+    import msvcrt
+log = lo.getLogger(__name__)
+
+# Write-behind for collection updates. Changes are appended to a local journal and acknowledged, then coalesced per (user, card) in memory
+# and flushed with one [Collection].[UpdateMTGCollection] call per user, so a scanning session of +1 updates becomes a call every few seconds
+#
+# Journal files, next to the journal path :
+#   journal           every acknowledged change since the last flush started, one [user id, ids] line each
+#   journal.flushing  the changes of the flush in progress
+#   journal.flushed   the id of the flush in progress, then the users whose changes are no longer needed from journal.flushing
+#   journal.lock      held by the process using the journal, so a second process can not replay and flush the same changes
+# On start everything in journal is queued again. journal.flushing is left for the next flush, which queues again the changes of the users
+# not in journal.flushed, less those [Collection].[WriteBehindApplied] says the db already has from that flush
+#
+# Only one process can use a journal, with uvicorn --workers N the journal can only be used by a single worker process
+
+class JournalLockedError(Exception):
+    pass
+
+def merge(pending: dict[int, dict[tuple[str, str], int]], user_id: int, ids: list) -> int:
+    """Add ids to the user's pending changes, returns how many cards the user had no change for yet"""
+    changes = pending.setdefault(user_id, {})
+    new = 0
+    for set_code, source_id, amount in ids:
+        key = (set_code, source_id)
+        if key not in changes:
+            new += 1
+        changes[key] = changes.get(key, 0) + amount
+    return new
+
+def read_journal(journal_path: str) -> list[tuple[int, list]]:
+    if not path.exists(journal_path):
+        return []
+    records = []
+    with open(journal_path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                user_id, ids = json.loads(line)
+            except ValueError:
+                # a line cut short by a crash was never acknowledged
+                log.warning("skipping incomplete line in collection journal %s", journal_path)
+                continue
+            records.append((user_id, ids))
+    return records
+
+def read_batch(journal_path: str) -> dict[int, list[tuple[str, str, int]]]:
+    """Each user's coalesced changes in a journal, in the order a flush applies them"""
+    pending: dict[int, dict[tuple[str, str], int]] = {}
+    for user_id, ids in read_journal(journal_path):
+        merge(pending, user_id, ids)
+    return {user_id: to_ids(changes) for user_id, changes in pending.items()}
+
+def read_flushed(flushed_path: str) -> tuple[str | None, set[int]]:
+    """(flush id, users done with) of the flush in progress, no id when it stopped before applying anything"""
+    if not path.exists(flushed_path):
+        return None, set()
+    flush_id = None
+    done = set()
+    with open(flushed_path, "r", encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if line.startswith("flush "):
+                flush_id = line[6:]
+            elif line.isdigit():
+                done.add(int(line))
+    return flush_id, done
+
+def lock_journal(lock_path: str):
+    """Open and lock the journal's lock file without waiting, the lock is released when the file is closed or the process exits
+
+    Raises JournalLockedError when another process holds the lock
+    """
+    file = open(lock_path, "a+b")
+    try:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        file.close()
+        raise JournalLockedError("collection journal "+lock_path.removesuffix(".lock")+" is in use by another process")
+    return file
+
+def to_ids(changes: dict[tuple[str, str], int]) -> list[tuple[str, str, int]]:
+    # changes that cancelled each other out change nothing
+    return [(set_code, source_id, amount) for (set_code, source_id), amount in changes.items() if amount != 0]
+
+class WriteBehindQueue:
+    """Acknowledges collection updates once they are in the journal and applies them to the db in coalesced batches
+
+    Parameters:
+    database (db.Database): Database the batches are applied to
+    journal_path (str): Journal file, locked while the queue is open. Raises JournalLockedError when another process has it
+    flush_seconds (float): Most seconds a change waits before it is applied
+    max_cards (int): Pending (user, card) changes that start a flush early
+    sync (bool): fsync the journal before acknowledging, without it a power loss can lose acknowledged changes but a process crash can not
+    """
+    def __init__(self, database, journal_path: str, flush_seconds: float = 2, max_cards: int = 10000, sync: bool = True):
+        self.database = database
+        self.journal_path = journal_path
+        self.flushing_path = journal_path+".flushing"
+        self.flushed_path = journal_path+".flushed"
+        self.flush_seconds = flush_seconds
+        self.max_cards = max_cards
+        self.sync = sync
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending: dict[int, dict[tuple[str, str], int]] = {}
+        self.pending_cards = 0
+        self.stop_event = threading.Event()
+        self.wake = threading.Event()
+        self.thread: threading.Thread = None
+        self.counts = {"updates": 0, "changes": 0, "flushes": 0, "db_calls": 0, "retried_users": 0, "dropped_changes": 0}
+        self.last_flush = {"seconds": 0.0, "users": 0, "cards": 0, "error": None}
+        # taken before the journal is read, another process replaying it would apply its changes twice
+        self.lock_file = lock_journal(journal_path+".lock")
+        self.recover()
+        self.journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def recover(self):
+        """Queue the changes left in the journal by the last run and compact them into a new journal
+
+        A flush the last run did not finish needs the db to tell which of its changes were applied, it is left for requeue_unfinished
+        """
+        records = read_journal(self.journal_path)
+        for user_id, ids in records:
+            self.pending_cards += merge(self.pending, user_id, ids)
+        if len(records) > 0:
+            log.info("recovered %s collection updates from the journal", len(records))
+
+        temp_path = self.journal_path+".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            for user_id, changes in self.pending.items():
+                file.write(json.dumps([user_id, to_ids(changes)])+"\n")
+            file.flush()
+            fsync(file.fileno())
+        replace(temp_path, self.journal_path)
+        if not path.exists(self.flushing_path) and path.exists(self.flushed_path):
+            remove(self.flushed_path)
+
+    def queue(self, user_id: int, ids: list):
+        """Journal the change and queue it, returns once the change is durable"""
+        line = json.dumps([user_id, ids])+"\n"
+        with self.lock:
+            self.journal.write(line)
+            self.journal.flush()
+            if self.sync:
+                fsync(self.journal.fileno())
+            self.pending_cards += merge(self.pending, user_id, ids)
+            if self.pending_cards >= self.max_cards:
+                self.wake.set()
+
+    def append(self, user_id: int, ids: list):
+        self.queue(user_id, ids)
+        with self.lock:
+            self.counts["updates"] += 1
+            self.counts["changes"] += len(ids)
+
+    def requeue_unfinished(self):
+        """Queue again the changes of a flush that stopped part way, which are otherwise only in journal.flushing
+
+        The process can stop after the db committed a user's changes and before the user was written to journal.flushed, the changes the
+        db has from that flush are left out
+        """
+        if not path.exists(self.flushing_path):
+            return
+        flush_id, done = read_flushed(self.flushed_path)
+        batch = {user_id: ids for user_id, ids in read_batch(self.flushing_path).items() if user_id not in done}
+        applied = self.database.fetch_applied_changes(flush_id) if flush_id is not None and len(batch) > 0 else {}
+        for user_id, ids in batch.items():
+            remaining = ids[applied.get(user_id, -1) + 1:]
+            if len(remaining) > 0:
+                self.queue(user_id, remaining)
+        if len(batch) > 0:
+            log.info("queued %s users of an unfinished flush again, %s of them had changes applied", len(batch), len(set(batch) & set(applied)))
+        remove(self.flushing_path)
+        if path.exists(self.flushed_path):
+            remove(self.flushed_path)
+
+    async def add(self, user_id: int, ids: list):
+        # the journal write waits on the disk, keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.append, user_id, ids)
+
+    def count(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def apply(self, user_id: int, ids: list, finished: list, flush_id: str) -> bool:
+        """Apply one user's changes, falling back to one card at a time when the batch has a card that does not exist
+
+        Changes are added to finished in order once they are applied or dropped, so when a db call raises part way only the changes
+        after them still need applying. The db stores the index of the last change applied against flush_id with the changes
+
+        Parameters:
+        finished (list): Gets the changes that are done with
+        flush_id (str): Id of the flush the changes are applied in
+        """
+        self.count("db_calls")
+        if self.database.exec_update_collection(user_id, "{ \"ids\":"+json.dumps(ids)+"}", (flush_id, len(ids) - 1)) == 1:
+            finished.extend(ids)
+            return True
+        for index, change in enumerate(ids):
+            self.count("db_calls")
+            if self.database.exec_update_collection(user_id, "{ \"ids\":"+json.dumps([change])+"}", (flush_id, index)) != 1:
+                self.count("dropped_changes")
+                log.error("dropping collection change %s for user %s, the card does not exist", change, user_id)
+            finished.append(change)
+        return False
+
+    def flush(self):
+        """Apply everything pending, the changes of a user that were not applied when their batch raised are queued again"""
+        with self.flush_lock:
+            self.requeue_unfinished()
+            with self.lock:
+                if len(self.pending) == 0:
+                    return
+                self.pending, self.pending_cards = {}, 0
+                self.wake.clear()
+                # changes from here on go to a new journal, the old one covers this batch until every user in it is done
+                self.journal.close()
+                replace(self.journal_path, self.flushing_path)
+                self.journal = open(self.journal_path, "a", encoding="utf-8")
+
+            # the batch is read back from journal.flushing, so requeue_unfinished sees the same changes in the same order after a crash
+            batch = read_batch(self.flushing_path)
+            flush_id = uuid4().hex
+            started = monotonic()
+            error = None
+            cards = 0
+            with open(self.flushed_path, "a", encoding="utf-8") as flushed:
+                self.write_flushed(flushed, "flush "+flush_id)
+                for user_id, ids in batch.items():
+                    cards += len(ids)
+                    finished = []
+                    try:
+                        if len(ids) > 0:
+                            self.apply(user_id, ids, finished, flush_id)
+                    except Exception as ex:
+                        error = str(ex)
+                        # changes applied or dropped before the failure must not be applied again
+                        remaining = ids[self.done_count(user_id, flush_id, len(finished)):]
+                        log.exception("failed to apply collection changes for user %s, queueing %s of them again : %s", user_id, len(remaining), ex)
+                        self.count("retried_users")
+                        self.queue(user_id, remaining)
+                    self.write_flushed(flushed, str(user_id))
+            remove(self.flushing_path)
+            remove(self.flushed_path)
+            with self.lock:
+                self.counts["flushes"] += 1
+                self.last_flush = {"seconds": round(monotonic() - started, 4), "users": len(batch), "cards": cards, "error": error}
+
+    def done_count(self, user_id: int, flush_id: str, finished: int) -> int:
+        """Changes of a user that are done with after a db call raised, the call may have committed before the connection failed"""
+        try:
+            return max(finished, self.database.fetch_applied_changes(flush_id).get(user_id, -1) + 1)
+        except Exception as ex:
+            log.warning("could not read the applied changes of flush %s, queueing every unfinished change of user %s : %s", flush_id, user_id, ex)
+            return finished
+
+    def write_flushed(self, flushed, line: str):
+        flushed.write(line+"\n")
+        flushed.flush()
+        if self.sync:
+            fsync(flushed.fileno())
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.wake.wait(self.flush_seconds)
+            try:
+                self.flush()
+            except Exception as ex:
+                log.exception("collection flush failed : %s", ex)
+                # back off instead of spinning on a full queue
+                self.stop_event.wait(self.flush_seconds)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop flushing in the background and apply what is still pending"""
+        self.stop_event.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+        try:
+            self.flush()
+        except Exception as ex:
+            log.exception("final collection flush failed, the journal is applied on the next start : %s", ex)
+        self.journal.close()
+        self.lock_file.close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            updates = self.counts["updates"]
+            return {
+                "pending_users": len(self.pending),
+                "pending_cards": self.pending_cards,
+                **self.counts,
+                # updates acknowledged per stored procedure call
+                "coalescing": round(updates / self.counts["db_calls"], 2) if self.counts["db_calls"] > 0 else None,
+                "last_flush": self.last_flush
+            }